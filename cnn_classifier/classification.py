@@ -0,0 +1,427 @@
+import collections
+import io
+import itertools
+import os
+import queue
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from enum import Enum
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+import numpy as np
+from PIL import Image
+from tqdm import tqdm
+
+from utils.prediction_cache import PredictionCache
+
+
+class TagStatus(Enum):
+    tagged = 0
+    untagged = 1
+
+
+class_labels = (TagStatus.tagged.name, TagStatus.untagged.name)
+
+# Normalization of the training transforms, i.e. Normalize([0.5], [0.5])
+# applied to images scaled to [0, 1]
+normalize_mean = 0.5
+normalize_std = 0.5
+
+# torch: TaggedBeeClassifierConvNet in inference.py
+# numpy: NumpyTaggedBeeClassifier in numpy_inference.py, doesn't import torch
+backends = ("torch", "numpy")
+
+# Variants of the torch backend
+# fp32: the eager PyTorch model
+# torchscript: the traced and frozen model, see export.py
+# int8: the statically quantized and traced model for CPUs, see export.py
+model_variants = ("fp32", "torchscript", "int8")
+# File in the archive of an exported variant with the hash of the fp32
+# weights it was exported from, see export.py
+SOURCE_HASH_FILE = "source_model_hash"
+
+# Aggregations of the predictions of several frames of a video snippet
+# mean: the mean of the class probabilities of the frames
+# max: the maximum tagged probability, i.e. tagged if any frame looks tagged
+frame_aggregations = ("mean", "max")
+
+# File extensions of images, as in torchvision's ImageFolder
+IMG_EXTENSIONS = (
+    ".jpg",
+    ".jpeg",
+    ".png",
+    ".ppm",
+    ".bmp",
+    ".pgm",
+    ".tif",
+    ".tiff",
+    ".webp",
+)
+
+
+def load_classifier(model_path, backend: str = "torch", variant: str = "fp32"):
+    """
+    Loads the classifier of a backend. The backend module is only imported
+    here, so that the numpy backend never imports torch.
+    """
+    if backend == "numpy":
+        if variant != "fp32":
+            raise ValueError("The numpy backend only supports the fp32 variant")
+        from .numpy_inference import NumpyTaggedBeeClassifier
+
+        return NumpyTaggedBeeClassifier(model_path)
+    if backend == "torch":
+        from .inference import TaggedBeeClassifierConvNet
+
+        return TaggedBeeClassifierConvNet(model_path, variant)
+    raise ValueError(
+        f"Unknown backend: {backend}, expected one of {', '.join(backends)}"
+    )
+
+
+class ImageClassifier:
+    """
+    Classification API shared by the backends, which implement classify_batch
+    for stacked uint8 batches of grayscale images.
+    """
+
+    # File that determines the predictions, e.g. for the prediction cache
+    weights_path: Path
+
+    def classify_batch(self, images):
+        """
+        Classifies a stacked uint8 batch of grayscale images of shape (N, H, W)
+        or (N, 1, H, W) in a single forward pass. Returns the predictions,
+        confidences and tagged probabilities as arrays.
+        """
+        raise NotImplementedError
+
+    def classify_single_image(self, image):
+        """Classifies an image."""
+        predictions, confidences, _ = self.classify_batch(
+            to_grayscale_array(image)[np.newaxis]
+        )
+        return predictions[0], confidences[0]
+
+    def classify_images(self, images):
+        """
+        Classifies a sequence of images in a single forward pass. Returns the
+        predictions, confidences and tagged probabilities as arrays.
+        """
+        return self.classify_batch(
+            np.stack([to_grayscale_array(image) for image in images])
+        )
+
+    def classify_frame_stacks(self, frame_stacks, aggregation: str = "mean"):
+        """
+        Classifies video snippets by several frames each, e.g. from
+        decode_frames_center. The frames of all snippets are classified in a
+        single forward pass and their probabilities are aggregated per
+        snippet, see frame_aggregations. Returns the predictions,
+        confidences and tagged probabilities of the snippets as arrays.
+        """
+        _, _, tagged_probabilities = self.classify_batch(
+            np.concatenate([to_grayscale_array(frames) for frames in frame_stacks])
+        )
+        return aggregate_frame_predictions(
+            tagged_probabilities, [len(frames) for frames in frame_stacks], aggregation
+        )
+
+    def classify_image_files(
+        self,
+        paths,
+        batch_size,
+        cache: Optional[PredictionCache] = None,
+        decode_workers: Optional[int] = None,
+    ):
+        """
+        Classifies image files in batches. Returns the predictions, confidences
+        and tagged probabilities as arrays.
+
+        If a cache is given, it is consulted before an image is decoded, keyed
+        by the directory and the CRC32 of the file, and new results are added
+        to it. The images are decoded as in iter_classify_images.
+        """
+        predictions = np.empty(len(paths), dtype=int)
+        confidences = np.empty(len(paths), dtype=np.float32)
+        tagged_probabilities = np.empty(len(paths), dtype=np.float32)
+        start = 0
+        with tqdm(total=len(paths)) as progress:
+            for batch_paths, *results in self.iter_classify_images(
+                paths, batch_size, decode_workers, cache
+            ):
+                end = start + len(batch_paths)
+                (
+                    predictions[start:end],
+                    confidences[start:end],
+                    tagged_probabilities[start:end],
+                ) = results
+                start = end
+                progress.update(len(batch_paths))
+        return predictions, confidences, tagged_probabilities
+
+    def classify_images_from_directory(
+        self,
+        image_dir: Path | str,
+        batch_size,
+        cache: Optional[PredictionCache] = None,
+        decode_workers: Optional[int] = None,
+    ):
+        """
+        Classifies the images below a directory, e.g. one with one
+        subdirectory per class like an ImageFolder. Returns the predictions,
+        confidences and paths as arrays. If a cache is given, it is used as in
+        classify_image_files.
+        """
+        batches = list(
+            self.iter_classify_images(image_dir, batch_size, decode_workers, cache)
+        )
+        if not batches:
+            return np.empty(0, dtype=int), np.empty(0, dtype=np.float32), np.empty(0)
+        paths, predictions, confidences, _ = zip(*batches)
+        return (
+            np.concatenate(predictions),
+            np.concatenate(confidences),
+            np.array(list(itertools.chain.from_iterable(paths))),
+        )
+
+    def iter_classify_images(
+        self,
+        images: Union[Path, str, Iterable],
+        batch_size: int,
+        decode_workers: Optional[int] = None,
+        cache: Optional[PredictionCache] = None,
+    ) -> Iterator[Tuple[List[str], np.ndarray, np.ndarray, np.ndarray]]:
+        """
+        Classifies the images below a directory, which may be flat or nested,
+        or the image files of an iterable of paths, batch by batch. Yields the
+        paths, predictions, confidences and tagged probabilities of every
+        batch as soon as it is classified, so the first results arrive
+        immediately and memory stays constant however many images there are.
+
+        Batches are read and decoded ahead by decode_workers threads (default:
+        number of CPUs) into reused image buffers. PIL releases the GIL while
+        decoding, so the threads decode in parallel. With 0 workers, the
+        images are decoded on the calling thread. If a cache is given, it is
+        used as in classify_image_files.
+        """
+        if isinstance(images, (str, os.PathLike)):
+            images = iter_image_paths(images)
+        paths = iter(images)
+        batches = iter(lambda: list(itertools.islice(paths, batch_size)), [])
+        if decode_workers is None:
+            decode_workers = os.cpu_count() or 1
+        # Image buffers of classified batches, which later batches reuse
+        free_buffers = queue.SimpleQueue()
+        # Cached predictions by directory, shared by the decoding threads
+        cached_by_directory = {}
+
+        def read(batch_paths: List) -> _ReadBatch:
+            return _read_batch(
+                batch_paths, batch_size, free_buffers, cache, cached_by_directory
+            )
+
+        def classify(batch: _ReadBatch):
+            if batch.uncached:
+                num_uncached = len(batch.uncached)
+                results = self.classify_batch(batch.images[:num_uncached])
+                (
+                    batch.predictions[batch.uncached],
+                    batch.confidences[batch.uncached],
+                    batch.tagged_probabilities[batch.uncached],
+                ) = results
+                free_buffers.put(batch.images)
+                if cache is not None:
+                    for directory in set(batch.directories):
+                        members = [
+                            i
+                            for i, other in enumerate(batch.directories)
+                            if other == directory
+                        ]
+                        cache.put_many(
+                            directory,
+                            [batch.crc32s[i] for i in members],
+                            *(result[members] for result in results),
+                        )
+            return (
+                batch.paths,
+                batch.predictions,
+                batch.confidences,
+                batch.tagged_probabilities,
+            )
+
+        if decode_workers == 0:
+            for batch_paths in batches:
+                yield classify(read(batch_paths))
+            return
+        with ThreadPoolExecutor(decode_workers) as executor:
+            # Batches that are read ahead, at most one more than workers
+            pending = collections.deque()
+            for batch_paths in batches:
+                pending.append(executor.submit(read, batch_paths))
+                if len(pending) > decode_workers:
+                    yield classify(pending.popleft().result())
+            while pending:
+                yield classify(pending.popleft().result())
+
+
+class _ReadBatch:
+    """
+    A batch of image files of iter_classify_images. The results of cached
+    images are filled in, the other images are decoded into images in the
+    order of uncached.
+    """
+
+    def __init__(self, paths: List[str]):
+        self.paths = paths
+        self.predictions = np.empty(len(paths), dtype=int)
+        self.confidences = np.empty(len(paths), dtype=np.float32)
+        self.tagged_probabilities = np.empty(len(paths), dtype=np.float32)
+        self.images: Optional[np.ndarray] = None
+        # Indices, directories and CRC32s of the images that aren't cached
+        self.uncached: List[int] = []
+        self.directories: List[str] = []
+        self.crc32s: List[int] = []
+
+
+def _read_batch(
+    paths: List,
+    batch_size: int,
+    free_buffers: queue.SimpleQueue,
+    cache: Optional[PredictionCache],
+    cached_by_directory: Dict[str, Dict],
+) -> _ReadBatch:
+    batch = _ReadBatch([str(path) for path in paths])
+    for index, path in enumerate(batch.paths):
+        with open(path, "rb") as f:
+            data = f.read()
+        # Keyed like Path.resolve, which follows symbolic links
+        directory = os.path.dirname(os.path.realpath(path))
+        crc32 = zlib.crc32(data)
+        if cache is not None:
+            if directory not in cached_by_directory:
+                cached_by_directory[directory] = cache.get_archive(directory)
+            cached = cached_by_directory[directory].get(crc32)
+            if cached is not None:
+                (
+                    batch.predictions[index],
+                    batch.confidences[index],
+                    batch.tagged_probabilities[index],
+                ) = cached
+                continue
+        with Image.open(io.BytesIO(data)) as image:
+            array = to_grayscale_array(image)
+        if batch.images is None:
+            batch.images = _image_buffer(free_buffers, batch_size, array.shape)
+        elif array.shape != batch.images.shape[1:]:
+            raise ValueError(
+                f"{path} has shape {array.shape}, but the other images of its "
+                f"batch have shape {batch.images.shape[1:]}"
+            )
+        batch.images[len(batch.uncached)] = array
+        batch.uncached.append(index)
+        batch.directories.append(directory)
+        batch.crc32s.append(crc32)
+    return batch
+
+
+def _image_buffer(
+    free_buffers: queue.SimpleQueue, batch_size: int, shape: Tuple[int, ...]
+) -> np.ndarray:
+    """Reuses a free image buffer of the shape or allocates a new one."""
+    try:
+        buffer = free_buffers.get_nowait()
+    except queue.Empty:
+        buffer = None
+    if buffer is None or buffer.shape[1:] != shape:
+        buffer = np.empty((batch_size, *shape), dtype=np.uint8)
+    return buffer
+
+
+def aggregate_frame_predictions(
+    tagged_probabilities: np.ndarray, frame_counts: List[int], aggregation: str = "mean"
+):
+    """
+    Aggregates the tagged probabilities of consecutive groups of frames into
+    the predictions, confidences and tagged probabilities of the groups.
+    """
+    starts = np.cumsum([0] + list(frame_counts[:-1]))
+    if aggregation == "mean":
+        snippet_probabilities = np.add.reduceat(
+            tagged_probabilities, starts
+        ) / np.asarray(frame_counts)
+    elif aggregation == "max":
+        snippet_probabilities = np.maximum.reduceat(tagged_probabilities, starts)
+    else:
+        raise ValueError(
+            f"Unknown aggregation: {aggregation}, expected one of {', '.join(frame_aggregations)}"
+        )
+    snippet_probabilities = snippet_probabilities.astype(np.float32)
+    # Ties are tagged, like the argmax of the model
+    predictions = np.where(
+        snippet_probabilities >= 0.5, TagStatus.tagged.value, TagStatus.untagged.value
+    )
+    confidences = np.where(
+        predictions == TagStatus.tagged.value,
+        snippet_probabilities,
+        1 - snippet_probabilities,
+    )
+    return predictions, confidences, snippet_probabilities
+
+
+def to_grayscale_array(image: Union[Image.Image, np.ndarray]) -> np.ndarray:
+    """
+    Converts a PIL image to a uint8 grayscale array like transforms.Grayscale,
+    which converts with PIL, too. Single-channel images and arrays are
+    returned without conversion.
+    """
+    if isinstance(image, np.ndarray):
+        return image
+    if image.mode != "L":
+        image = image.convert("L")
+    return np.asarray(image)
+
+
+def variant_path(model_path, variant: str) -> Path:
+    """Path of an exported model variant next to the fp32 weights."""
+    model_path = Path(model_path)
+    if variant == "fp32":
+        return model_path
+    return model_path.with_suffix(f".{variant}.pt")
+
+
+def image_folder_samples(image_dir: Path | str) -> List[Tuple[str, int]]:
+    """
+    Paths and class indices of the images in a directory with one
+    subdirectory per class, in the order of torchvision's ImageFolder.
+    """
+    class_dirs = sorted(entry.path for entry in os.scandir(image_dir) if entry.is_dir())
+    samples = []
+    for class_index, class_dir in enumerate(class_dirs):
+        for root, _, filenames in sorted(os.walk(class_dir, followlinks=True)):
+            for filename in sorted(filenames):
+                if filename.lower().endswith(IMG_EXTENSIONS):
+                    samples.append((os.path.join(root, filename), class_index))
+    return samples
+
+
+def iter_image_paths(image_dir: Path | str) -> Iterator[str]:
+    """
+    Paths of the images below a flat or nested directory, depth-first in
+    sorted order. A directory with one subdirectory per class is walked in
+    the order of torchvision's ImageFolder. Directories are listed lazily, so
+    that a caller can start on the first images of a large tree.
+    """
+    entries = sorted(os.scandir(image_dir), key=lambda entry: entry.name)
+    for entry in entries:
+        if entry.is_file() and entry.name.lower().endswith(IMG_EXTENSIONS):
+            yield entry.path
+    for entry in entries:
+        if entry.is_dir():
+            yield from iter_image_paths(entry.path)
+
+
+def image_folder_paths(image_dir: Path | str) -> List[str]:
+    """Paths of the images of image_folder_samples."""
+    return [path for path, _ in image_folder_samples(image_dir)]
@@ -0,0 +1,129 @@
+import http.client
+import io
+import json
+import threading
+from pathlib import Path
+from typing import Optional
+from urllib.parse import urlsplit
+
+import numpy as np
+
+from utils.micro_batcher import MicroBatcher
+
+from .classification import ImageClassifier
+from .server import DEFAULT_HOST, DEFAULT_PORT
+
+
+class InferenceClient(ImageClassifier):
+    """
+    Classifies with a running inference server, see server.py, with the API of
+    the classifiers, e.g. classify_single_image. Doesn't import torch.
+    Connections are kept open, one per thread.
+    """
+
+    def __init__(
+        self, url: str = f"http://{DEFAULT_HOST}:{DEFAULT_PORT}", timeout: float = 30
+    ):
+        parts = urlsplit(url)
+        self.host = parts.hostname or DEFAULT_HOST
+        self.port = parts.port or DEFAULT_PORT
+        self.timeout = timeout
+        self._local = threading.local()
+
+    @property
+    def weights_path(self) -> Path:
+        """Weights of the server, e.g. for the prediction cache."""
+        return Path(self.health()["weights_path"])
+
+    def classify_batch(self, images):
+        """
+        Classifies a stacked uint8 batch of grayscale images of shape (N, H, W)
+        or (N, 1, H, W) on the server, where it may share a forward pass with
+        other requests. Returns the predictions, confidences and tagged
+        probabilities as arrays.
+        """
+        images = np.asarray(images)
+        if images.dtype != np.uint8:
+            raise ValueError(f"Expected a uint8 batch, got {images.dtype}")
+        if images.ndim == 4:
+            images = images[:, 0]
+        buffer = io.BytesIO()
+        np.save(buffer, np.ascontiguousarray(images), allow_pickle=False)
+        response = self._request("POST", "/classify", buffer.getvalue())
+        return (
+            np.array(response["predictions"], dtype=int),
+            np.array(response["confidences"], dtype=np.float32),
+            np.array(response["tagged_probabilities"], dtype=np.float32),
+        )
+
+    def health(self) -> dict:
+        return self._request("GET", "/health")
+
+    def stats(self) -> dict:
+        return self._request("GET", "/stats")
+
+    def _request(self, method: str, path: str, body: Optional[bytes] = None):
+        headers = {"Content-Type": "application/octet-stream"} if body else {}
+        for attempt in range(2):
+            connection = self._connection()
+            try:
+                connection.request(method, path, body, headers)
+                response = connection.getresponse()
+                data = json.loads(response.read())
+                break
+            except (http.client.RemoteDisconnected, ConnectionResetError):
+                # The server closed the kept-open connection, reconnect once.
+                self._close_connection()
+                if attempt == 1:
+                    raise
+            except BaseException:
+                # E.g. a timeout, after which the response may still arrive on
+                # the connection, so the next request uses a new one.
+                self._close_connection()
+                raise
+        if response.status != 200:
+            raise RuntimeError(
+                f"Inference server error {response.status}: {data.get('error')}"
+            )
+        return data
+
+    def _connection(self) -> http.client.HTTPConnection:
+        if getattr(self._local, "connection", None) is None:
+            self._local.connection = http.client.HTTPConnection(
+                self.host, self.port, timeout=self.timeout
+            )
+        return self._local.connection
+
+    def _close_connection(self):
+        self._local.connection.close()
+        self._local.connection = None
+
+
+class LocalInferenceClient(ImageClassifier):
+    """
+    Stand-in for InferenceClient without a server: requests are merged into
+    batches in this process, like on the server. Useful for testing code that
+    uses a client and for threads of one process that share a classifier.
+    """
+
+    def __init__(
+        self,
+        classifier: ImageClassifier,
+        max_batch_size: int = 64,
+        max_wait: float = 0.002,
+    ):
+        self.classifier = classifier
+        self.weights_path = classifier.weights_path
+        self.batcher = MicroBatcher(classifier.classify_batch, max_batch_size, max_wait)
+
+    def classify_batch(self, images):
+        images = np.asarray(images)
+        if images.ndim == 4:
+            images = images[:, 0]
+        return self.batcher.classify(images)
+
+    def stats(self) -> dict:
+        return self.batcher.stats()
+
+    def close(self):
+        self.batcher.close()
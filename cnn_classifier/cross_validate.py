@@ -0,0 +1,350 @@
+import argparse
+import json
+import multiprocessing
+import os
+import statistics
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from .classification import TagStatus, class_labels
+from .hyperparameters import batch_size, epochs, learning_rate
+from .split_dataset import (
+    DEFAULT_DATA_DIR,
+    labeled_images,
+    read_manifest,
+    stratified_assignment,
+)
+
+# Metrics of every fold on its held-out images, tagged is the positive class
+METRICS = ("accuracy", "loss", "precision", "recall", "f1")
+
+# Images of a worker process, decoded once in init_worker
+_worker = {}
+
+
+def main():
+    """
+    Trains the model k times, each time holding out another of k stratified
+    folds of the images, and evaluates it on the held-out fold. The folds are
+    trained concurrently in worker processes. Reports the mean, standard
+    deviation and variance of the metrics over the folds, which is a more
+    reliable estimate of the performance than a single small test split.
+    """
+    parser = init_argparse()
+    args: MyArgs = parser.parse_args(namespace=MyArgs())
+    if args.folds < 2:
+        parser.error("--folds must be at least 2")
+    if args.manifest is not None:
+        splits = ["train", "validation"] + (["test"] if args.include_test else [])
+        samples = read_manifest(args.manifest, splits)
+    else:
+        samples = [
+            (str(path), class_labels.index(label))
+            for path, label, _ in labeled_images(args.data_dir)
+        ]
+    if len(samples) < args.folds:
+        parser.error(f"found {len(samples)} images, fewer than --folds {args.folds}")
+    folds = stratified_assignment(
+        [label for _, label in samples], [1 / args.folds] * args.folds, args.seed
+    )
+    empty_folds = sorted(set(range(args.folds)) - set(folds))
+    if empty_folds:
+        parser.error(
+            f"folds {', '.join(map(str, empty_folds))} of {args.folds} have no "
+            f"images, use fewer --folds"
+        )
+    workers = min(args.workers, args.folds)
+    if args.torch_threads is None:
+        args.torch_threads = max(1, (os.cpu_count() or 1) // workers)
+    if args.output_dir is None:
+        args.output_dir = Path("output/cross_validation") / datetime.now().strftime(
+            "%Y%m%d_%H%M%S"
+        )
+    args.output_dir.mkdir(parents=True, exist_ok=True)
+    configuration = {
+        "learning_rate": args.learning_rate,
+        "batch_size": args.batch_size,
+        "epochs": args.epochs,
+        "seed": args.seed,
+    }
+
+    print(
+        f"Cross-validating on {len(samples)} images with {args.folds} folds, "
+        f"{workers} workers and {args.torch_threads} torch threads each"
+    )
+    start = time.perf_counter()
+    results = []
+    with ProcessPoolExecutor(
+        workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=init_worker,
+        initargs=(samples, args.torch_threads),
+    ) as executor:
+        futures = [
+            executor.submit(
+                run_fold_in_worker,
+                fold,
+                args.output_dir / f"fold_{fold}",
+                [index for index, other in enumerate(folds) if other != fold],
+                [index for index, other in enumerate(folds) if other == fold],
+                configuration,
+            )
+            for fold in range(args.folds)
+        ]
+        for future in as_completed(futures):
+            result = future.result()
+            results.append(result)
+            print(
+                f"{result['fold']}: "
+                + ", ".join(f"{metric} {result[metric]:.4f}" for metric in METRICS)
+                + f" ({result['seconds']:.1f} s)"
+            )
+
+    # The names sort fold_10 before fold_2.
+    results.sort(key=lambda result: result["fold_index"])
+    summary = summarize(results)
+    with open(args.output_dir / "cross_validation.json", "w") as f:
+        json.dump(
+            {
+                "manifest": None if args.manifest is None else str(args.manifest),
+                "data_dir": str(args.data_dir),
+                "num_images": len(samples),
+                "folds": args.folds,
+                "config": configuration,
+                "summary": summary,
+                "results": results,
+            },
+            f,
+            indent=2,
+        )
+    print(
+        f"\n{args.folds} folds in {time.perf_counter() - start:.1f} s, "
+        f"results: {args.output_dir / 'cross_validation.json'}"
+    )
+    print(f"{'metric':<9}  {'mean':>7}  {'std':>7}  {'variance':>9}")
+    for metric, values in summary.items():
+        print(
+            f"{metric:<9}  {values['mean']:>7.4f}  {values['std']:>7.4f}  "
+            f"{values['variance']:>9.2e}"
+        )
+
+
+def summarize(results: List[Dict]) -> Dict[str, Dict[str, float]]:
+    """Mean, sample standard deviation and variance of the metrics over the folds."""
+    summary = {}
+    for metric in METRICS:
+        values = [result[metric] for result in results]
+        summary[metric] = {
+            "mean": statistics.mean(values),
+            "std": statistics.stdev(values),
+            "variance": statistics.variance(values),
+        }
+    return summary
+
+
+def init_worker(samples: List[Tuple[str, int]], torch_threads: int):
+    # Imported here, so that the main process doesn't import torch.
+    import matplotlib
+    import torch
+
+    from .datasets import InMemoryDataset
+
+    matplotlib.use("Agg")
+    # Caps intra-op parallelism, so that the workers don't oversubscribe the CPU.
+    torch.set_num_threads(torch_threads)
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    _worker["device"] = device
+    # Every fold of the worker takes its images from the same decoded images.
+    _worker["dataset"] = InMemoryDataset.from_samples(samples, device)
+
+
+def run_fold_in_worker(
+    fold_index: int,
+    fold_dir: Path,
+    train_indices: List[int],
+    test_indices: List[int],
+    configuration: Dict,
+) -> Dict:
+    """
+    Trains the model on the images of the other folds, evaluates it on the
+    held-out images and writes metrics.json, training_graphs.png and
+    model.pth to the fold directory. Returns the metrics.
+    """
+    import torch
+
+    from .datasets import InMemoryDataLoader
+    from .model import TaggedBeeClassificationModel
+    from .train import fit, save_plots
+
+    fold_dir.mkdir(parents=True, exist_ok=True)
+    start = time.perf_counter()
+    torch.manual_seed(configuration["seed"])
+    device = _worker["device"]
+    dataset = _worker["dataset"]
+    test_dataloader = InMemoryDataLoader(
+        dataset.subset(test_indices), configuration["batch_size"]
+    )
+    model = TaggedBeeClassificationModel().to(device)
+    history = fit(
+        model,
+        InMemoryDataLoader(
+            dataset.subset(train_indices),
+            configuration["batch_size"],
+            shuffle=True,
+            augment=True,
+            seed=configuration["seed"],
+        ),
+        test_dataloader,
+        configuration["epochs"],
+        configuration["learning_rate"],
+        device,
+        verbose=False,
+    )
+    metrics = {
+        "fold": fold_dir.name,
+        "fold_index": fold_index,
+        "num_train_images": len(train_indices),
+        "num_test_images": len(test_indices),
+        **evaluate(model, test_dataloader, device),
+        "seconds": time.perf_counter() - start,
+        "history": history,
+    }
+    with open(fold_dir / "metrics.json", "w") as f:
+        json.dump(metrics, f, indent=2)
+    save_plots(
+        history["train_loss"],
+        history["validation_loss"],
+        history["validation_accuracy"],
+        fold_dir / "training_graphs.png",
+    )
+    torch.save(model.state_dict(), fold_dir / "model.pth")
+    return metrics
+
+
+def evaluate(model, dataloader, device) -> Dict[str, float]:
+    """Accuracy, mean loss and, for tagged bees, precision, recall and F1 score."""
+    import math
+
+    import torch
+    import torch.nn as nn
+
+    from utils.metrics import BinaryMetrics
+
+    criterion = nn.CrossEntropyLoss(reduction="sum")
+    model.eval()
+    loss = 0.0
+    metrics = BinaryMetrics(positive=TagStatus.tagged.value)
+    with torch.no_grad():
+        for images, labels in dataloader:
+            images, labels = images.to(device), labels.to(device)
+            outputs = model(images)
+            loss += criterion(outputs, labels).item()
+            metrics.update(labels.cpu(), outputs.argmax(1).cpu())
+    # Undefined scores count as 0, so that they can be averaged over the folds.
+    return {
+        "accuracy": metrics.accuracy(),
+        "loss": loss / metrics.count,
+        **{
+            name: 0.0 if math.isnan(value) else value
+            for name, value in (
+                ("precision", metrics.precision()),
+                ("recall", metrics.recall()),
+                ("f1", metrics.f1_score()),
+            )
+        },
+    }
+
+
+class MyArgs(argparse.Namespace):
+    manifest: Optional[Path]
+    data_dir: Path
+    include_test: bool
+    folds: int
+    seed: int
+    learning_rate: float
+    batch_size: int
+    epochs: int
+    workers: int
+    torch_threads: Optional[int]
+    output_dir: Optional[Path]
+
+
+def init_argparse() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        description=(
+            "Cross-validates the CNN classifier with k stratified folds that are trained concurrently in worker processes"
+        ),
+    )
+    parser.add_argument(
+        "--manifest",
+        type=Path,
+        default=None,
+        help="split manifest whose train and validation images are cross-validated, see split_dataset.py (default: all images below --data_dir)",
+    )
+    parser.add_argument(
+        "--data_dir",
+        type=Path,
+        default=DEFAULT_DATA_DIR,
+        help="directory with the images in tagged and untagged directories, used without --manifest (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--include_test",
+        action="store_true",
+        help="also cross-validate the test images of --manifest",
+    )
+    parser.add_argument(
+        "--folds",
+        type=int,
+        default=5,
+        help="number of folds (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=0,
+        help="seed of the folds, the weight initialization and the training order (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--learning_rate",
+        type=float,
+        default=learning_rate,
+        help="learning rate of Adam (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=batch_size,
+        help="number of images per batch (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--epochs",
+        type=int,
+        default=epochs,
+        help="number of epochs (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="number of folds that are trained in parallel processes (default: number of CPUs, %(default)s)",
+    )
+    parser.add_argument(
+        "--torch_threads",
+        type=int,
+        default=None,
+        help="number of torch intra-op threads per worker (default: number of CPUs divided by --workers)",
+    )
+    parser.add_argument(
+        "--output_dir",
+        type=Path,
+        default=None,
+        help="directory of the folds and the results (default: output/cross_validation/<timestamp>)",
+    )
+    return parser
+
+
+if __name__ == "__main__":
+    main()
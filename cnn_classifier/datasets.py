@@ -1,54 +1,432 @@
+import copy
+import csv
+import os
 from pathlib import Path
+from typing import Iterator, List, Optional, Sequence, Tuple, Union
+from zipfile import ZipFile
 
+import numpy as np
 import torch
 import torchvision.datasets as datasets
 import torchvision.transforms.v2 as transforms
-from torch.utils.data import DataLoader
-
-from hyperparameters import batch_size
-
-train_transform = transforms.Compose(
-    [
-        transforms.Grayscale(1),
-        transforms.RandomHorizontalFlip(p=0.5),
-        transforms.RandomVerticalFlip(p=0.5),
-        transforms.ToImage(),
-        transforms.ToDtype(torch.float32, scale=True),
-        transforms.Normalize([0.5], [0.5]),
-    ]
-)
+from PIL import Image
+from torch.utils.data import DataLoader, Dataset
 
-test_transform = transforms.Compose(
-    [
-        transforms.Grayscale(1),
-        transforms.ToImage(),
-        transforms.ToDtype(torch.float32, scale=True),
-        transforms.Normalize([0.5], [0.5]),
-    ]
-)
+from utils.apng_decoding import decode_first_frame_center
 
-train_dataset = datasets.ImageFolder(
-    Path.cwd() / "data" / "cropped" / "50x50" / "train",
-    train_transform,
-)
-validation_dataset = datasets.ImageFolder(
-    Path.cwd() / "data" / "cropped" / "50x50" / "validation",
-    test_transform,
-)
-test_dataset = datasets.ImageFolder(
-    Path.cwd() / "data" / "cropped" / "50x50" / "test",
-    test_transform,
+from .classification import class_labels, image_folder_samples, to_grayscale_array
+from .hyperparameters import batch_size, image_size
+from .split_dataset import (
+    DEFAULT_DATA_DIR,
+    SPLITS,
+    read_manifest,
+    stratified_assignment,
 )
 
-train_dataloader = DataLoader(train_dataset, batch_size=batch_size, shuffle=True)
-validation_dataloader = DataLoader(
-    validation_dataset,
-    batch_size=batch_size,
-)
-test_dataloader = DataLoader(test_dataset, batch_size=120)
+
+def get_transform(split: str) -> transforms.Compose:
+    """Transforms of the images of a split, only training images are flipped."""
+    augmentations = []
+    if split == "train":
+        augmentations = [
+            transforms.RandomHorizontalFlip(p=0.5),
+            transforms.RandomVerticalFlip(p=0.5),
+        ]
+    return transforms.Compose(
+        [
+            transforms.Grayscale(1),
+            *augmentations,
+            transforms.ToImage(),
+            transforms.ToDtype(torch.float32, scale=True),
+            transforms.Normalize([0.5], [0.5]),
+        ]
+    )
+
+
+def get_samples(
+    split: str, data_dir: Path = DEFAULT_DATA_DIR, manifest: Optional[Path] = None
+) -> List[Tuple[str, int]]:
+    """
+    Paths and class indices of the images of a split, from its directory or,
+    if given, from a manifest, see split_dataset.py.
+    """
+    _check_split(split)
+    if manifest is None:
+        return image_folder_samples(data_dir / split)
+    return read_manifest(manifest, [split])
+
+
+class ManifestDataset(Dataset):
+    """Images of a list of samples, loaded and transformed like ImageFolder."""
+
+    def __init__(self, samples: List[Tuple[str, int]], transform=None):
+        self.samples = samples
+        self.targets = [label for _, label in samples]
+        self.transform = transform
+
+    def __len__(self):
+        return len(self.samples)
+
+    def __getitem__(self, index: int):
+        path, label = self.samples[index]
+        image = datasets.folder.default_loader(path)
+        if self.transform is not None:
+            image = self.transform(image)
+        return image, label
+
+
+def get_dataset(
+    split: str, data_dir: Path = DEFAULT_DATA_DIR, manifest: Optional[Path] = None
+) -> Dataset:
+    """
+    Image folder of a split, or the images of the split of a manifest. Its
+    directory is only scanned when this is called, not when the module is
+    imported.
+    """
+    _check_split(split)
+    if manifest is not None:
+        return ManifestDataset(
+            get_samples(split, manifest=manifest), get_transform(split)
+        )
+    return datasets.ImageFolder(data_dir / split, get_transform(split))
+
+
+def get_dataloader(
+    split: str,
+    data_dir: Path = DEFAULT_DATA_DIR,
+    batch_size: int = batch_size,
+    manifest: Optional[Path] = None,
+) -> DataLoader:
+    """
+    Data loader of a split, only training images are shuffled. Test images
+    are loaded in batches of 120.
+    """
+    dataset = get_dataset(split, data_dir, manifest)
+    if split == "train":
+        return DataLoader(dataset, batch_size=batch_size, shuffle=True)
+    if split == "validation":
+        return DataLoader(dataset, batch_size=batch_size)
+    return DataLoader(dataset, batch_size=120)
+
+
+class WDDZipDataset(Dataset):
+    """
+    Center crops of the first frames of the video snippets in WDD zip
+    archives, decoded from the archives on the fly instead of from images
+    written by scripts/crop_images.py.
+
+    The snippets of an archive are numbered by their day dance id like in
+    daily_data_processing.py. If labels_dir is given, only the snippets in the
+    data.csv of the day of an archive are included, labeled by their
+    corrected label or else their predicted label, and archives without a
+    data.csv are skipped. Otherwise all snippets are included with label -1.
+
+    Without a transform, the items are uint8 arrays of shape (H, W), so the
+    batches of a DataLoader can be passed to ImageClassifier.classify_batch.
+    Every process opens its own handles to the archives, so the dataset can
+    be used by the workers of a DataLoader.
+    """
+
+    def __init__(
+        self,
+        zips: Union[Path, Sequence[Path]],
+        labels_dir: Optional[Path] = None,
+        transform=None,
+        size: int = image_size,
+    ):
+        if isinstance(zips, (str, os.PathLike)):
+            zips = wdd_zip_paths(Path(zips))
+        self.zip_paths = [Path(path) for path in zips]
+        self.transform = transform
+        self.size = size
+        # Archive index, APNG member and class index of every snippet
+        self.samples: List[Tuple[int, str, int]] = []
+        for zip_index, zip_path in enumerate(self.zip_paths):
+            with ZipFile(zip_path) as zip_file:
+                video_filenames = [
+                    name for name in zip_file.namelist() if name.endswith(".apng")
+                ]
+            if labels_dir is None:
+                self.samples += [(zip_index, name, -1) for name in video_filenames]
+                continue
+            data_path = Path(labels_dir) / zip_path.stem / "data.csv"
+            if not data_path.exists():
+                continue
+            with open(data_path, newline="") as f:
+                for row in csv.DictReader(f):
+                    label = row["corrected_category_label"] or row["category_label"]
+                    if label not in class_labels:
+                        raise ValueError(f"Unknown label in {data_path}: {label}")
+                    self.samples.append(
+                        (
+                            zip_index,
+                            video_filenames[int(row["day_dance_id"]) - 1],
+                            class_labels.index(label),
+                        )
+                    )
+        self.targets = [label for *_, label in self.samples]
+        self._zip_files = {}
+        self._pid = os.getpid()
+
+    def __len__(self):
+        return len(self.samples)
+
+    def __getitem__(self, index: int):
+        zip_index, video_filename, label = self.samples[index]
+        # The first frame is decoded from the stream, so only the beginning
+        # of the snippet is decompressed.
+        with self._zip_file(zip_index).open(video_filename) as video_file:
+            image = decode_first_frame_center(video_file, self.size, self.size)
+        if self.transform is not None:
+            image = self.transform(Image.fromarray(image))
+        return image, label
+
+    def subset(self, indices: Sequence[int], transform=None) -> "WDDZipDataset":
+        """Dataset of some of the snippets, e.g. of a split, with its own transform."""
+        dataset = copy.copy(self)
+        dataset.samples = [self.samples[index] for index in indices]
+        dataset.targets = [label for *_, label in dataset.samples]
+        dataset.transform = transform
+        return dataset
+
+    def close(self):
+        for zip_file in self._zip_files.values():
+            zip_file.close()
+        self._zip_files = {}
+
+    def _zip_file(self, zip_index: int) -> ZipFile:
+        # Handles aren't shared with forked or spawned workers, whose reads
+        # would move the file position of the other processes.
+        if self._pid != os.getpid():
+            self._zip_files = {}
+            self._pid = os.getpid()
+        if zip_index not in self._zip_files:
+            self._zip_files[zip_index] = ZipFile(self.zip_paths[zip_index])
+        return self._zip_files[zip_index]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_zip_files"] = {}
+        return state
+
+
+def wdd_zip_paths(zips_dir: Path) -> List[Path]:
+    """Zip archives below a directory, e.g. one per day."""
+    return sorted(zips_dir.rglob("*.zip"))
+
+
+def split_wdd_zip_dataset(
+    dataset: WDDZipDataset, validation_fraction: float = 0.15, seed: Optional[int] = 0
+) -> Tuple[List[int], List[int]]:
+    """Indices of a seeded split into training and validation snippets, stratified by label."""
+    groups = stratified_assignment(
+        dataset.targets, [1 - validation_fraction, validation_fraction], seed
+    )
+    return (
+        [index for index, group in enumerate(groups) if group == 0],
+        [index for index, group in enumerate(groups) if group == 1],
+    )
+
+
+def get_wdd_zip_dataloaders(
+    zips_dir: Path,
+    labels_dir: Path,
+    batch_size: int = batch_size,
+    validation_fraction: float = 0.15,
+    seed: Optional[int] = 0,
+    num_workers: int = 0,
+) -> Tuple[DataLoader, DataLoader]:
+    """
+    Training and validation data loaders of the labeled snippets of WDD zip
+    archives, transformed like the cropped images of get_dataloader.
+    """
+    dataset = WDDZipDataset(zips_dir, labels_dir)
+    if not dataset.samples:
+        raise FileNotFoundError(
+            f"Found no labeled snippets of the archives in {zips_dir} in {labels_dir}"
+        )
+    train_indices, validation_indices = split_wdd_zip_dataset(
+        dataset, validation_fraction, seed
+    )
+    loader_args = dict(
+        batch_size=batch_size,
+        num_workers=num_workers,
+        persistent_workers=num_workers > 0,
+    )
+    return (
+        DataLoader(
+            dataset.subset(train_indices, get_transform("train")),
+            shuffle=True,
+            **loader_args,
+        ),
+        DataLoader(
+            dataset.subset(validation_indices, get_transform("validation")),
+            **loader_args,
+        ),
+    )
+
+
+class InMemoryDataset:
+    """
+    All images of a split, decoded once into a uint8 tensor of shape
+    (N, 1, H, W) on the device, and their labels in the order of ImageFolder.
+    """
+
+    def __init__(
+        self,
+        split: str,
+        data_dir: Path = DEFAULT_DATA_DIR,
+        device: Optional[torch.device] = None,
+        manifest: Optional[Path] = None,
+    ):
+        samples = get_samples(split, data_dir, manifest)
+        if not samples:
+            raise FileNotFoundError(
+                f"Found no {split} images in {manifest or data_dir}"
+            )
+        self.images, self.labels = decode_samples(samples, device)
+
+    @classmethod
+    def from_samples(
+        cls, samples: List[Tuple[str, int]], device: Optional[torch.device] = None
+    ) -> "InMemoryDataset":
+        """Dataset of any list of samples, e.g. of several splits."""
+        dataset = cls.__new__(cls)
+        dataset.images, dataset.labels = decode_samples(samples, device)
+        return dataset
+
+    @classmethod
+    def from_dataset(
+        cls, dataset: Dataset, device: Optional[torch.device] = None
+    ) -> "InMemoryDataset":
+        """
+        Dataset of the images of a dataset without a transform, whose items
+        are uint8 images and labels, e.g. a WDDZipDataset.
+        """
+        images, labels = zip(*(dataset[index] for index in range(len(dataset))))
+        result = cls.__new__(cls)
+        result.images = (
+            torch.from_numpy(np.stack([to_grayscale_array(image) for image in images]))
+            .unsqueeze(1)
+            .to(device)
+        )
+        result.labels = torch.tensor(labels, device=device)
+        return result
+
+    def subset(self, indices: Sequence[int]) -> "InMemoryDataset":
+        """Dataset of some of the images, e.g. of the folds of a cross-validation."""
+        dataset = copy.copy(self)
+        indices = torch.as_tensor(indices, device=self.labels.device)
+        dataset.images = self.images[indices]
+        dataset.labels = self.labels[indices]
+        return dataset
+
+    def __len__(self):
+        return len(self.labels)
+
+
+def decode_samples(
+    samples: List[Tuple[str, int]], device: Optional[torch.device] = None
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Decodes images into a uint8 tensor of shape (N, 1, H, W) and their labels."""
+    images = []
+    for path, _ in samples:
+        with Image.open(path) as image:
+            images.append(to_grayscale_array(image))
+    return (
+        torch.from_numpy(np.stack(images)).unsqueeze(1).to(device),
+        torch.tensor([label for _, label in samples], device=device),
+    )
+
+
+class InMemoryDataLoader:
+    """
+    Iterates over the batches of an InMemoryDataset like a DataLoader, without
+    workers, and with the transforms of get_transform applied to whole
+    batches: the flips of the training images are drawn from a seeded
+    generator and applied with tensor ops, then the images are normalized.
+    """
+
+    def __init__(
+        self,
+        dataset: InMemoryDataset,
+        batch_size: int,
+        shuffle: bool = False,
+        augment: bool = False,
+        seed: Optional[int] = None,
+    ):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.augment = augment
+        self.generator = torch.Generator(dataset.images.device)
+        if seed is None:
+            self.generator.seed()
+        else:
+            self.generator.manual_seed(seed)
+
+    def __len__(self):
+        return -(-len(self.dataset) // self.batch_size)
+
+    def __iter__(self) -> Iterator[Tuple[torch.Tensor, torch.Tensor]]:
+        images = self.dataset.images
+        labels = self.dataset.labels
+        if self.shuffle:
+            order = torch.randperm(
+                len(labels), generator=self.generator, device=labels.device
+            )
+            images, labels = images[order], labels[order]
+        for start in range(0, len(labels), self.batch_size):
+            batch = images[start : start + self.batch_size]
+            if self.augment:
+                batch = self._flip(batch)
+            # Like ToDtype(scale=True) and Normalize([0.5], [0.5])
+            yield (
+                (batch.float() / 255 - 0.5) / 0.5,
+                labels[start : start + self.batch_size],
+            )
+
+    def _flip(self, batch: torch.Tensor) -> torch.Tensor:
+        """Flips each image horizontally and vertically with a probability of 0.5."""
+        flips = (
+            torch.rand(
+                (2, len(batch), 1, 1, 1), generator=self.generator, device=batch.device
+            )
+            < 0.5
+        )
+        batch = torch.where(flips[0], batch.flip(-1), batch)
+        return torch.where(flips[1], batch.flip(-2), batch)
+
+
+def get_in_memory_dataloader(
+    split: str,
+    data_dir: Path = DEFAULT_DATA_DIR,
+    batch_size: int = batch_size,
+    device: Optional[torch.device] = None,
+    seed: Optional[int] = None,
+    manifest: Optional[Path] = None,
+) -> InMemoryDataLoader:
+    """
+    In-memory counterpart of get_dataloader: only training images are
+    shuffled and flipped.
+    """
+    dataset = InMemoryDataset(split, data_dir, device, manifest)
+    if split == "train":
+        return InMemoryDataLoader(
+            dataset, batch_size, shuffle=True, augment=True, seed=seed
+        )
+    if split == "validation":
+        return InMemoryDataLoader(dataset, batch_size)
+    return InMemoryDataLoader(dataset, 120)
+
+
+def _check_split(split: str):
+    if split not in SPLITS:
+        raise ValueError(f"Unknown split: {split}, expected one of {', '.join(SPLITS)}")
+
 
 if __name__ == "__main__":
-    for X, y in test_dataloader:
+    for X, y in get_dataloader("test"):
         print(f"Shape of X [N, C, H, W]: {X.shape}")
         print(f"Shape of y: {y.shape} {y.dtype}")
         break
@@ -0,0 +1,244 @@
+import argparse
+import time
+from pathlib import Path
+from typing import TYPE_CHECKING, List, Optional
+
+import numpy as np
+from PIL import Image
+
+from utils.prediction_cache import hash_file
+
+from .classification import (
+    SOURCE_HASH_FILE,
+    image_folder_paths,
+    model_variants,
+    to_grayscale_array,
+    variant_path,
+)
+from .hyperparameters import image_size
+from .numpy_inference import NumpyTaggedBeeClassifier, npz_path
+
+if TYPE_CHECKING:
+    from .inference import TaggedBeeClassifierConvNet
+
+
+def main():
+    """
+    Exports the TorchScript and int8-quantized variants of the model and the
+    weights of the numpy backend next to the fp32 weights, then reports for
+    every variant the agreement with the fp32 model on the test split and the
+    CPU latency per batch.
+    """
+    parser = init_argparse()
+    args: MyArgs = parser.parse_args(namespace=MyArgs())
+    # Imported after parsing the arguments, so that --help is fast.
+    import torch
+
+    from .inference import TaggedBeeClassifierConvNet
+
+    if args.torch_threads is not None:
+        torch.set_num_threads(args.torch_threads)
+    classifier = TaggedBeeClassifierConvNet(args.model_path, device="cpu")
+
+    if not args.check_only:
+        traced_model = export_torchscript(classifier)
+        save_variant(traced_model, args.model_path, "torchscript")
+        print(f"Saved {variant_path(args.model_path, 'torchscript')}")
+        quantized_model = export_int8(
+            classifier, load_images(args.calibration_dir, args.batch_size)
+        )
+        save_variant(quantized_model, args.model_path, "int8")
+        print(f"Saved {variant_path(args.model_path, 'int8')}")
+        export_npz(classifier, npz_path(args.model_path))
+        print(f"Saved {npz_path(args.model_path)}")
+
+    batches = load_images(args.test_dir, args.batch_size)
+    check_variants(args.model_path, batches, args.repetitions)
+
+
+def export_torchscript(classifier: "TaggedBeeClassifierConvNet"):
+    """
+    Traces the model that takes uint8 pixel values (see fold_normalization)
+    and freezes it, which inlines the weights. The model is optimized for
+    inference when it is loaded, because the optimized graph can't be saved.
+    """
+    import torch
+
+    example_inputs = torch.zeros(1, 1, image_size, image_size)
+    with torch.no_grad():
+        traced_model = torch.jit.trace(classifier.uint8_model, example_inputs)
+    return torch.jit.freeze(traced_model)
+
+
+def export_int8(
+    classifier: "TaggedBeeClassifierConvNet", calibration_batches: List[np.ndarray]
+):
+    """
+    Statically quantizes the convolutions and linear layers of the model that
+    takes uint8 pixel values to int8, calibrating the activation ranges on the
+    given batches. The inputs in [0, 255] are quantized with a scale of about 1,
+    so they are represented almost exactly.
+    """
+    import torch
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+
+    example_inputs = (torch.zeros(1, 1, image_size, image_size),)
+    prepared_model = prepare_fx(
+        classifier.uint8_model,
+        get_default_qconfig_mapping("x86"),
+        example_inputs,
+    )
+    with torch.inference_mode():
+        for batch in calibration_batches:
+            prepared_model(torch.from_numpy(batch).unsqueeze(1).float())
+    quantized_model = convert_fx(prepared_model)
+    with torch.no_grad():
+        traced_model = torch.jit.trace(quantized_model, example_inputs)
+    return torch.jit.freeze(traced_model)
+
+
+def save_variant(traced_model, model_path: Path, variant: str):
+    """
+    Saves an exported variant next to the fp32 weights, with the hash of the
+    weights, so that a variant that is older than the weights isn't loaded.
+    """
+    traced_model.save(
+        variant_path(model_path, variant),
+        _extra_files={SOURCE_HASH_FILE: hash_file(model_path)},
+    )
+
+
+def export_npz(classifier: "TaggedBeeClassifierConvNet", path: Path):
+    """
+    Saves the weights as arrays for the numpy backend, which can load them
+    without unpickling.
+    """
+    np.savez(
+        path,
+        **{
+            name: tensor.detach().cpu().numpy()
+            for name, tensor in classifier.model.state_dict().items()
+        },
+    )
+
+
+def check_variants(model_path: Path, batches: List[np.ndarray], repetitions: int):
+    """
+    Prints the agreement of the predictions of every variant and of the numpy
+    backend with the fp32 model and the median latency per batch.
+    """
+    from .inference import TaggedBeeClassifierConvNet
+
+    reference = None
+    print(f"test images: {sum(len(batch) for batch in batches)}")
+    classifiers = {
+        variant: lambda variant=variant: TaggedBeeClassifierConvNet(
+            model_path, variant, device="cpu"
+        )
+        for variant in model_variants
+        if variant_path(model_path, variant).exists()
+    }
+    if npz_path(model_path).exists():
+        classifiers["numpy"] = lambda: NumpyTaggedBeeClassifier(npz_path(model_path))
+    for variant in (*model_variants, "numpy"):
+        if variant not in classifiers:
+            print(f"{variant}: not exported")
+            continue
+        classifier = classifiers[variant]()
+        results = [classifier.classify_batch(batch) for batch in batches]
+        predictions = np.concatenate([result[0] for result in results])
+        tagged_probabilities = np.concatenate([result[2] for result in results])
+        latencies = []
+        for _ in range(repetitions):
+            for batch in batches:
+                start = time.perf_counter()
+                classifier.classify_batch(batch)
+                latencies.append(time.perf_counter() - start)
+        latency = f"{1000 * np.median(latencies):.3f} ms per batch"
+        if reference is None:
+            reference = predictions, tagged_probabilities
+            print(f"{variant}: {latency}")
+            continue
+        agreement = np.mean(predictions == reference[0])
+        difference = np.abs(tagged_probabilities - reference[1]).max()
+        print(
+            f"{variant}: {latency}, {100 * agreement:.2f}% identical predictions, "
+            f"max. tagged probability difference {difference:.3g}"
+        )
+
+
+def load_images(image_dir: Path, batch_size: int) -> List[np.ndarray]:
+    """Loads the images of an image folder as uint8 batches."""
+    images = []
+    for path in image_folder_paths(image_dir):
+        with Image.open(path) as image:
+            images.append(to_grayscale_array(image))
+    return [
+        np.stack(images[start : start + batch_size])
+        for start in range(0, len(images), batch_size)
+    ]
+
+
+class MyArgs(argparse.Namespace):
+    model_path: Path
+    test_dir: Path
+    calibration_dir: Path
+    batch_size: int
+    repetitions: int
+    torch_threads: Optional[int]
+    check_only: bool
+
+
+def init_argparse() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        description=(
+            "Exports TorchScript and int8-quantized variants of the model and the weights of the numpy backend, and checks their agreement with the fp32 model and their CPU latency"
+        ),
+    )
+    parser.add_argument(
+        "--model_path",
+        type=Path,
+        default=Path("output/model.pth"),
+        help="path to the fp32 model weights, the variants and the weights of the numpy backend are saved next to them (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--test_dir",
+        type=Path,
+        default=Path.cwd() / "data" / "cropped" / "50x50" / "test",
+        help="path to the test split, an image folder with one directory per class (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--calibration_dir",
+        type=Path,
+        default=Path.cwd() / "data" / "cropped" / "50x50" / "validation",
+        help="path to the images the activation ranges of the int8 variant are calibrated on (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=64,
+        help="number of images per batch (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--repetitions",
+        type=int,
+        default=5,
+        help="number of passes over the test split to measure the latency (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--torch_threads",
+        type=int,
+        default=None,
+        help="number of torch intra-op threads (default: chosen by torch)",
+    )
+    parser.add_argument(
+        "--check_only",
+        action="store_true",
+        help="only check the variants that were exported before",
+    )
+    return parser
+
+
+if __name__ == "__main__":
+    main()
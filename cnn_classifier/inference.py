@@ -1,73 +1,101 @@
-from enum import Enum
-from pathlib import Path
+import copy
+from typing import Optional, Union
 
 import numpy as np
 import torch
-import torchvision.datasets as datasets
-import torchvision.transforms.v2 as transforms
-from tqdm import tqdm
-
-from .model import TaggedBeeClassificationModel
-
-
-class TagStatus(Enum):
-    tagged = 0
-    untagged = 1
 
+from utils.prediction_cache import hash_file
 
-class_labels = (TagStatus.tagged.name, TagStatus.untagged.name)
+from .classification import (
+    SOURCE_HASH_FILE,
+    ImageClassifier,
+    model_variants,
+    normalize_mean,
+    normalize_std,
+    variant_path,
+)
+from .model import TaggedBeeClassificationModel
 
 
-class TaggedBeeClassifierConvNet:
-    def __init__(self, model_path):
-        self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+class TaggedBeeClassifierConvNet(ImageClassifier):
+    def __init__(
+        self,
+        model_path,
+        variant: str = "fp32",
+        device: Optional[str] = None,
+    ):
+        if variant not in model_variants:
+            raise ValueError(
+                f"Unknown model variant: {variant}, expected one of "
+                f"{', '.join(model_variants)}"
+            )
+        if device is None:
+            # Quantized kernels only run on the CPU.
+            use_cuda = torch.cuda.is_available() and variant != "int8"
+            device = "cuda" if use_cuda else "cpu"
+        self.device = torch.device(device)
+        self.variant = variant
+        # File that determines the predictions, e.g. for the prediction cache
+        self.weights_path = variant_path(model_path, variant)
         self.model = TaggedBeeClassificationModel().to(self.device)
         self.model.load_state_dict(
             torch.load(model_path, map_location=self.device, weights_only=True)
         )
         self.model.eval()
+        if variant == "fp32":
+            # Takes uint8 pixel values as floats, see fold_normalization
+            self.uint8_model = fold_normalization(self.model)
+        else:
+            # The exported variants are based on the folded model, too.
+            extra_files = {SOURCE_HASH_FILE: ""}
+            self.uint8_model = torch.jit.load(
+                self.weights_path, map_location=self.device, _extra_files=extra_files
+            )
+            # Variants saved before the hash was recorded have an empty one.
+            if extra_files[SOURCE_HASH_FILE].decode() != hash_file(model_path):
+                raise ValueError(
+                    f"{self.weights_path} was not exported from {model_path}, "
+                    "export it again with cnn_classifier/export.py"
+                )
+            if variant == "torchscript":
+                self.uint8_model = torch.jit.optimize_for_inference(self.uint8_model)
 
-    def classify_single_image(self, image):
-        """Classifies an image."""
-        transform = transforms.Compose(
-            [
-                transforms.Grayscale(1),
-                transforms.ToImage(),
-                transforms.ToDtype(torch.float32, scale=True),
-                transforms.Normalize([0.5], [0.5]),
-            ]
-        )
-        image_tensor = transform(image).unsqueeze(0)
-        image_tensor = image_tensor.to(self.device, non_blocking=True)
+    def classify_batch(self, images: Union[np.ndarray, torch.Tensor]):
+        """
+        Classifies a stacked uint8 batch of grayscale images of shape (N, H, W)
+        or (N, 1, H, W) in a single forward pass. Returns the predictions,
+        confidences and tagged probabilities as arrays.
+        """
+        image_tensor = torch.as_tensor(images)
+        if image_tensor.dtype != torch.uint8:
+            raise ValueError(f"Expected a uint8 batch, got {image_tensor.dtype}")
+        if image_tensor.ndim == 3:
+            image_tensor = image_tensor.unsqueeze(1)
+        # Converting on the device transfers a quarter of the bytes.
+        image_tensor = image_tensor.to(self.device, non_blocking=True).float()
         with torch.inference_mode():
-            output = self.model(image_tensor)
-            prediction, confidence, _ = self.model.postprocess_predictions(output)
-            return prediction[0], confidence[0]
+            outputs = self.uint8_model(image_tensor)
+            return self.model.postprocess_predictions(outputs)
 
-    def classify_images_from_directory(self, image_dir: Path | str, batch_size):
-        """Classifies images in given directory."""
-        transform = transforms.Compose(
-            [
-                transforms.Grayscale(1),
-                transforms.ToImage(),
-                transforms.ToDtype(torch.float32, scale=True),
-                transforms.Normalize([0.5], [0.5]),
-            ]
-        )
-        dataset = datasets.ImageFolder(image_dir, transform)
-        dataloader = torch.utils.data.DataLoader(dataset, batch_size, pin_memory=True)
-        paths = np.array([path for path, _ in dataset.imgs])
-        with torch.inference_mode():
-            all_predictions = np.array([], dtype=int)
-            all_confidences = np.array([])
-            for inputs, _ in tqdm(dataloader):
-                inputs = inputs.to(self.device, non_blocking=True)
-                outputs = self.model(inputs)
-                predictions, confidences, _ = self.model.postprocess_predictions(
-                    outputs
-                )
-                all_predictions = np.concatenate(
-                    (all_predictions, predictions), dtype=int
-                )
-                all_confidences = np.concatenate((all_confidences, confidences))
-            return all_predictions, all_confidences, paths
+
+def fold_normalization(
+    model: TaggedBeeClassificationModel,
+    mean: float = normalize_mean,
+    std: float = normalize_std,
+) -> TaggedBeeClassificationModel:
+    """
+    Returns a copy of the model that takes uint8 pixel values in [0, 255] as
+    floats instead of normalized images. The input x is normalized as
+    (x / 255 - mean) / std, which is affine, so it can be folded into the
+    weights and bias of the first convolution, which has no padding:
+
+        W' = W / (255 * std)
+        b' = b - mean / std * sum(W)
+    """
+    folded_model = copy.deepcopy(model)
+    conv1 = folded_model.conv1
+    with torch.no_grad():
+        weight_sum = conv1.weight.sum(dim=(1, 2, 3))
+        conv1.weight.div_(255 * std)
+        conv1.bias.sub_(mean / std * weight_sum)
+    return folded_model
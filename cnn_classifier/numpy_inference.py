@@ -0,0 +1,184 @@
+import pickle
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict
+from zipfile import ZipFile
+
+import numpy as np
+from numpy.lib.stride_tricks import as_strided, sliding_window_view
+
+from .classification import ImageClassifier, normalize_mean, normalize_std
+
+# Element types of the storages of tensors saved with torch.save
+_STORAGE_DTYPES = {
+    "FloatStorage": np.float32,
+    "DoubleStorage": np.float64,
+    "HalfStorage": np.float16,
+    "LongStorage": np.int64,
+    "IntStorage": np.int32,
+    "ShortStorage": np.int16,
+    "CharStorage": np.int8,
+    "ByteStorage": np.uint8,
+    "BoolStorage": np.bool_,
+}
+
+# Stride of the convolutions of TaggedBeeClassificationModel, see model.py
+_CONV_STRIDES = {"conv1": 3, "conv2": 1}
+
+
+class NumpyTaggedBeeClassifier(ImageClassifier):
+    """
+    TaggedBeeClassificationModel implemented with NumPy, so classifying doesn't
+    import torch. The convolutions are computed as matrix products of the
+    image patches (im2col) and the weights.
+    """
+
+    def __init__(self, model_path):
+        # File that determines the predictions, e.g. for the prediction cache
+        self.weights_path = Path(model_path)
+        state_dict = load_state_dict(self.weights_path)
+        # Like in the torch backend, the normalization is folded into conv1.
+        weight = state_dict["conv1.weight"]
+        state_dict["conv1.bias"] = state_dict["conv1.bias"] - (
+            normalize_mean / normalize_std * weight.sum(axis=(1, 2, 3))
+        )
+        state_dict["conv1.weight"] = weight / (255 * normalize_std)
+        self.convolutions = [
+            (
+                # (out channels, in channels * kernel height * kernel width)
+                state_dict[f"{name}.weight"].reshape(
+                    len(state_dict[f"{name}.weight"]), -1
+                ),
+                state_dict[f"{name}.bias"],
+                state_dict[f"{name}.weight"].shape[2:],
+                stride,
+            )
+            for name, stride in _CONV_STRIDES.items()
+        ]
+        self.linears = [
+            (state_dict[f"{name}.weight"].T.copy(), state_dict[f"{name}.bias"])
+            for name in ("fc1", "fc2")
+        ]
+
+    def forward(self, images: np.ndarray) -> np.ndarray:
+        """
+        Computes the logits of a uint8 batch of grayscale images of shape
+        (N, H, W) or (N, 1, H, W). Activations are kept in NHWC layout, so
+        the patches of a convolution are views of its input.
+        """
+        if images.ndim == 4:
+            images = images[:, 0]
+        x = images[..., np.newaxis].astype(np.float32)
+        for weight, bias, kernel_size, stride in self.convolutions:
+            x = _max_pool(np.maximum(_conv2d(x, weight, bias, kernel_size, stride), 0))
+        # Flatten in the NCHW order of torch.flatten
+        x = x.transpose(0, 3, 1, 2).reshape(len(x), -1)
+        (fc1_weight, fc1_bias), (fc2_weight, fc2_bias) = self.linears
+        x = np.maximum(x @ fc1_weight + fc1_bias, 0)
+        return x @ fc2_weight + fc2_bias
+
+    def classify_batch(self, images: np.ndarray):
+        """
+        Classifies a stacked uint8 batch of grayscale images of shape (N, H, W)
+        or (N, 1, H, W) in a single forward pass. Returns the predictions,
+        confidences and tagged probabilities as arrays.
+        """
+        images = np.asarray(images)
+        if images.dtype != np.uint8:
+            raise ValueError(f"Expected a uint8 batch, got {images.dtype}")
+        return postprocess_predictions(self.forward(images))
+
+
+def npz_path(model_path) -> Path:
+    """Path of the weights exported for the numpy backend, see export.py."""
+    return Path(model_path).with_suffix(".npz")
+
+
+def postprocess_predictions(outputs: np.ndarray):
+    """NumPy version of TaggedBeeClassificationModel.postprocess_predictions."""
+    exponentials = np.exp(outputs - outputs.max(axis=1, keepdims=True))
+    probabilities = exponentials / exponentials.sum(axis=1, keepdims=True)
+    predictions = np.argmax(outputs, 1)
+    confidences = probabilities[np.arange(probabilities.shape[0]), predictions]
+    tagged_probabilities = probabilities[np.arange(probabilities.shape[0]), 0]
+    return predictions, confidences, tagged_probabilities
+
+
+def load_state_dict(path: Path) -> Dict[str, np.ndarray]:
+    """
+    Loads the weights of a model as float32 arrays, either from an .npz file
+    (see export.py) or from a state dict saved with torch.save, which is read
+    without torch.
+    """
+    if path.suffix == ".npz":
+        with np.load(path) as weights:
+            return {name: weights[name].astype(np.float32) for name in weights.files}
+    with ZipFile(path) as zip_file:
+        pickle_name = next(
+            name for name in zip_file.namelist() if name.endswith("/data.pkl")
+        )
+        prefix = pickle_name.removesuffix("data.pkl")
+        byteorder = zip_file.read(f"{prefix}byteorder").decode()
+        if byteorder != "little":
+            raise ValueError(f"{path} was saved with {byteorder}-endian byte order")
+        with zip_file.open(pickle_name) as file:
+            state_dict = _StateDictUnpickler(file, zip_file, prefix).load()
+    return {name: tensor.astype(np.float32) for name, tensor in state_dict.items()}
+
+
+class _StateDictUnpickler(pickle.Unpickler):
+    """
+    Unpickles a state dict saved with torch.save, rebuilding the tensors as
+    arrays. Only the globals of tensors and state dicts are allowed, like
+    torch.load with weights_only=True.
+    """
+
+    def __init__(self, file, zip_file: ZipFile, prefix: str):
+        super().__init__(file)
+        self.zip_file = zip_file
+        self.prefix = prefix
+
+    def find_class(self, module, name):
+        if module == "collections" and name == "OrderedDict":
+            return OrderedDict
+        if module == "torch._utils" and name == "_rebuild_tensor_v2":
+            return _rebuild_tensor
+        if module == "torch._utils" and name == "_rebuild_parameter":
+            return _rebuild_parameter
+        if module == "torch" and name in _STORAGE_DTYPES:
+            return _STORAGE_DTYPES[name]
+        raise pickle.UnpicklingError(f"Unsupported global: {module}.{name}")
+
+    def persistent_load(self, pid):
+        # ("storage", storage type, key, location, number of elements)
+        _, dtype, key, _, numel = pid
+        data = self.zip_file.read(f"{self.prefix}data/{key}")
+        return np.frombuffer(data, dtype=dtype, count=numel)
+
+
+def _rebuild_tensor(storage, storage_offset, size, stride, *_):
+    return as_strided(
+        storage[storage_offset:],
+        shape=size,
+        strides=[element_stride * storage.itemsize for element_stride in stride],
+    ).copy()
+
+
+def _rebuild_parameter(data, *_):
+    return data
+
+
+def _conv2d(x: np.ndarray, weight: np.ndarray, bias: np.ndarray, kernel_size, stride):
+    """Convolution without padding of an NHWC batch as one matrix product."""
+    # (N, H', W', C, kernel height, kernel width)
+    patches = sliding_window_view(x, kernel_size, axis=(1, 2))[:, ::stride, ::stride]
+    n, height, width = patches.shape[:3]
+    columns = patches.reshape(n * height * width, -1)
+    return (columns @ weight.T + bias).reshape(n, height, width, -1)
+
+
+def _max_pool(x: np.ndarray) -> np.ndarray:
+    """2x2 max pooling with stride 2 of an NHWC batch, dropping odd edges."""
+    n, height, width, channels = x.shape
+    x = x[:, : height // 2 * 2, : width // 2 * 2]
+    return x.reshape(n, height // 2, 2, width // 2, 2, channels).max(axis=(2, 4))
@@ -0,0 +1,226 @@
+import argparse
+import io
+import json
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+
+from utils.micro_batcher import MicroBatcher
+
+from .classification import (
+    ImageClassifier,
+    backends,
+    load_classifier,
+    model_variants,
+)
+from .hyperparameters import image_size
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+
+
+def main():
+    """
+    Serves the classifier on localhost, keeping the model loaded. Concurrent
+    requests are merged into batches, see MicroBatcher. Use InferenceClient
+    in client.py to classify with it.
+    """
+    parser = init_argparse()
+    args: MyArgs = parser.parse_args(namespace=MyArgs())
+    if args.backend == "numpy" and args.model_variant != "fp32":
+        parser.error("--backend numpy only supports --model_variant fp32")
+    if args.backend == "torch" and args.torch_threads is not None:
+        import torch
+
+        torch.set_num_threads(args.torch_threads)
+    classifier = load_classifier(args.model_path, args.backend, args.model_variant)
+    batcher = MicroBatcher(
+        classifier.classify_batch, args.max_batch_size, args.max_wait_ms / 1000
+    )
+    server = InferenceServer((args.host, args.port), classifier, batcher)
+    print(f"Serving {classifier.weights_path} on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        batcher.close()
+
+
+class InferenceServer(ThreadingHTTPServer):
+    """
+    HTTP server with the endpoints
+
+        POST /classify  body: uint8 images of shape (H, W) or (N, H, W) in the
+                        .npy format, returns the predictions, confidences and
+                        tagged probabilities as JSON lists
+        GET /health     the model and the uptime
+        GET /stats      the number of requests and batches, the batch sizes
+                        and the latencies, see MicroBatcher.stats
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address, classifier: ImageClassifier, batcher: MicroBatcher):
+        super().__init__(address, InferenceRequestHandler)
+        self.classifier = classifier
+        self.batcher = batcher
+        self.start = time.time()
+
+    def health(self) -> dict:
+        return {
+            "status": "ok",
+            "weights_path": str(self.classifier.weights_path),
+            "classifier": type(self.classifier).__name__,
+            "max_batch_size": self.batcher.max_batch_size,
+            "max_wait_ms": 1000 * self.batcher.max_wait,
+            "uptime_seconds": round(time.time() - self.start, 3),
+        }
+
+
+class InferenceRequestHandler(BaseHTTPRequestHandler):
+    # Keeps connections open, so that clients don't connect for every request
+    protocol_version = "HTTP/1.1"
+    # Headers and body are written separately, without TCP_NODELAY the body
+    # would wait for the delayed ACK of the client.
+    disable_nagle_algorithm = True
+    server: InferenceServer
+
+    def do_GET(self):
+        if self.path == "/health":
+            self._send_json(200, self.server.health())
+        elif self.path == "/stats":
+            self._send_json(200, self.server.batcher.stats())
+        else:
+            self._send_json(404, {"error": f"Unknown path: {self.path}"})
+
+    def do_POST(self):
+        if self.path != "/classify":
+            self._send_json(404, {"error": f"Unknown path: {self.path}"})
+            return
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        try:
+            images = parse_images(body)
+        except ValueError as e:
+            self._send_json(400, {"error": str(e)})
+            return
+        try:
+            predictions, confidences, tagged_probabilities = (
+                self.server.batcher.classify(images)
+            )
+        except Exception as e:
+            self._send_json(500, {"error": repr(e)})
+            return
+        self._send_json(
+            200,
+            {
+                "predictions": predictions.tolist(),
+                "confidences": confidences.tolist(),
+                "tagged_probabilities": tagged_probabilities.tolist(),
+            },
+        )
+
+    def log_message(self, format, *args):
+        # Requests are counted in /stats instead of logged one by one.
+        pass
+
+    def _send_json(self, status: int, data: dict):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def parse_images(body: bytes) -> np.ndarray:
+    """Reads the images of a request as a uint8 batch of shape (N, H, W)."""
+    try:
+        images = np.load(io.BytesIO(body), allow_pickle=False)
+    except Exception as e:
+        raise ValueError(f"Expected images in the .npy format: {e}") from e
+    if images.dtype != np.uint8:
+        raise ValueError(f"Expected uint8 images, got {images.dtype}")
+    if images.ndim == 2:
+        images = images[np.newaxis]
+    if images.ndim != 3 or images.shape[1:] != (image_size, image_size):
+        raise ValueError(
+            f"Expected images of shape ({image_size}, {image_size}), got {images.shape}"
+        )
+    return images
+
+
+class MyArgs(argparse.Namespace):
+    host: str
+    port: int
+    model_path: Path
+    backend: str
+    model_variant: str
+    max_batch_size: int
+    max_wait_ms: float
+    torch_threads: Optional[int]
+
+
+def init_argparse() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        description=(
+            "Serves the tag classifier over HTTP on localhost and merges concurrent requests into batches"
+        ),
+    )
+    parser.add_argument(
+        "--host",
+        type=str,
+        default=DEFAULT_HOST,
+        help="address to listen on (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--port",
+        type=int,
+        default=DEFAULT_PORT,
+        help="port to listen on (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--model_path",
+        type=Path,
+        default=Path("output/model.pth"),
+        help="path to the model weights (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--backend",
+        choices=backends,
+        default="torch",
+        help="backend to classify with (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--model_variant",
+        choices=model_variants,
+        default="fp32",
+        help="variant of the model to classify with, see cnn_classifier/export.py (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--max_batch_size",
+        type=int,
+        default=64,
+        help="maximum number of images that are classified together (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--max_wait_ms",
+        type=float,
+        default=2.0,
+        help="maximum time in milliseconds that a request waits for other requests to share its batch (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--torch_threads",
+        type=int,
+        default=None,
+        help="number of torch intra-op threads (default: chosen by torch)",
+    )
+    return parser
+
+
+if __name__ == "__main__":
+    main()
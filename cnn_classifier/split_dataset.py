@@ -1,67 +1,245 @@
+import argparse
+import csv
+import math
 import random
 from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Tuple
 
+from .classification import IMG_EXTENSIONS, class_labels
 
-def main():
-    """Splits dataset into train, validation and test sets."""
-    image_dir = Path.joinpath(Path.cwd(), "data", "cropped", "50x50")
-    tagged_image_dir = image_dir / "tagged"
-    untagged_image_dir = image_dir / "untagged"
-
-    tagged_images = list(tagged_image_dir.iterdir())
-    untagged_images = list(untagged_image_dir.iterdir())
-
-    assert len(tagged_images) == 397 == len(untagged_images)
-    num_train_images_per_class = 277
-    num_test_images_per_class = 60
-
-    # move train images
-    train_tagged = random.sample(tagged_images, k=num_train_images_per_class)
-    train_untagged = random.sample(untagged_images, k=num_train_images_per_class)
-
-    train_tagged_image_dir = Path.joinpath(image_dir, "train", "tagged")
-    train_tagged_image_dir.mkdir(parents=True, exist_ok=True)
-
-    train_untagged_image_dir = Path.joinpath(image_dir, "train", "untagged")
-    train_untagged_image_dir.mkdir(parents=True, exist_ok=True)
-
-    for file in train_tagged:
-        move_file(file, train_tagged_image_dir / file.name)
-
-    for file in train_untagged:
-        move_file(file, train_untagged_image_dir / file.name)
-
-    # move test images
-    tagged_images = list(tagged_image_dir.iterdir())
-    untagged_images = list(untagged_image_dir.iterdir())
+# Splits of the cropped images
+SPLITS = ("train", "validation", "test")
+# Directory of the cropped images, with one directory per split
+DEFAULT_DATA_DIR = Path("data") / "cropped" / "50x50"
+# Name of the split manifest in the directory of the cropped images
+MANIFEST_NAME = "manifest.csv"
+MANIFEST_COLUMNS = ["path", "label", "split"]
 
-    test_tagged = random.sample(tagged_images, k=num_test_images_per_class)
-    test_untagged = random.sample(untagged_images, k=num_test_images_per_class)
 
-    test_tagged_image_dir = Path.joinpath(image_dir, "test", "tagged")
-    test_tagged_image_dir.mkdir(parents=True, exist_ok=True)
-
-    test_untagged_image_dir = Path.joinpath(image_dir, "test", "untagged")
-    test_untagged_image_dir.mkdir(parents=True, exist_ok=True)
-
-    for file in test_tagged:
-        move_file(file, test_tagged_image_dir / file.name)
-
-    for file in test_untagged:
-        move_file(file, test_untagged_image_dir / file.name)
-
-    # move validation images
-    (image_dir / "validation").mkdir(parents=True, exist_ok=True)
-
-    tagged_image_dir.rename(Path.joinpath(image_dir, "validation", "tagged"))
-    untagged_image_dir.rename(Path.joinpath(image_dir, "validation", "untagged"))
-
-
-def move_file(source, destination):
-    if destination.exists():
-        print(f"{destination} already exists")
-    else:
-        source.replace(destination)
+def main():
+    """
+    Splits the cropped images into train, validation and test sets by writing
+    a manifest, a CSV file with the path, label and split of every image.
+    The split is stratified by label and seeded, and the images stay where
+    they are, so a dataset can be re-split without moving files. Images are
+    labeled by the name of their directory, tagged or untagged, which may be
+    inside a split directory.
+    """
+    parser = init_argparse()
+    args: MyArgs = parser.parse_args(namespace=MyArgs())
+    if args.manifest is None:
+        args.manifest = args.image_dir / MANIFEST_NAME
+    if args.validation_fraction + args.test_fraction >= 1:
+        parser.error(
+            "--validation_fraction and --test_fraction must sum to less than 1"
+        )
+    rows = create_manifest(
+        args.image_dir,
+        args.manifest.parent,
+        args.validation_fraction,
+        args.test_fraction,
+        args.seed,
+        args.existing_split,
+    )
+    if not rows:
+        parser.error(
+            f"found no images in tagged or untagged directories of {args.image_dir}"
+        )
+    write_manifest(rows, args.manifest)
+    for split in SPLITS:
+        counts = [
+            sum(row["split"] == split and row["label"] == label for row in rows)
+            for label in class_labels
+        ]
+        print(
+            f"{split}: "
+            + ", ".join(
+                f"{count} {label}" for label, count in zip(class_labels, counts)
+            )
+        )
+    print(f"Wrote {len(rows)} images to {args.manifest}")
+
+
+def labeled_images(image_dir: Path) -> List[Tuple[Path, str, Optional[str]]]:
+    """
+    Paths, labels and, if they are in a split directory, splits of the images
+    below a directory. The label of an image is the name of its directory.
+    """
+    images = []
+    for path in sorted(image_dir.rglob("*")):
+        if (
+            path.suffix.lower() not in IMG_EXTENSIONS
+            or path.parent.name not in class_labels
+        ):
+            continue
+        split = path.parent.parent.name
+        images.append((path, path.parent.name, split if split in SPLITS else None))
+    return images
+
+
+def stratified_assignment(
+    labels: Sequence, fractions: Sequence[float], seed: Optional[int] = None
+) -> List[int]:
+    """
+    Assigns every item to one of len(fractions) groups, e.g. splits or folds,
+    so that each group has the given fraction of the items of every label,
+    rounded down or up. The items of a label are shuffled with the seed.
+
+    The items that are left over after rounding down go to the groups that
+    are furthest below their fraction of the items of all labels so far, so
+    that the rounding continues where the previous label stopped instead of
+    favoring the same groups for every label. With equal fractions, e.g.
+    folds, this deals the items round-robin, and no group is empty unless
+    there are fewer items than groups.
+    """
+    rng = random.Random(seed)
+    groups = [0] * len(labels)
+    # Items of every group and in total, over the labels so far
+    counts = [0] * len(fractions)
+    total = 0
+    for label in sorted(set(labels)):
+        indices = [index for index, other in enumerate(labels) if other == label]
+        rng.shuffle(indices)
+        total += len(indices)
+        sizes = [math.floor(fraction * len(indices)) for fraction in fractions]
+        deficits = [
+            fraction * total - count - size
+            for fraction, count, size in zip(fractions, counts, sizes)
+        ]
+        # Stable, so that ties go to the first groups
+        by_deficit = sorted(range(len(fractions)), key=lambda group: -deficits[group])
+        for group in by_deficit[: len(indices) - sum(sizes)]:
+            sizes[group] += 1
+        start = 0
+        for group, size in enumerate(sizes):
+            for index in indices[start : start + size]:
+                groups[index] = group
+            counts[group] += size
+            start += size
+    return groups
+
+
+def create_manifest(
+    image_dir: Path,
+    manifest_dir: Path,
+    validation_fraction: float = 0.15,
+    test_fraction: float = 0.15,
+    seed: Optional[int] = 0,
+    existing_split: bool = False,
+) -> List[Dict[str, str]]:
+    """
+    Rows of a manifest of the labeled images below image_dir, with paths
+    relative to the directory of the manifest. With existing_split, images in
+    split directories keep their split and only the others are split.
+    """
+    images = labeled_images(image_dir)
+    splits = [split if existing_split else None for _, _, split in images]
+    unsplit = [index for index, split in enumerate(splits) if split is None]
+    # The test split is drawn first, so that it only changes with its fraction
+    # and the seed.
+    split_order = ("test", "validation", "train")
+    fractions = (
+        test_fraction,
+        validation_fraction,
+        1 - test_fraction - validation_fraction,
+    )
+    groups = stratified_assignment(
+        [images[index][1] for index in unsplit], fractions, seed
+    )
+    for index, group in zip(unsplit, groups):
+        splits[index] = split_order[group]
+    manifest_dir = manifest_dir.resolve()
+    rows = [
+        {
+            "path": path.resolve().relative_to(manifest_dir, walk_up=True).as_posix(),
+            "label": label,
+            "split": split,
+        }
+        for (path, label, _), split in zip(images, splits)
+    ]
+    # Sorted like the samples of ImageFolder
+    return sorted(rows, key=lambda row: (row["label"], row["path"]))
+
+
+def write_manifest(rows: List[Dict[str, str]], path: Path):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "w", newline="") as f:
+        writer = csv.DictWriter(f, MANIFEST_COLUMNS)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def read_manifest(
+    path: Path, splits: Optional[Sequence[str]] = None
+) -> List[Tuple[str, int]]:
+    """
+    Paths and class indices of the images of a manifest, optionally only of
+    some splits, like the samples of ImageFolder.
+    """
+    samples = []
+    with open(path, newline="") as f:
+        for row in csv.DictReader(f):
+            if splits is not None and row["split"] not in splits:
+                continue
+            if row["label"] not in class_labels:
+                raise ValueError(f"Unknown label in {path}: {row['label']}")
+            samples.append(
+                (str(path.parent / row["path"]), class_labels.index(row["label"]))
+            )
+    return samples
+
+
+class MyArgs(argparse.Namespace):
+    image_dir: Path
+    manifest: Optional[Path]
+    validation_fraction: float
+    test_fraction: float
+    seed: int
+    existing_split: bool
+
+
+def init_argparse() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        description=(
+            "Writes a seeded, stratified train, validation and test split of the cropped images to a manifest, without moving the images"
+        ),
+    )
+    parser.add_argument(
+        "--image_dir",
+        type=Path,
+        default=DEFAULT_DATA_DIR,
+        help="directory with the images in tagged and untagged directories, possibly inside split directories (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--manifest",
+        type=Path,
+        default=None,
+        help=f"path of the manifest (default: {MANIFEST_NAME} in --image_dir)",
+    )
+    parser.add_argument(
+        "--validation_fraction",
+        type=float,
+        default=0.15,
+        help="fraction of the images of each label in the validation split (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--test_fraction",
+        type=float,
+        default=0.15,
+        help="fraction of the images of each label in the test split (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=0,
+        help="seed of the split (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--existing_split",
+        action="store_true",
+        help="keep the split of images that are in train, validation or test directories and only split the others",
+    )
+    return parser
 
 
 if __name__ == "__main__":
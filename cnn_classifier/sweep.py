@@ -0,0 +1,424 @@
+import argparse
+import csv
+import itertools
+import json
+import math
+import multiprocessing
+import os
+import random
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple, Union
+
+from .hyperparameters import batch_size, epochs, learning_rate
+from .split_dataset import DEFAULT_DATA_DIR
+
+# Hyperparameters that can be swept, with their type and default value. The
+# image size is fixed by the crops and the architecture of the model.
+PARAMETERS = {
+    "learning_rate": (float, learning_rate),
+    "batch_size": (int, batch_size),
+    "epochs": (int, epochs),
+    "seed": (int, 0),
+}
+
+LEADERBOARD_COLUMNS = [
+    "rank",
+    "run",
+    *PARAMETERS,
+    "best_validation_accuracy",
+    "best_epoch",
+    "final_validation_accuracy",
+    "final_validation_loss",
+    "seconds",
+]
+
+# Values of a parameter, either a list or a (low, high) range for --search random
+SearchSpace = Dict[str, Union[List, Tuple[float, float]]]
+
+# Datasets of a worker process, decoded once in init_worker
+_worker = {}
+
+
+def main():
+    """
+    Trains the model with every configuration of a hyperparameter search
+    space in parallel worker processes, each with few torch threads, since a
+    single training of the small model can't use many cores. Every run writes
+    its configuration, metrics, curves and weights into its own directory,
+    the leaderboard of all runs is written to leaderboard.csv.
+    """
+    parser = init_argparse()
+    args: MyArgs = parser.parse_args(namespace=MyArgs())
+    try:
+        space = dict(parse_parameter(spec) for spec in args.param)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.search == "grid":
+        ranges = [name for name, values in space.items() if isinstance(values, tuple)]
+        if ranges:
+            parser.error(
+                f"--search grid needs lists of values, got ranges for {', '.join(ranges)}"
+            )
+        configurations = grid_configurations(space)
+    else:
+        configurations = random_configurations(space, args.num_samples, args.seed)
+    workers = min(args.workers, len(configurations))
+    if args.torch_threads is None:
+        args.torch_threads = max(1, (os.cpu_count() or 1) // workers)
+    if args.output_dir is None:
+        args.output_dir = Path("output/sweeps") / datetime.now().strftime(
+            "%Y%m%d_%H%M%S"
+        )
+    args.output_dir.mkdir(parents=True, exist_ok=True)
+    with open(args.output_dir / "sweep.json", "w") as f:
+        json.dump(
+            {
+                "search": args.search,
+                "space": space,
+                "data_dir": str(args.data_dir),
+                "manifest": None if args.manifest is None else str(args.manifest),
+                "workers": workers,
+                "torch_threads": args.torch_threads,
+                "configurations": configurations,
+            },
+            f,
+            indent=2,
+        )
+
+    print(
+        f"Training {len(configurations)} configurations with {workers} workers "
+        f"and {args.torch_threads} torch threads each"
+    )
+    start = time.perf_counter()
+    results = []
+    failed = 0
+    with ProcessPoolExecutor(
+        workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=init_worker,
+        initargs=(args.data_dir, args.manifest, args.torch_threads),
+    ) as executor:
+        futures = {
+            executor.submit(
+                run_in_worker, args.output_dir / f"run_{index:03d}", configuration
+            ): configuration
+            for index, configuration in enumerate(configurations)
+        }
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except Exception as e:
+                failed += 1
+                print(f"Error: {futures[future]}: {e!r}", file=sys.stderr)
+                continue
+            results.append(result)
+            print(
+                f"[{len(results) + failed}/{len(futures)}] {result['run']}: "
+                f"{format_configuration(result['config'])}, best validation "
+                f"accuracy {result['best_validation_accuracy']:.1f}% "
+                f"({result['seconds']:.1f} s)"
+            )
+
+    leaderboard = write_leaderboard(results, args.output_dir / "leaderboard.csv")
+    print(
+        f"\n{len(results)} runs in {time.perf_counter() - start:.1f} s, "
+        f"leaderboard: {args.output_dir / 'leaderboard.csv'}"
+    )
+    print_leaderboard(leaderboard, args.top)
+    if failed:
+        print(f"Error: {failed} runs failed", file=sys.stderr)
+        sys.exit(1)
+
+
+def parse_parameter(spec: str) -> Tuple[str, Union[List, Tuple[float, float]]]:
+    """
+    Parses NAME=V1,V2,... into a list of values and NAME=LOW:HIGH into a
+    range for random search.
+    """
+    name, _, values = spec.partition("=")
+    if name not in PARAMETERS or not values:
+        raise ValueError(
+            f"invalid --param value: {spec!r}, expected NAME=V1,V2,... or "
+            f"NAME=LOW:HIGH with NAME in {', '.join(PARAMETERS)}"
+        )
+    parameter_type = PARAMETERS[name][0]
+    try:
+        if ":" in values:
+            low, high = (parameter_type(value) for value in values.split(":"))
+            if not low <= high:
+                raise ValueError(f"expected LOW <= HIGH, got {values}")
+            # Float ranges are sampled log-uniformly, see random_configurations.
+            if parameter_type is float and low <= 0:
+                raise ValueError(f"expected 0 < LOW for a float range, got {values}")
+            return name, (low, high)
+        return name, [parameter_type(value) for value in values.split(",")]
+    except ValueError as e:
+        raise ValueError(f"invalid --param value: {spec!r}: {e}") from e
+
+
+def grid_configurations(space: SearchSpace) -> List[Dict]:
+    """All combinations of the values, other parameters keep their defaults."""
+    names = list(space)
+    return [
+        default_configuration() | dict(zip(names, values))
+        for values in itertools.product(*(space[name] for name in names))
+    ]
+
+
+def random_configurations(
+    space: SearchSpace, num_samples: int, seed: Optional[int] = None
+) -> List[Dict]:
+    """
+    Draws configurations at random. Values of a list are chosen uniformly,
+    float ranges are sampled log-uniformly, e.g. for the learning rate, and
+    integer ranges uniformly. Other parameters keep their defaults.
+    """
+    rng = random.Random(seed)
+    configurations = []
+    for _ in range(num_samples):
+        configuration = default_configuration()
+        for name, values in space.items():
+            if isinstance(values, list):
+                configuration[name] = rng.choice(values)
+            elif PARAMETERS[name][0] is int:
+                configuration[name] = rng.randint(*values)
+            else:
+                low, high = values
+                configuration[name] = math.exp(
+                    rng.uniform(math.log(low), math.log(high))
+                )
+        configurations.append(configuration)
+    return configurations
+
+
+def default_configuration() -> Dict:
+    return {name: default for name, (_, default) in PARAMETERS.items()}
+
+
+def format_configuration(configuration: Dict) -> str:
+    return ", ".join(f"{name}={value:.3g}" for name, value in configuration.items())
+
+
+def init_worker(data_dir: Path, manifest: Optional[Path], torch_threads: int):
+    # Imported here, so that the main process doesn't import torch.
+    import matplotlib
+    import torch
+
+    from .datasets import InMemoryDataset
+
+    matplotlib.use("Agg")
+    # Caps intra-op parallelism, so that the workers don't oversubscribe the CPU.
+    torch.set_num_threads(torch_threads)
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    _worker["device"] = device
+    # Every run of the worker trains on the same decoded images.
+    _worker["train"] = InMemoryDataset("train", data_dir, device, manifest)
+    _worker["validation"] = InMemoryDataset("validation", data_dir, device, manifest)
+
+
+def run_in_worker(run_dir: Path, configuration: Dict) -> Dict:
+    """
+    Trains the model with a configuration and writes config.json,
+    metrics.json, training_graphs.png and model.pth to the run directory.
+    Returns the metrics.
+    """
+    import torch
+
+    from .datasets import InMemoryDataLoader
+    from .model import TaggedBeeClassificationModel
+    from .train import fit, save_plots
+
+    run_dir.mkdir(parents=True, exist_ok=True)
+    with open(run_dir / "config.json", "w") as f:
+        json.dump(configuration, f, indent=2)
+    start = time.perf_counter()
+    torch.manual_seed(configuration["seed"])
+    device = _worker["device"]
+    model = TaggedBeeClassificationModel().to(device)
+    history = fit(
+        model,
+        InMemoryDataLoader(
+            _worker["train"],
+            configuration["batch_size"],
+            shuffle=True,
+            augment=True,
+            seed=configuration["seed"],
+        ),
+        InMemoryDataLoader(_worker["validation"], configuration["batch_size"]),
+        configuration["epochs"],
+        configuration["learning_rate"],
+        device,
+        verbose=False,
+    )
+    seconds = time.perf_counter() - start
+    best_epoch = max(
+        range(len(history["validation_accuracy"])),
+        key=lambda epoch: (
+            history["validation_accuracy"][epoch],
+            -history["validation_loss"][epoch],
+        ),
+    )
+    metrics = {
+        "run": run_dir.name,
+        "config": configuration,
+        "best_validation_accuracy": history["validation_accuracy"][best_epoch],
+        "best_validation_loss": history["validation_loss"][best_epoch],
+        "best_epoch": best_epoch + 1,
+        "final_validation_accuracy": history["validation_accuracy"][-1],
+        "final_validation_loss": history["validation_loss"][-1],
+        "seconds": seconds,
+        "history": history,
+    }
+    with open(run_dir / "metrics.json", "w") as f:
+        json.dump(metrics, f, indent=2)
+    save_plots(
+        history["train_loss"],
+        history["validation_loss"],
+        history["validation_accuracy"],
+        run_dir / "training_graphs.png",
+    )
+    torch.save(model.state_dict(), run_dir / "model.pth")
+    return metrics
+
+
+def write_leaderboard(results: List[Dict], path: Path) -> List[Dict]:
+    """
+    Ranks the runs by their best validation accuracy, then by the validation
+    loss of that epoch, and writes them to a CSV file.
+    """
+    results = sorted(
+        results,
+        key=lambda result: (
+            -result["best_validation_accuracy"],
+            result["best_validation_loss"],
+        ),
+    )
+    leaderboard = [
+        {
+            "rank": rank,
+            "run": result["run"],
+            **result["config"],
+            **{
+                column: result[column]
+                for column in LEADERBOARD_COLUMNS
+                if column in result and column != "run"
+            },
+        }
+        for rank, result in enumerate(results, start=1)
+    ]
+    with open(path, "w", newline="") as f:
+        writer = csv.DictWriter(f, LEADERBOARD_COLUMNS)
+        writer.writeheader()
+        writer.writerows(leaderboard)
+    return leaderboard
+
+
+def print_leaderboard(leaderboard: List[Dict], top: int):
+    print(
+        f"{'rank':>4}  {'run':<8}  {'learning_rate':>13}  {'batch_size':>10}  "
+        f"{'epochs':>6}  {'seed':>4}  {'best acc.':>9}  {'epoch':>5}  "
+        f"{'final acc.':>10}  {'seconds':>7}"
+    )
+    for row in leaderboard[:top]:
+        print(
+            f"{row['rank']:>4}  {row['run']:<8}  {row['learning_rate']:>13.3g}  "
+            f"{row['batch_size']:>10}  {row['epochs']:>6}  {row['seed']:>4}  "
+            f"{row['best_validation_accuracy']:>8.1f}%  {row['best_epoch']:>5}  "
+            f"{row['final_validation_accuracy']:>9.1f}%  {row['seconds']:>7.1f}"
+        )
+
+
+class MyArgs(argparse.Namespace):
+    param: List[str]
+    search: str
+    num_samples: int
+    seed: Optional[int]
+    workers: int
+    torch_threads: Optional[int]
+    data_dir: Path
+    manifest: Optional[Path]
+    output_dir: Optional[Path]
+    top: int
+
+
+def init_argparse() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        description=(
+            "Trains the CNN classifier with every configuration of a grid or random hyperparameter search in parallel processes and writes a leaderboard"
+        ),
+    )
+    parser.add_argument(
+        "--param",
+        action="append",
+        default=[],
+        metavar="NAME=VALUES",
+        help=(
+            f"values of a hyperparameter, NAME=V1,V2,... or, for --search random, "
+            f"NAME=LOW:HIGH, e.g. learning_rate=0.0001:0.01. NAME is one of "
+            f"{', '.join(PARAMETERS)}, the others keep the defaults of "
+            f"hyperparameters.py and seed 0, can be repeated"
+        ),
+    )
+    parser.add_argument(
+        "--search",
+        choices=("grid", "random"),
+        default="grid",
+        help="train all combinations of the values or --num_samples random ones (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--num_samples",
+        type=int,
+        default=16,
+        help="number of configurations of --search random (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=None,
+        help="seed of --search random (default: random)",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="number of configurations that are trained in parallel processes (default: number of CPUs, %(default)s)",
+    )
+    parser.add_argument(
+        "--torch_threads",
+        type=int,
+        default=None,
+        help="number of torch intra-op threads per worker (default: number of CPUs divided by --workers)",
+    )
+    parser.add_argument(
+        "--data_dir",
+        type=Path,
+        default=DEFAULT_DATA_DIR,
+        help="path to the cropped images, with one directory per split (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--manifest",
+        type=Path,
+        default=None,
+        help="split manifest to take the splits from instead of the split directories of --data_dir, see split_dataset.py",
+    )
+    parser.add_argument(
+        "--output_dir",
+        type=Path,
+        default=None,
+        help="directory of the runs and the leaderboard (default: output/sweeps/<timestamp>)",
+    )
+    parser.add_argument(
+        "--top",
+        type=int,
+        default=10,
+        help="number of runs of the leaderboard that are printed (default: %(default)s)",
+    )
+    return parser
+
+
+if __name__ == "__main__":
+    main()
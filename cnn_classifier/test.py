@@ -1,11 +1,22 @@
-import sklearn
-import torch
+import argparse
+from pathlib import Path
+from typing import Optional
 
-from datasets import test_dataloader
-from model import TaggedBeeClassificationModel
+from .split_dataset import DEFAULT_DATA_DIR
 
 
 def main():
+    parser = init_argparse()
+    args: MyArgs = parser.parse_args(namespace=MyArgs())
+    # Imported after parsing the arguments, so that --help is fast.
+    import torch
+
+    from utils.metrics import BinaryMetrics
+
+    from .classification import TagStatus
+    from .datasets import get_dataloader
+    from .model import TaggedBeeClassificationModel
+
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
     model = TaggedBeeClassificationModel()
     model.load_state_dict(
@@ -13,44 +24,56 @@ def main():
     )
     model.to(device)
     model.eval()
+    test_dataloader = get_dataloader("test", args.data_dir, manifest=args.manifest)
 
+    # Tagged is the positive class
+    metrics = BinaryMetrics(positive=TagStatus.tagged.value)
     with torch.no_grad():
-        correct = 0
-        total = 0
-        y_true = []
-        y_pred = []
-        y_score = []
         for images, labels in test_dataloader:
-            images, labels = images.to(device), labels.to(device)
+            images = images.to(device)
             outputs = model(images)
-            predictions, confidences, tagged_probabilities = (
-                model.postprocess_predictions(outputs, numpy=False)
+            predictions, _, tagged_probabilities = model.postprocess_predictions(
+                outputs
             )
-            total += labels.size(0)
-            correct += (predictions == labels).sum().item()
-            y_true += labels.tolist()
-            y_pred += predictions.tolist()
-            y_score += confidences.tolist()
-
-        accuracy = 100 * correct / total
-        print(f"Accuracy of the model on the {total} test images: {accuracy:.2f}%")
-
-        # Reverse labels because we want 0 = tagged to be positive
-        y_true = [0 if y == 1 else 1 for y in y_true]
-        y_pred = [0 if y == 1 else 1 for y in y_pred]
-
-        tn, fp, fn, tp = sklearn.metrics.confusion_matrix(y_true, y_pred).ravel()
-        print(f"tp: {tp}")
-        print(f"tn: {tn}")
-        print(f"fp: {fp}")
-        print(f"fn: {fn}")
-        f1_score = sklearn.metrics.f1_score(y_true, y_pred)
-        print(f"F1 score: {f1_score}")
-        roc_auc_score = sklearn.metrics.roc_auc_score(
-            y_true, tagged_probabilities.cpu()
-        )
-        print(f"ROC AUC score: {roc_auc_score}")
-        print(sklearn.metrics.classification_report(y_true, y_pred, digits=2))
+            metrics.update(labels.numpy(), predictions, tagged_probabilities)
+
+    print(
+        f"Accuracy of the model on the {metrics.count} test images: "
+        f"{100 * metrics.accuracy():.2f}%"
+    )
+    print(f"tp: {metrics.tp}")
+    print(f"tn: {metrics.tn}")
+    print(f"fp: {metrics.fp}")
+    print(f"fn: {metrics.fn}")
+    print(f"F1 score: {metrics.f1_score()}")
+    print(f"ROC AUC score: {metrics.roc_auc_score()}")
+    print(metrics.classification_report(("untagged", "tagged"), digits=2))
+
+
+class MyArgs(argparse.Namespace):
+    data_dir: Path
+    manifest: Optional[Path]
+
+
+def init_argparse() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        description=(
+            "Evaluates the CNN classifier saved in output/model.pth on the test split of the cropped images"
+        ),
+    )
+    parser.add_argument(
+        "--data_dir",
+        type=Path,
+        default=DEFAULT_DATA_DIR,
+        help="path to the cropped images, with one directory per split (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--manifest",
+        type=Path,
+        default=None,
+        help="split manifest to take the splits from instead of the split directories of --data_dir, see split_dataset.py",
+    )
+    return parser
 
 
 if __name__ == "__main__":
@@ -1,38 +1,141 @@
-import matplotlib.pyplot as plt
+import argparse
+import time
+from pathlib import Path
+from typing import Dict, List, Optional
+
 import numpy as np
-import torch
-import torch.nn as nn
-from matplotlib.ticker import MaxNLocator
 
-from datasets import train_dataloader, validation_dataloader
-from hyperparameters import epochs, learning_rate
-from model import TaggedBeeClassificationModel
+from .hyperparameters import batch_size, epochs, learning_rate
+from .split_dataset import DEFAULT_DATA_DIR
 
 
 def main():
+    parser = init_argparse()
+    args: MyArgs = parser.parse_args(namespace=MyArgs())
+    if (args.zips_dir is None) != (args.labels_dir is None):
+        parser.error("--zips_dir and --labels_dir must be given together")
+    # Imported after parsing the arguments, so that --help is fast.
+    import torch
+
+    from .datasets import (
+        InMemoryDataLoader,
+        InMemoryDataset,
+        WDDZipDataset,
+        get_dataloader,
+        get_in_memory_dataloader,
+        get_wdd_zip_dataloaders,
+        split_wdd_zip_dataset,
+    )
+    from .model import TaggedBeeClassificationModel
+
+    if args.seed is not None:
+        torch.manual_seed(args.seed)
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
     model = TaggedBeeClassificationModel().to(device)
+    if args.zips_dir is not None and args.in_memory:
+        # The snippets are decoded from the archives once.
+        dataset = WDDZipDataset(args.zips_dir, args.labels_dir)
+        train_indices, validation_indices = split_wdd_zip_dataset(
+            dataset, args.validation_fraction, args.split_seed
+        )
+        images = InMemoryDataset.from_dataset(dataset, device)
+        train_dataloader = InMemoryDataLoader(
+            images.subset(train_indices),
+            args.batch_size,
+            shuffle=True,
+            augment=True,
+            seed=args.seed,
+        )
+        validation_dataloader = InMemoryDataLoader(
+            images.subset(validation_indices), args.batch_size
+        )
+    elif args.zips_dir is not None:
+        train_dataloader, validation_dataloader = get_wdd_zip_dataloaders(
+            args.zips_dir,
+            args.labels_dir,
+            args.batch_size,
+            args.validation_fraction,
+            args.split_seed,
+            args.num_workers,
+        )
+    elif args.in_memory:
+        train_dataloader = get_in_memory_dataloader(
+            "train", args.data_dir, args.batch_size, device, args.seed, args.manifest
+        )
+        validation_dataloader = get_in_memory_dataloader(
+            "validation", args.data_dir, args.batch_size, device, manifest=args.manifest
+        )
+    else:
+        train_dataloader = get_dataloader(
+            "train", args.data_dir, args.batch_size, args.manifest
+        )
+        validation_dataloader = get_dataloader(
+            "validation", args.data_dir, args.batch_size, args.manifest
+        )
+
+    history = fit(
+        model,
+        train_dataloader,
+        validation_dataloader,
+        args.epochs,
+        args.learning_rate,
+        device,
+    )
+    print("Done!")
+    save_plots(
+        history["train_loss"],
+        history["validation_loss"],
+        history["validation_accuracy"],
+    )
+    torch.save(model.state_dict(), "output/model.pth")
+
+
+def fit(
+    model,
+    train_dataloader,
+    validation_dataloader,
+    epochs: int,
+    learning_rate: float,
+    device,
+    verbose: bool = True,
+) -> Dict[str, List[float]]:
+    """
+    Trains the model with Adam and validates it after every epoch. Returns the
+    training loss, validation loss and accuracy and the training time of
+    every epoch.
+    """
+    import torch
+    import torch.nn as nn
+
     criterion = nn.CrossEntropyLoss()
     optimizer = torch.optim.Adam(model.parameters(), lr=learning_rate)
-
-    train_loss_values = []
-    validation_loss_values = []
-    validation_accuracy_values = []
+    history = {
+        "train_loss": [],
+        "validation_loss": [],
+        "validation_accuracy": [],
+        "epoch_seconds": [],
+    }
     for t in range(epochs):
-        print(f"Epoch {t + 1}\n-------------------------------")
-        train_losses = train(train_dataloader, model, criterion, optimizer, device)
-        train_loss_values.append(sum(train_losses) / len(train_losses))
+        if verbose:
+            print(f"Epoch {t + 1}\n-------------------------------")
+        start = time.perf_counter()
+        train_losses = train(
+            train_dataloader, model, criterion, optimizer, device, verbose
+        )
+        epoch_seconds = time.perf_counter() - start
+        if verbose:
+            print(f"Epoch time: {1000 * epoch_seconds:.1f} ms")
+        history["train_loss"].append(sum(train_losses) / len(train_losses))
         validation_loss, validation_accuracy = validate(
-            validation_dataloader, model, criterion, device
+            validation_dataloader, model, criterion, device, verbose
         )
-        validation_loss_values.append(validation_loss)
-        validation_accuracy_values.append(validation_accuracy)
-    print("Done!")
-    save_plots(train_loss_values, validation_loss_values, validation_accuracy_values)
-    torch.save(model.state_dict(), "output/model.pth")
+        history["validation_loss"].append(validation_loss)
+        history["validation_accuracy"].append(validation_accuracy)
+        history["epoch_seconds"].append(epoch_seconds)
+    return history
 
 
-def train(dataloader, model, loss_fn, optimizer, device):
+def train(dataloader, model, loss_fn, optimizer, device, verbose=True):
     epoch_losses = []
     model.train()
     for batch, (images, labels) in enumerate(dataloader):
@@ -48,14 +151,16 @@ def train(dataloader, model, loss_fn, optimizer, device):
         optimizer.step()
         optimizer.zero_grad()
 
-        if batch % 100 == 0:
+        if verbose and batch % 100 == 0:
             loss, current = loss.item(), (batch + 1) * len(images)
             size = len(dataloader.dataset)
             print(f"loss: {loss:>7f}  [{current:>5d}/{size:>5d}]")
     return epoch_losses
 
 
-def validate(dataloader, model, loss_fn, device):
+def validate(dataloader, model, loss_fn, device, verbose=True):
+    import torch
+
     size = len(dataloader.dataset)
     num_batches = len(dataloader)
     model.eval()
@@ -69,13 +174,23 @@ def validate(dataloader, model, loss_fn, device):
             correct += (pred.argmax(1) == labels).type(torch.float).sum().item()
     validation_loss /= num_batches
     accuracy = 100 * correct / size
-    print(
-        f"Validation Error: \n Accuracy: {accuracy:>0.1f}%, Avg loss: {validation_loss:>8f} \n"
-    )
+    if verbose:
+        print(
+            f"Validation Error: \n Accuracy: {accuracy:>0.1f}%, Avg loss: {validation_loss:>8f} \n"
+        )
     return validation_loss, accuracy
 
 
-def save_plots(train_loss_values, validation_loss_values, validation_accuracy_values):
+def save_plots(
+    train_loss_values,
+    validation_loss_values,
+    validation_accuracy_values,
+    path: Path = Path("output/visualizations/training_graphs.png"),
+):
+    import matplotlib.pyplot as plt
+    from matplotlib.ticker import MaxNLocator
+
+    epochs = len(train_loss_values)
     fig, (ax1, ax2, ax3) = plt.subplots(3, sharex=True)
     ax1.plot(np.linspace(1, epochs, epochs).astype(int), train_loss_values)
     ax1.set_title("Training Loss")
@@ -86,7 +201,103 @@ def save_plots(train_loss_values, validation_loss_values, validation_accuracy_va
     ax1.xaxis.set_major_locator(MaxNLocator(epochs, integer=True))
     plt.xlabel("epochs")
     plt.tight_layout()
-    plt.savefig("output/visualizations/training_graphs.png")
+    plt.savefig(path)
+    plt.close(fig)
+
+
+class MyArgs(argparse.Namespace):
+    data_dir: Path
+    manifest: Optional[Path]
+    zips_dir: Optional[Path]
+    labels_dir: Optional[Path]
+    validation_fraction: float
+    split_seed: int
+    num_workers: int
+    in_memory: bool
+    batch_size: int
+    epochs: int
+    learning_rate: float
+    seed: Optional[int]
+
+
+def init_argparse() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        description=(
+            "Trains the CNN classifier on the train split of the cropped images, validating after every epoch, and saves the weights to output/model.pth"
+        ),
+    )
+    parser.add_argument(
+        "--data_dir",
+        type=Path,
+        default=DEFAULT_DATA_DIR,
+        help="path to the cropped images, with one directory per split (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--manifest",
+        type=Path,
+        default=None,
+        help="split manifest to take the splits from instead of the split directories of --data_dir, see split_dataset.py",
+    )
+    parser.add_argument(
+        "--zips_dir",
+        type=Path,
+        default=None,
+        help="directory with WDD zip archives to train on instead of the cropped images, the snippets are decoded and cropped on the fly",
+    )
+    parser.add_argument(
+        "--labels_dir",
+        type=Path,
+        default=None,
+        help="directory with the labeled days of the archives of --zips_dir, as written by daily_data_processing.py and corrected with the Label GUI",
+    )
+    parser.add_argument(
+        "--validation_fraction",
+        type=float,
+        default=0.15,
+        help="fraction of the snippets of each label of --zips_dir that are validated on (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--split_seed",
+        type=int,
+        default=0,
+        help="seed of the split of the snippets of --zips_dir (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--num_workers",
+        type=int,
+        default=0,
+        help="number of DataLoader worker processes that decode the snippets of --zips_dir (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--in_memory",
+        action="store_true",
+        help="decode the images once into a tensor on the device and flip training batches with tensor ops instead of loading them with a DataLoader in every epoch",
+    )
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=batch_size,
+        help="number of training and validation images per batch, --in_memory makes large batches cheap (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--epochs",
+        type=int,
+        default=epochs,
+        help="number of epochs (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--learning_rate",
+        type=float,
+        default=learning_rate,
+        help="learning rate of Adam (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=None,
+        help="seed of the weight initialization and, with --in_memory, of the order and flips of the training images (default: random)",
+    )
+    return parser
 
 
 if __name__ == "__main__":
@@ -1,24 +1,58 @@
 import argparse
-import datetime
+import functools
+import io
+import itertools
 import json
+import multiprocessing
+import os
+import shutil
 import sys
-import tempfile
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
 from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
 from zipfile import ZipFile
 
 import numpy as np
-import pandas as pd
-from ffmpeg import FFmpeg
-from PIL import Image
 from tqdm import tqdm
 
+from cnn_classifier.classification import (
+    ImageClassifier,
+    TagStatus,
+    backends,
+    class_labels,
+    frame_aggregations,
+    load_classifier,
+    model_variants,
+)
 from cnn_classifier.hyperparameters import image_size
-from cnn_classifier.inference import TaggedBeeClassifierConvNet, TagStatus, class_labels
-from utils.image_cropping import crop_center
+from utils.apng_decoding import decode_first_frame_center, decode_frames_center
+from utils.archive_watcher import ArchiveWatcher
+from utils.day_journal import DayJournal
+from utils.instrumentation import DayTimings, RunReport, profile_path, sample_stacks
 from utils.metadata_types import MetadataJson
+from utils.pipeline import Pipeline, Stage
+from utils.prediction_cache import (
+    DEFAULT_CACHE_PATH,
+    DEFAULT_MAX_BYTES,
+    PredictionCache,
+)
+from utils.video_encoding import encode_video
+from utils.wood_filter import MarkerIndex, validate_csv_path
 
 TAGGED_DANCE_DIR = "tagged-dances"
 UNTAGGED_DANCE_DIR = "untagged-dances"
+# Stages of the pipeline that processes the detections of a day, see DayProcessor
+STAGES = ("read", "filter", "decode", "classify", "encode", "write")
+# Days that are still being processed are staged in this subdirectory of the
+# output directory.
+PARTIAL_DIR = ".partial"
+# Archives seen in watch mode are tracked in this file of the output directory.
+WATCH_STATE_FILE = ".watch_state.json"
+# Status of the days that were lost with a worker process, see process_days
+WORKER_DIED_STATUS = "failed: a worker process died, will be resumed"
 
 
 def main():
@@ -35,175 +69,721 @@ def main():
     except Exception as e:
         print(f"Error: {e}", file=sys.stderr)
         sys.exit(1)
+    if args.profile_day is not None and args.report is None:
+        parser.error("--profile_day requires --report to be set")
+    if args.backend == "numpy" and args.model_variant != "fp32":
+        parser.error("--backend numpy only supports --model_variant fp32")
+    if args.num_frames < 1 or args.max_decoded_frames < 1:
+        parser.error("--num_frames and --max_decoded_frames must be at least 1")
+    if args.torch_threads is None and args.workers > 1:
+        args.torch_threads = max(1, (os.cpu_count() or 1) // args.workers)
 
-    classifier = TaggedBeeClassifierConvNet("output/model.pth")
-    for zip_path in tqdm(list(zipped_wdd_data_dir.rglob("*"))):
-        if not zip_path.suffix == ".zip":
-            continue
-        daily_target = output_dir / zip_path.stem
-        # Ignore days that were already processed.
-        if daily_target.exists():
-            print(f"{daily_target} already exists.")
-            continue
-        with ZipFile(zip_path) as zip_file:
-            day_dance_ids = []
-            waggle_ids = []
-            predictions = []
-            confidences = []
-            dance_types = []
+    # Every stage runs with one worker unless configured otherwise.
+    stage_workers = dict.fromkeys(STAGES, 1)
+    stage_workers["decode"] = 2
+    stage_workers["encode"] = args.encode_jobs
+    for stage_worker in args.stage_workers:
+        stage, _, workers = stage_worker.partition("=")
+        if stage not in STAGES or not workers.isdigit() or int(workers) < 1:
+            parser.error(
+                f"invalid --stage_workers value: {stage_worker!r}, expected STAGE=N "
+                f"with STAGE in {', '.join(STAGES)}"
+            )
+        stage_workers[stage] = int(workers)
 
-            tagged_target_dir = daily_target / TAGGED_DANCE_DIR
-            untagged_target_dir = daily_target / UNTAGGED_DANCE_DIR
+    worker_args = (
+        wdd_markers_path,
+        output_dir,
+        stage_workers,
+        args.batch_size,
+        args.queue_size,
+        args.encode_threads,
+        args.torch_threads,
+        args.backend,
+        args.model_variant,
+        None if args.no_prediction_cache else args.prediction_cache,
+        int(args.max_prediction_cache_mb * 1024**2),
+        args.profile_day,
+        None
+        if args.profile_day is None
+        else profile_path(args.report, args.profile_day),
+        args.num_frames,
+        args.max_decoded_frames,
+        args.frame_aggregation,
+    )
+    report = None if args.report is None else RunReport(args.report)
+    create_executor = None
+    executor = None
+    if args.workers > 1:
+        # Each worker process loads the model once and processes whole days.
+        create_executor = functools.partial(
+            ProcessPoolExecutor,
+            args.workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=init_worker,
+            initargs=worker_args + (False,),
+        )
+    else:
+        init_worker(*worker_args)
 
-            video_filenames = list(
-                filter(lambda filename: filename.endswith(".apng"), zip_file.namelist())
+    try:
+        if args.watch:
+            watcher = ArchiveWatcher(
+                zipped_wdd_data_dir,
+                output_dir / WATCH_STATE_FILE,
+                args.active_hours * 3600,
             )
-            for count, video_filename in enumerate(tqdm(video_filenames), start=1):
-                # Find matching metadata file
-                metadata_filename = video_filename.replace("frames.apng", "waggle.json")
-                with zip_file.open(metadata_filename) as metadata_file:
-                    json_data: MetadataJson = json.load(metadata_file)
-                    # We only care about waggles, so filter the rest out. Also,
-                    # the model thinks the bright pixels of the wooden frame on
-                    # the comb are tags, so we ignore those detections.
-                if json_data["predicted_class_label"] != "waggle" or is_wood_in_frame(
-                    json_data, wdd_markers_path
-                ):
-                    continue
-                with zip_file.open(video_filename) as video_file:
-                    with Image.open(video_file) as image:
-                        cropped_image = crop_center(image, image_size, image_size)
-                prediction, confidence = classifier.classify_single_image(cropped_image)
-                day_dance_id = f"{count:04d}"
-                day_dance_ids.append(day_dance_id)
-                waggle_ids.append(json_data["waggle_id"])
-                predictions.append(prediction)
-                confidences.append(confidence)
-                dance_types.append(json_data["predicted_class_label"])
-                # Save video file
-                # Because we don't want to keep the nested directory structure
-                # which the files within the zip file are in, we assign a new
-                # name to the filename attribute of a video file, i.e.
-                # "12/44/8/frames.apng", -> "0001.apng". This leads to a flat
-                # directory structure.
-                zip_file.getinfo(video_filename).filename = day_dance_id + ".apng"
-                with tempfile.TemporaryDirectory() as tmp_dir:
-                    zip_file.extract(video_filename, tmp_dir)
-                    input = Path(tmp_dir) / (day_dance_id + ".apng")
-                    if class_labels[prediction] == TagStatus.tagged.name:
-                        output = tagged_target_dir / (day_dance_id + ".mp4")
+            watch(watcher, create_executor, args.poll_interval, report)
+            return
+
+        if create_executor is not None:
+            executor = create_executor()
+
+        zip_paths = []
+        for zip_path in zipped_wdd_data_dir.rglob("*"):
+            if not zip_path.suffix == ".zip":
+                continue
+            daily_target = output_dir / zip_path.stem
+            # Ignore days that were already processed. Days are only published
+            # to their target directory once they are complete.
+            if daily_target.exists():
+                print(f"{daily_target} already exists.")
+                continue
+            zip_paths.append(zip_path)
+        results = process_days(
+            [(zip_path, 0) for zip_path in zip_paths], executor, report
+        )
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        if report is not None:
+            report.close()
+
+    failed_days = {
+        zip_path.stem: status
+        for zip_path, (status, _) in results.items()
+        if status != "complete"
+    }
+    print(f"{len(results) - len(failed_days)} of {len(results)} days were processed.")
+    for date, status in sorted(failed_days.items()):
+        print(f"Error: {date}: {status}", file=sys.stderr)
+    if failed_days:
+        sys.exit(1)
+
+
+def watch(
+    watcher: ArchiveWatcher,
+    create_executor: Optional[Callable[[], ProcessPoolExecutor]],
+    poll_interval: float,
+    report: Optional[RunReport] = None,
+):
+    """
+    Processes new and grown archives as soon as they are complete, until
+    interrupted. Of a grown archive, only the new detections are processed and
+    appended to the published day. The days are processed in the worker
+    processes of an executor if create_executor is given, which is replaced
+    if a worker process dies.
+    """
+    print(f"Watching {watcher.root} for new WDD data.")
+    executor = None if create_executor is None else create_executor()
+    try:
+        while True:
+            archives = watcher.poll()
+            if archives:
+                jobs = [
+                    (archive, watcher.processed_members(archive))
+                    for archive in archives
+                ]
+                results = process_days(jobs, executor, report)
+                for archive, (status, members) in results.items():
+                    if status == "complete":
+                        watcher.mark_processed(archive, members)
                     else:
-                        output = untagged_target_dir / (day_dance_id + ".mp4")
-                    encode_video(input, output)
-
-            data = {
-                "day_dance_id": np.array(day_dance_ids),
-                "waggle_id": np.array(waggle_ids),
-                "category": np.array(
-                    [predictions[i] for i, _ in enumerate(predictions)]
-                ),
-                "category_label": np.array(
-                    [class_labels[predictions[i]] for i, _ in enumerate(predictions)]
-                ),
-                "confidence": np.array(confidences),
-                "corrected_category": np.empty_like(day_dance_ids),
-                "corrected_category_label": np.empty_like(day_dance_ids),
-                "dance_type": np.array(dance_types),
-                "corrected_dance_type": np.empty_like(day_dance_ids),
-            }
+                        # The archive is retried at one of the next polls.
+                        print(f"Error: {archive.stem}: {status}", file=sys.stderr)
+                if executor is not None and any(
+                    status == WORKER_DIED_STATUS for status, _ in results.values()
+                ):
+                    print("Restarting the worker processes.", file=sys.stderr)
+                    executor.shutdown()
+                    executor = create_executor()
+            time.sleep(poll_interval)
+    finally:
+        if executor is not None:
+            executor.shutdown()
 
-            # Save to csv file
-            df = pd.DataFrame(data)
-            df.to_csv(daily_target / "data.csv", index=False)
 
+def process_days(
+    jobs: List[Tuple[Path, int]],
+    executor: Optional[ProcessPoolExecutor],
+    report: Optional[RunReport] = None,
+) -> Dict[Path, Tuple[str, Optional[int]]]:
+    """
+    Processes the days given as (zip path, start count) pairs, in the worker
+    processes of the executor if given. Returns the status and the number of
+    video snippets of each day by zip path. The timings of every day are added
+    to the report if given.
 
-def is_wood_in_frame(json_data, wdd_markers_path: Path):
+    If a worker process dies, e.g. killed for using too much memory, the
+    executor is broken: the days that weren't finished fail with
+    WORKER_DIED_STATUS, and the executor can't be used anymore. Their staged
+    progress is kept, so they are resumed by the next run.
     """
-    Estimates whether the cropped image of the corresponding dance shows a part
-    of the wooden frame on the comb based on the position of the dance.
+    results = {}
+
+    def add_result(zip_path: Path, result):
+        status, members, timings = result
+        results[zip_path] = (status, members)
+        if report is not None:
+            report.add_day(timings)
+
+    if executor is not None:
+        futures = {}
+        for zip_path, start_count in jobs:
+            try:
+                future = executor.submit(process_day_in_worker, zip_path, start_count)
+            except BrokenProcessPool:
+                results[zip_path] = (WORKER_DIED_STATUS, None)
+                continue
+            futures[future] = zip_path
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            try:
+                result = future.result()
+            except BrokenProcessPool:
+                results[futures[future]] = (WORKER_DIED_STATUS, None)
+                continue
+            add_result(futures[future], result)
+    else:
+        for zip_path, start_count in tqdm(jobs):
+            add_result(zip_path, process_day_in_worker(zip_path, start_count))
+    return results
+
+
+# Model, marker index and settings of the current (worker) process, set
+# up once by init_worker.
+_worker = {}
+
+
+def init_worker(
+    wdd_markers_path: Path,
+    output_dir: Path,
+    stage_workers: Dict[str, int],
+    batch_size: int,
+    queue_size: int,
+    encode_threads: Optional[int],
+    torch_threads: Optional[int],
+    backend: str,
+    model_variant: str,
+    prediction_cache_path: Optional[Path],
+    max_prediction_cache_bytes: int,
+    profile_day: Optional[str],
+    stacks_path: Optional[Path],
+    num_frames: int = 1,
+    max_decoded_frames: Optional[int] = None,
+    frame_aggregation: str = "mean",
+    show_progress: bool = True,
+):
+    if backend == "torch" and torch_threads is not None:
+        # Caps intra-op parallelism, so that several workers don't
+        # oversubscribe the CPU. The numpy backend doesn't import torch.
+        import torch
+
+        torch.set_num_threads(torch_threads)
+    _worker["marker_index"] = MarkerIndex.from_csv(wdd_markers_path, image_size)
+    classifier = load_classifier("output/model.pth", backend, model_variant)
+    _worker["classifier"] = classifier
+    _worker["prediction_cache"] = None
+    if prediction_cache_path is not None:
+        _worker["prediction_cache"] = PredictionCache(
+            prediction_cache_path, classifier.weights_path, max_prediction_cache_bytes
+        )
+    _worker["output_dir"] = output_dir
+    _worker["stage_workers"] = stage_workers
+    _worker["batch_size"] = batch_size
+    _worker["queue_size"] = queue_size
+    _worker["encode_threads"] = encode_threads
+    _worker["profile_day"] = profile_day
+    _worker["stacks_path"] = stacks_path
+    _worker["show_progress"] = show_progress
+    _worker["num_frames"] = num_frames
+    _worker["max_decoded_frames"] = max_decoded_frames
+    _worker["frame_aggregation"] = frame_aggregation
+
+
+def process_day_in_worker(zip_path: Path, start_count: int = 0):
     """
-    df_markers_wdd = pd.read_csv(wdd_markers_path)
-    wdd_markers = get_marker_coordinates_by_timestamp(
-        detection_timestamp=json_data["timestamp_begin"],
-        df_markers=df_markers_wdd,
-    )
-    if wdd_markers is None:
-        return False
-
-    # Values were determined from a single wdd image.
-    wood_offset_x = 100
-    wood_offset_top = 80
-    wood_offset_bot = 220
-
-    # These borders span an area on the comb that is within the wooden frame.
-    border_left = max(
-        [wdd_markers[0][0] + wood_offset_x, wdd_markers[2][0] + wood_offset_x]
-    )
-    border_top = max(
-        [wdd_markers[0][1] + wood_offset_top, wdd_markers[1][1] + wood_offset_top]
-    )
-    border_right = min(
-        [wdd_markers[1][0] - wood_offset_x, wdd_markers[3][0] - wood_offset_x]
-    )
-    border_bot = min(
-        [wdd_markers[2][1] - wood_offset_bot, wdd_markers[3][1] - wood_offset_bot]
-    )
-
-    center_x, center_y = json_data["roi_center"]
-    # Correct the -125 offset of the roi coordinates in the metadata
-    correction_offset = 125
-    center_x += correction_offset
-    center_y += correction_offset
-
-    # Apply offset to account for size of cropped image that the model works on
-    frame_offset = image_size // 2
-    return (
-        center_x - frame_offset <= border_left
-        or center_x + frame_offset >= border_right
-        or center_y - frame_offset <= border_top
-        or center_y + frame_offset >= border_bot
-    )
-
-
-def get_marker_coordinates_by_timestamp(detection_timestamp, df_markers):
-    """Gives the most recent marker coordinates from before the dance detection."""
-    df_markers["timestamp"] = pd.to_datetime(df_markers["timestamp"])
-    marker_timestamps = sorted(df_markers["timestamp"].unique())
-    timestamp_to_show = None
-    for marker_timestamp in marker_timestamps:
-        if marker_timestamp <= datetime.datetime.fromisoformat(detection_timestamp):
-            timestamp_to_show = marker_timestamp
-    if timestamp_to_show is None:
-        return None
-    dfsel = df_markers.loc[df_markers["timestamp"] == timestamp_to_show]
-    marker_coords = [(row["x"], row["y"]) for _, row in dfsel.iterrows()]
-    return marker_coords
+    Processes one day with the state of the current worker. Errors are
+    returned as status, so that a failed day doesn't stop the other days.
+    Returns the status, the number of video snippets and the timings of the
+    day.
+    """
+    date = zip_path.stem
+    timings = DayTimings(date)
+    stacks_path = None
+    if date == _worker["profile_day"]:
+        stacks_path = _worker["stacks_path"]
+    members = None
+    start = time.perf_counter()
+    try:
+        with sample_stacks(stacks_path):
+            members = process_day(
+                zip_path,
+                _worker["output_dir"],
+                _worker["classifier"],
+                _worker["marker_index"],
+                _worker["stage_workers"],
+                _worker["batch_size"],
+                _worker["queue_size"],
+                _worker["encode_threads"],
+                _worker["show_progress"],
+                start_count,
+                _worker["prediction_cache"],
+                timings,
+                _worker["num_frames"],
+                _worker["max_decoded_frames"],
+                _worker["frame_aggregation"],
+            )
+        status = "incomplete, will be resumed" if members is None else "complete"
+    except Exception as e:
+        traceback.print_exc()
+        status = f"failed: {e!r}"
+    timings.seconds = time.perf_counter() - start
+    return status, members, timings
+
+
+def process_day(
+    zip_path: Path,
+    output_dir: Path,
+    classifier: ImageClassifier,
+    marker_index: MarkerIndex,
+    stage_workers: Dict[str, int],
+    batch_size: int,
+    queue_size: int,
+    encode_threads: Optional[int] = None,
+    show_progress: bool = True,
+    start_count: int = 0,
+    prediction_cache: Optional[PredictionCache] = None,
+    timings: Optional[DayTimings] = None,
+    num_frames: int = 1,
+    max_decoded_frames: Optional[int] = None,
+    frame_aggregation: str = "mean",
+) -> Optional[int]:
+    """
+    Classifies the waggles of one zip archive and writes the video snippets
+    and the data.csv file into the daily target directory.
+
+    The detections flow through a pipeline of stages (see DayProcessor) that
+    run concurrently and are connected by bounded queues.
+
+    The day is processed in a staging directory next to a journal of the
+    classified and encoded detections. If processing is interrupted, the next
+    run resumes from the journal. Once the day is complete, the staging
+    directory is renamed to the daily target directory.
+
+    Only the detections after the first start_count video snippets of the
+    archive are processed. If the day was already published, e.g. before the
+    archive grew, the detections after the last published one are processed
+    and appended to it.
 
+    If a prediction cache is given, detections whose video snippet was
+    classified before with the same model are not decoded and classified
+    again.
 
-def encode_video(input: Path, output: Path):
-    output.parent.mkdir(parents=True, exist_ok=True)
-    ffmpeg = (
-        FFmpeg()
-        .option("y")
-        .input(str(input))
-        .output(str(output), {"codec:v": "libx264"}, crf=18, pix_fmt="yuv420p")
+    The stages are timed into the given timings, see DayTimings.
+
+    With num_frames > 1, every detection is classified by that many evenly
+    spaced frames of its video snippet, of which at most max_decoded_frames
+    are decoded, and their predictions are aggregated with frame_aggregation,
+    see frame_aggregations.
+
+    Returns the number of video snippets in the archive if the day is
+    complete, otherwise None.
+    """
+    date = zip_path.stem
+    daily_target = output_dir / date
+    archive = str(zip_path.resolve())
+    if num_frames > 1:
+        # Predictions of several frames are cached separately from those of
+        # the first frame.
+        archive += f"?frames={num_frames}&max_decoded={max_decoded_frames}&aggregation={frame_aggregation}"
+    if timings is None:
+        timings = DayTimings(date)
+    if daily_target.exists():
+        start_count = max(start_count, published_count(daily_target))
+    staging_dir = output_dir / PARTIAL_DIR / date
+    staging_dir.mkdir(parents=True, exist_ok=True)
+    journal = DayJournal(output_dir / PARTIAL_DIR / f"{date}.jsonl")
+    if journal.classified:
+        print(
+            f"Resuming {date}: {len(journal.classified)} detections classified, "
+            f"{len(journal.encoded)} videos encoded."
+        )
+
+    try:
+        with ZipFile(zip_path) as zip_file:
+            video_filenames = list(
+                filter(lambda filename: filename.endswith(".apng"), zip_file.namelist())
+            )
+            with tqdm(
+                total=len(video_filenames), disable=not show_progress
+            ) as progress:
+                processor = DayProcessor(
+                    zip_file,
+                    staging_dir,
+                    classifier,
+                    marker_index,
+                    journal,
+                    progress,
+                    timings,
+                    encode_threads,
+                    prediction_cache,
+                    archive,
+                    num_frames,
+                    max_decoded_frames,
+                    frame_aggregation,
+                )
+                pipeline = Pipeline(
+                    [
+                        Stage("read", processor.read, stage_workers["read"]),
+                        Stage("filter", processor.filter, stage_workers["filter"]),
+                        Stage("decode", processor.decode, stage_workers["decode"]),
+                        Stage(
+                            "classify",
+                            processor.classify,
+                            stage_workers["classify"],
+                            batch_size=batch_size,
+                        ),
+                        Stage("encode", processor.encode, stage_workers["encode"]),
+                        Stage("write", processor.write, stage_workers["write"]),
+                    ],
+                    queue_size,
+                    timings,
+                )
+                timings.detections = max(0, len(video_filenames) - start_count)
+                progress.update(min(start_count, len(video_filenames)))
+                pipeline.run(
+                    itertools.islice(
+                        enumerate(video_filenames, start=1), start_count, None
+                    ),
+                    report=lambda depths: progress.set_postfix(depths, refresh=False),
+                )
+    finally:
+        journal.close()
+
+    # The day is only finished once all of its videos are encoded.
+    if processor.failures:
+        for day_dance_id, exception in processor.failures.items():
+            print(
+                f"Error: Failed to encode {date}/{day_dance_id}: {exception}",
+                file=sys.stderr,
+            )
+        print(
+            f"{date} is incomplete and will be resumed in the next run.",
+            file=sys.stderr,
+        )
+        return None
+
+    # After a crash during publishing, the journal may still hold detections
+    # that were already published.
+    entries = sorted(
+        (
+            entry
+            for entry in journal.classified.values()
+            if int(entry["day_dance_id"]) > start_count
+        ),
+        key=lambda e: int(e["day_dance_id"]),
     )
-    ffmpeg.execute()
+    day_dance_ids = [entry["day_dance_id"] for entry in entries]
+    predictions = [entry["prediction"] for entry in entries]
+    data = {
+        "day_dance_id": np.array(day_dance_ids),
+        "waggle_id": np.array([entry["waggle_id"] for entry in entries]),
+        "category": np.array(predictions),
+        "category_label": np.array(
+            [class_labels[prediction] for prediction in predictions]
+        ),
+        "confidence": np.array(
+            [entry["confidence"] for entry in entries], dtype=np.float32
+        ),
+        "corrected_category": np.empty_like(day_dance_ids),
+        "corrected_category_label": np.empty_like(day_dance_ids),
+        "dance_type": np.array([entry["dance_type"] for entry in entries]),
+        "corrected_dance_type": np.empty_like(day_dance_ids),
+    }
+
+    # Save to csv file
+    import pandas as pd
+
+    df = pd.DataFrame(data)
+    df.to_csv(staging_dir / "data.csv", index=False)
+
+    if daily_target.exists():
+        append_to_day(staging_dir, daily_target)
+    else:
+        # Publish the complete day at once
+        staging_dir.rename(daily_target)
+    journal.remove()
+    try:
+        (output_dir / PARTIAL_DIR).rmdir()
+    except OSError:
+        # Other days are still staged
+        pass
+    return len(video_filenames)
+
+
+def published_count(daily_target: Path) -> int:
+    """Count of the last detection in the data.csv file of a published day."""
+    import pandas as pd
+
+    day_dance_ids = pd.read_csv(daily_target / "data.csv", dtype=str)["day_dance_id"]
+    return int(day_dance_ids.astype(int).max()) if len(day_dance_ids) else 0
 
 
-def validate_csv_path(path: Path) -> None:
-    if not path.exists():
-        raise FileNotFoundError(f"File does not exist: {path}")
-    if not path.is_file():
-        raise ValueError(f"Not a file: {path}")
-    if path.suffix.lower() != ".csv":
-        raise ValueError(f"Not a CSV file: {path}")
+def append_to_day(staging_dir: Path, daily_target: Path):
+    """
+    Moves the videos of the staging directory into the published day and
+    appends the rows of its data.csv file. The published data.csv file is
+    replaced atomically and its existing rows, including corrections made in
+    the Label GUI since, are kept as they are.
+    """
+    for video in staging_dir.glob("*/*.mp4"):
+        target = daily_target / video.parent.name / video.name
+        target.parent.mkdir(exist_ok=True)
+        os.replace(video, target)
+    new_rows = (staging_dir / "data.csv").read_text().splitlines(keepends=True)[1:]
+    if new_rows:
+        published = (daily_target / "data.csv").read_text()
+        if published and not published.endswith("\n"):
+            published += "\n"
+        tmp_path = daily_target / "data.csv.tmp"
+        tmp_path.write_text(published + "".join(new_rows))
+        os.replace(tmp_path, daily_target / "data.csv")
+    shutil.rmtree(staging_dir)
+
+
+class DayProcessor:
+    """
+    The stages of processing the detections of one day. Each stage takes a
+    detection dict and returns the detections for the next stage, or nothing
+    if a detection is done:
+
+    read: reads the metadata of a detection from the zip archive
+    filter: drops detections that aren't waggles, show wood or were already
+        processed in a previous run, and looks up cached predictions
+    decode: decodes the cropped first frame, or num_frames frames, and reads
+        the video
+    classify: classifies batches of detections in one forward pass, with the
+        frames of all detections of a batch in one batch
+    encode: encodes the video into the directory of the predicted class
+    write: records the detection in the journal, from which data.csv is built
+
+    Besides the calls of the stages, which the pipeline times, zip I/O, JSON
+    parsing, the wood filter and image decoding are timed separately, as well
+    as the latency of each detection from read to write.
+    """
+
+    def __init__(
+        self,
+        zip_file: ZipFile,
+        staging_dir: Path,
+        classifier: ImageClassifier,
+        marker_index: MarkerIndex,
+        journal: DayJournal,
+        progress: tqdm,
+        timings: DayTimings,
+        encode_threads: Optional[int] = None,
+        prediction_cache: Optional[PredictionCache] = None,
+        archive: Optional[str] = None,
+        num_frames: int = 1,
+        max_decoded_frames: Optional[int] = None,
+        frame_aggregation: str = "mean",
+    ):
+        self.zip_file = zip_file
+        self.staging_dir = staging_dir
+        self.classifier = classifier
+        self.marker_index = marker_index
+        self.journal = journal
+        self.progress = progress
+        self.timings = timings
+        self.encode_threads = encode_threads
+        self.prediction_cache = prediction_cache
+        self.archive = archive
+        self.num_frames = num_frames
+        self.max_decoded_frames = max_decoded_frames
+        self.frame_aggregation = frame_aggregation
+        # Cached predictions of the archive by CRC32 of the video snippet
+        self.cached_predictions = {}
+        if prediction_cache is not None:
+            self.cached_predictions = prediction_cache.get_archive(archive)
+        # Exceptions of failed encodes by day dance id
+        self.failures: Dict[str, BaseException] = {}
+
+    def read(self, item):
+        count, video_filename = item
+        # Find matching metadata file
+        metadata_filename = video_filename.replace("frames.apng", "waggle.json")
+        start = time.perf_counter()
+        with self.timings.time("read.zip_io"):
+            metadata = self.zip_file.read(metadata_filename)
+        with self.timings.time("read.json"):
+            json_data: MetadataJson = json.loads(metadata)
+        return [
+            {
+                "day_dance_id": f"{count:04d}",
+                "video_filename": video_filename,
+                "json_data": json_data,
+                "start": start,
+            }
+        ]
+
+    def filter(self, detection):
+        json_data = detection["json_data"]
+        day_dance_id = detection["day_dance_id"]
+        # We only care about waggles, so filter the rest out. Also, the model
+        # thinks the bright pixels of the wooden frame on the comb are tags,
+        # so we ignore those detections.
+        if json_data["predicted_class_label"] != "waggle":
+            self.progress.update()
+            return []
+        with self.timings.time("filter.wood"):
+            is_wood = self.marker_index.is_wood_in_frame(json_data)
+        if is_wood:
+            self.progress.update()
+            return []
+        if day_dance_id in self.journal.encoded:
+            self.progress.update()
+            return []
+        if day_dance_id in self.journal.classified:
+            # Classified in a previous run, but the video still needs to be
+            # encoded.
+            entry = self.journal.classified[day_dance_id]
+            detection["prediction"] = entry["prediction"]
+            detection["confidence"] = entry["confidence"]
+            return [detection]
+        crc32 = self.zip_file.getinfo(detection["video_filename"]).CRC
+        detection["crc32"] = crc32
+        if crc32 in self.cached_predictions:
+            prediction, confidence, _ = self.cached_predictions[crc32]
+            detection["prediction"] = prediction
+            detection["confidence"] = confidence
+        return [detection]
+
+    def decode(self, detection):
+        # The whole snippet is needed for the encoder, so it is read once and
+        # the frames are decoded from the bytes.
+        with self.timings.time("decode.zip_io"):
+            detection["video"] = self.zip_file.read(detection["video_filename"])
+        if "prediction" in detection:
+            return [detection]
+        with self.timings.time("decode.image"):
+            if self.num_frames > 1:
+                detection["cropped_frames"] = decode_frames_center(
+                    detection["video"],
+                    image_size,
+                    image_size,
+                    self.num_frames,
+                    self.max_decoded_frames,
+                )
+            else:
+                detection["cropped_image"] = decode_first_frame_center(
+                    io.BytesIO(detection["video"]), image_size, image_size
+                )
+        return [detection]
+
+    def classify(self, detections):
+        unclassified = [
+            detection for detection in detections if "prediction" not in detection
+        ]
+        if not unclassified:
+            return detections
+        if self.num_frames > 1:
+            predictions, confidences, tagged_probabilities = (
+                self.classifier.classify_frame_stacks(
+                    [detection.pop("cropped_frames") for detection in unclassified],
+                    self.frame_aggregation,
+                )
+            )
+        else:
+            predictions, confidences, tagged_probabilities = (
+                self.classifier.classify_images(
+                    [detection.pop("cropped_image") for detection in unclassified]
+                )
+            )
+        if self.prediction_cache is not None:
+            self.prediction_cache.put_many(
+                self.archive,
+                [detection["crc32"] for detection in unclassified],
+                predictions,
+                confidences,
+                tagged_probabilities,
+            )
+        for detection, prediction, confidence in zip(
+            unclassified, predictions, confidences
+        ):
+            detection["prediction"] = prediction
+            detection["confidence"] = confidence
+        return detections
+
+    def encode(self, detection):
+        day_dance_id = detection["day_dance_id"]
+        # Because we don't want to keep the nested directory structure which
+        # the files within the zip file are in, the video is saved under a new
+        # name, i.e. "12/44/8/frames.apng" -> "0001.mp4". This leads to a flat
+        # directory structure.
+        if class_labels[detection["prediction"]] == TagStatus.tagged.name:
+            output = self.staging_dir / TAGGED_DANCE_DIR / (day_dance_id + ".mp4")
+        else:
+            output = self.staging_dir / UNTAGGED_DANCE_DIR / (day_dance_id + ".mp4")
+        try:
+            encode_video(detection.pop("video"), output, self.encode_threads)
+        except Exception as e:
+            self.failures[day_dance_id] = e
+            self.progress.update()
+            return []
+        return [detection]
+
+    def write(self, detection):
+        json_data = detection["json_data"]
+        day_dance_id = detection["day_dance_id"]
+        if day_dance_id not in self.journal.classified:
+            self.journal.record_classified(
+                day_dance_id,
+                json_data["waggle_id"],
+                detection["prediction"],
+                detection["confidence"],
+                json_data["predicted_class_label"],
+            )
+        self.journal.record_encoded(day_dance_id)
+        self.progress.update()
+        # Time from reading the metadata to recording the encoded video
+        self.timings.record("detection", time.perf_counter() - detection["start"])
+        return []
 
 
 class MyArgs(argparse.Namespace):
     zipped_wdd_data_dir: Path
     wdd_markers_path: Path
     output_dir: Path
+    batch_size: int
+    encode_jobs: int
+    encode_threads: Optional[int]
+    workers: int
+    torch_threads: Optional[int]
+    backend: str
+    model_variant: str
+    stage_workers: List[str]
+    queue_size: int
+    watch: bool
+    poll_interval: float
+    active_hours: float
+    prediction_cache: Path
+    no_prediction_cache: bool
+    max_prediction_cache_mb: float
+    report: Optional[Path]
+    profile_day: Optional[str]
+    num_frames: int
+    max_decoded_frames: int
+    frame_aggregation: str
 
 
 def init_argparse() -> argparse.ArgumentParser:
@@ -227,6 +807,126 @@ def init_argparse() -> argparse.ArgumentParser:
         type=Path,
         help="path to output directory",
     )
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=64,
+        help="number of detections that are classified together in one forward pass (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--encode_jobs",
+        type=int,
+        default=4,
+        help="number of ffmpeg processes that encode videos concurrently, i.e. workers of the encode stage (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--encode_threads",
+        type=int,
+        default=None,
+        help="number of threads per ffmpeg process (default: chosen by ffmpeg)",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="number of processes that process day archives in parallel, each with its own --encode_jobs (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--torch_threads",
+        type=int,
+        default=None,
+        help="number of torch intra-op threads per process (default: number of CPUs divided by --workers)",
+    )
+    parser.add_argument(
+        "--backend",
+        choices=backends,
+        default="torch",
+        help="backend to classify with, the numpy backend loads the same weights without importing torch, which makes worker processes start faster and use less memory (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--model_variant",
+        choices=model_variants,
+        default="fp32",
+        help="variant of the model to classify with, the torchscript and int8 variants have to be exported with cnn_classifier/export.py first and require --backend torch (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--num_frames",
+        type=int,
+        default=1,
+        help="number of evenly spaced frames of each video snippet that are classified together and aggregated, 1 classifies the first frame only (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--max_decoded_frames",
+        type=int,
+        default=16,
+        help="maximum number of frames that are decoded per video snippet with --num_frames, caps the decoding cost (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--frame_aggregation",
+        choices=frame_aggregations,
+        default="mean",
+        help="aggregation of the predictions of the frames with --num_frames: the mean probability or the maximum tagged probability (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--stage_workers",
+        action="append",
+        default=[],
+        metavar="STAGE=N",
+        help=f"number of worker threads of a pipeline stage, one of {', '.join(STAGES)}, can be repeated (default: 2 for decode, --encode_jobs for encode, 1 otherwise)",
+    )
+    parser.add_argument(
+        "--queue_size",
+        type=int,
+        default=64,
+        help="maximum number of detections waiting in front of each pipeline stage (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="keep running and process new or grown zip archives as soon as they are complete, i.e. their size and modification time are stable between two polls and they can be opened",
+    )
+    parser.add_argument(
+        "--poll_interval",
+        type=float,
+        default=60,
+        help="seconds between two polls of the zip archives in watch mode (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--active_hours",
+        type=float,
+        default=48,
+        help="in watch mode, processed zip archives are only checked for growth if they were modified within this many hours (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--prediction_cache",
+        type=Path,
+        default=DEFAULT_CACHE_PATH,
+        help="path to the SQLite database that caches predictions across runs, keyed by archive, CRC32 of the video snippet and hash of the model weights (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--no_prediction_cache",
+        action="store_true",
+        help="decode and classify all detections without using the prediction cache",
+    )
+    parser.add_argument(
+        "--max_prediction_cache_mb",
+        type=float,
+        default=DEFAULT_MAX_BYTES / 1024**2,
+        help="size in MiB above which the least recently used predictions are evicted from the prediction cache (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--report",
+        type=Path,
+        default=None,
+        help="path to a JSONL file to write a run report to: the per-stage timings, detections per second and p50/p99 latencies of every day, and a summary in the last line",
+    )
+    parser.add_argument(
+        "--profile_day",
+        type=str,
+        default=None,
+        metavar="DATE",
+        help="sample the call stacks of all threads while processing this day, e.g. 2024-09-02, and write them next to --report in the collapsed format of flamegraph.pl",
+    )
     return parser
 
 
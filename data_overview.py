@@ -1,14 +1,17 @@
 import argparse
 import json
 import sys
+import time
 from pathlib import Path
 from typing import Optional
 from zipfile import ZipFile
 
 from tqdm import tqdm
 
-from daily_data_processing import is_wood_in_frame, validate_csv_path
+from cnn_classifier.hyperparameters import image_size
+from utils.instrumentation import DayTimings, RunReport, profile_path, sample_stacks
 from utils.metadata_types import MetadataJson
+from utils.wood_filter import MarkerIndex, validate_csv_path
 
 
 def main():
@@ -33,50 +36,93 @@ def main():
         except Exception as e:
             print(f"Error: {e}", file=sys.stderr)
             sys.exit(1)
+        marker_index = MarkerIndex.from_csv(wdd_markers_path, image_size)
+    if args.profile_day is not None and args.report is None:
+        parser.error("--profile_day requires --report to be set")
 
+    report = None if args.report is None else RunReport(args.report)
     data = dict()
     zip_files = sorted(list(zipped_wdd_data_dir.rglob("*")))
     for zip_path in tqdm(zip_files):
         if not zip_path.suffix == ".zip":
             continue
-        predicted_class_labels = ["waggle", "activating", "ventilating", "other"]
-        day_data = {
-            label: {
-                "detections": 0,
-                "videos": 0,
-                **({"wood filter": 0} if apply_woodfilter else {}),
-            }
-            for label in predicted_class_labels
-        }
-        with ZipFile(zip_path) as zip_file:
-            files = zip_file.namelist()
-            metadata_filenames = list(
-                filter(lambda filename: filename.endswith(".json"), files)
-            )
-            for metadata_filename in tqdm(metadata_filenames):
-                with zip_file.open(metadata_filename) as metadata_file:
-                    json_data: MetadataJson = json.load(metadata_file)
-                label = json_data["predicted_class_label"]
-                day_data[label]["detections"] += 1
-                if apply_woodfilter and is_wood_in_frame(json_data, wdd_markers_path):
-                    day_data[label]["wood filter"] += 1
-
-                # find matching video file
-                video_filename = metadata_filename.replace("waggle.json", "frames.apng")
-                if video_filename in files:
-                    day_data[label]["videos"] += 1
         date_str = zip_path.stem
-        data[date_str] = day_data
+        timings = DayTimings(date_str)
+        stacks_path = None
+        if date_str == args.profile_day:
+            stacks_path = profile_path(args.report, date_str)
+        start = time.perf_counter()
+        with sample_stacks(stacks_path):
+            data[date_str] = get_day_overview(
+                zip_path, marker_index if apply_woodfilter else None, timings
+            )
+        timings.seconds = time.perf_counter() - start
+        if report is not None:
+            report.add_day(timings)
+    if report is not None:
+        report.close()
     output_path = Path.cwd() / "output" / "data_overview.json"
     output_path.parent.mkdir(parents=True, exist_ok=True)
     with output_path.open("w") as file:
         json.dump(data, file, indent=2)
 
 
+def get_day_overview(
+    zip_path: Path, marker_index: Optional[MarkerIndex], timings: DayTimings
+):
+    """
+    Counts the detections and video snippets of one zip archive per predicted
+    class label, and the detections with wood in the frame if a marker index
+    is given.
+    """
+    predicted_class_labels = ["waggle", "activating", "ventilating", "other"]
+    day_data = {
+        label: {
+            "detections": 0,
+            "videos": 0,
+            **({"wood filter": 0} if marker_index is not None else {}),
+        }
+        for label in predicted_class_labels
+    }
+    with ZipFile(zip_path) as zip_file:
+        with timings.time("zip_io"):
+            files = zip_file.namelist()
+        metadata_filenames = list(
+            filter(lambda filename: filename.endswith(".json"), files)
+        )
+        timings.detections = len(metadata_filenames)
+        metadata = []
+        for metadata_filename in tqdm(metadata_filenames):
+            with timings.time("zip_io"):
+                raw_metadata = zip_file.read(metadata_filename)
+            with timings.time("json"):
+                json_data: MetadataJson = json.loads(raw_metadata)
+            metadata.append(json_data)
+            label = json_data["predicted_class_label"]
+            day_data[label]["detections"] += 1
+
+            # find matching video file
+            video_filename = metadata_filename.replace("waggle.json", "frames.apng")
+            if video_filename in files:
+                day_data[label]["videos"] += 1
+        if marker_index is not None:
+            with timings.time("wood_filter", len(metadata)):
+                is_wood = marker_index.wood_mask(
+                    [json_data["timestamp_begin"] for json_data in metadata],
+                    [json_data["roi_center"] for json_data in metadata],
+                )
+            for json_data, wood in zip(metadata, is_wood):
+                if wood:
+                    day_data[json_data["predicted_class_label"]]["wood filter"] += 1
+    return day_data
+
+
 class MyArgs(argparse.Namespace):
     zipped_wdd_data_dir: Path
     woodfilter: Optional[bool]
     wdd_markers_path: Optional[Path]
+    report: Optional[Path]
+    profile_day: Optional[str]
 
 
 def init_argparse() -> argparse.ArgumentParser:
@@ -100,6 +146,19 @@ def init_argparse() -> argparse.ArgumentParser:
         type=Path,
         help="path to CSV file required by the wood filter, contains coordinates of the markers at the corners of the comb",
     )
+    parser.add_argument(
+        "--report",
+        type=Path,
+        default=None,
+        help="path to a JSONL file to write a run report to: the per-stage timings, detections per second and p50/p99 latencies of every day, and a summary in the last line",
+    )
+    parser.add_argument(
+        "--profile_day",
+        type=str,
+        default=None,
+        metavar="DATE",
+        help="sample the call stacks while processing this day, e.g. 2024-09-02, and write them next to --report in the collapsed format of flamegraph.pl",
+    )
     return parser
 
 
@@ -3,8 +3,6 @@ import json
 from pathlib import Path
 
 import numpy as np
-import pandas as pd
-import sklearn
 
 
 def main():
@@ -18,24 +16,18 @@ def main():
     parser = init_argparse()
     args: MyArgs = parser.parse_args(namespace=MyArgs())
     classified_data_dir = args.classified_data_dir
+    # Imported after parsing the arguments, so that --help is fast.
+    import pandas as pd
 
-    results = {
-        "total": {
-            "confusion_matrix": {
-                "true_positive": 0,
-                "true_negative": 0,
-                "false_positive": 0,
-                "false_negative": 0,
-            }
-        }
-    }
-    tagged_probabilities_total = []
-    y_true_total = []
-    y_pred_total = []
-    dirs = sorted(classified_data_dir.glob("*"))
+    from utils.metrics import BinaryMetrics
+
+    results = {}
+    day_metrics = []
+    # Hidden directories hold days that are still being processed.
+    dirs = sorted(
+        dir for dir in classified_data_dir.glob("*") if not dir.name.startswith(".")
+    )
     for dir in dirs:
-        tagged_probabilities = []
-        y_true = []
         data = pd.read_csv(
             dir / "data.csv",
             dtype={
@@ -52,92 +44,54 @@ def main():
             na_filter=False,
         )
 
-        true_positives = data.loc[
-            (data["category_label"] == "tagged")
-            & (data["corrected_category_label"] == "")
-        ]
-        for _, row in true_positives.iterrows():
-            tagged_probabilities.append(row["confidence"])
-            y_true.append(1)
-
-        true_negatives = data.loc[
-            (data["category_label"] == "untagged")
-            & (data["corrected_category_label"] == "")
-        ]
-        for _, row in true_negatives.iterrows():
-            tagged_probabilities.append(1 - row["confidence"])
-            y_true.append(0)
-
-        false_positives = data.loc[
-            (data["category_label"] == "tagged")
-            & (data["corrected_category_label"] == "untagged")
-        ]
-        for _, row in false_positives.iterrows():
-            tagged_probabilities.append(row["confidence"])
-            y_true.append(0)
-
-        false_negatives = data.loc[
-            (data["category_label"] == "untagged")
-            & (data["corrected_category_label"] == "tagged")
-        ]
-        for _, row in false_negatives.iterrows():
-            tagged_probabilities.append(1 - row["confidence"])
-            y_true.append(1)
-
-        confusion_matrix = {
-            "true_positive": true_positives.shape[0],
-            "true_negative": true_negatives.shape[0],
-            "false_positive": false_positives.shape[0],
-            "false_negative": false_negatives.shape[0],
-        }
-
-        tp = confusion_matrix["true_positive"]
-        fp = confusion_matrix["false_positive"]
-        fn = confusion_matrix["false_negative"]
-        tn = confusion_matrix["true_negative"]
-
-        y_pred = tp * [1] + fp * [1] + fn * [0] + tn * [0]
-
-        precision = sklearn.metrics.precision_score(
-            y_true, y_pred, zero_division=np.nan
+        predicted_tagged = data["category_label"] == "tagged"
+        predicted_untagged = data["category_label"] == "untagged"
+        uncorrected = data["corrected_category_label"] == ""
+        # True positives and negatives weren't corrected, false positives and
+        # negatives were corrected to the other label.
+        true_positives = predicted_tagged & uncorrected
+        true_negatives = predicted_untagged & uncorrected
+        false_positives = predicted_tagged & (
+            data["corrected_category_label"] == "untagged"
+        )
+        false_negatives = predicted_untagged & (
+            data["corrected_category_label"] == "tagged"
         )
-        recall = sklearn.metrics.recall_score(y_true, y_pred, zero_division=np.nan)
-        f1_score = sklearn.metrics.f1_score(y_true, y_pred, zero_division=np.nan)
-        roc_auc_score = sklearn.metrics.roc_auc_score(y_true, tagged_probabilities)
+        evaluated = true_positives | true_negatives | false_positives | false_negatives
+        confidence = data["confidence"].to_numpy(dtype=np.float64)
+        tagged_probabilities = np.where(
+            predicted_tagged.to_numpy(dtype=bool), confidence, 1 - confidence
+        )
+
+        metrics = BinaryMetrics()
+        metrics.update(
+            (true_positives | false_negatives)[evaluated].to_numpy(dtype=bool),
+            predicted_tagged[evaluated].to_numpy(dtype=bool),
+            tagged_probabilities[evaluated.to_numpy(dtype=bool)],
+        )
+        day_metrics.append(metrics)
 
+        recall = metrics.recall()
+        roc_auc_score = metrics.roc_auc_score()
         results[dir.name] = dict(
-            confusion_matrix=confusion_matrix,
-            precision=precision,
+            confusion_matrix=metrics.confusion_matrix(),
+            precision=metrics.precision(),
             recall=recall if not np.isnan(recall) else "NaN",
-            f1_score=f1_score,
+            f1_score=metrics.f1_score(),
             roc_auc_score=roc_auc_score if not np.isnan(roc_auc_score) else "NaN",
         )
 
-        results["total"]["confusion_matrix"]["true_positive"] += tp
-        results["total"]["confusion_matrix"]["true_negative"] += tn
-        results["total"]["confusion_matrix"]["false_positive"] += fp
-        results["total"]["confusion_matrix"]["false_negative"] += fn
-
-        y_pred_total += y_pred
-        y_true_total += y_true
-        tagged_probabilities_total += tagged_probabilities
-
-    precision_total = sklearn.metrics.precision_score(
-        y_true_total, y_pred_total, zero_division=np.nan
-    )
-    recall_total = sklearn.metrics.recall_score(
-        y_true_total, y_pred_total, zero_division=np.nan
-    )
-    f1_score_total = sklearn.metrics.f1_score(
-        y_true_total, y_pred_total, zero_division=np.nan
-    )
-    roc_auc_score_total = sklearn.metrics.roc_auc_score(
-        y_true_total, tagged_probabilities_total
-    )
-    results["total"]["precision"] = precision_total
-    results["total"]["recall"] = recall_total
-    results["total"]["f1_score"] = f1_score_total
-    results["total"]["roc_auc_score"] = roc_auc_score_total
+    total = BinaryMetrics.merged(day_metrics)
+    results = {
+        "total": dict(
+            confusion_matrix=total.confusion_matrix(),
+            precision=total.precision(),
+            recall=total.recall(),
+            f1_score=total.f1_score(),
+            roc_auc_score=total.roc_auc_score(),
+        ),
+        **results,
+    }
 
     output_path = Path.cwd() / "output" / "classifier_results.json"
     output_path.parent.mkdir(parents=True, exist_ok=True)
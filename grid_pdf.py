@@ -1,32 +1,62 @@
 import argparse
 import re
 from pathlib import Path
+from typing import TYPE_CHECKING, Optional
 
-import matplotlib.pyplot as plt
 import numpy as np
-import pandas as pd
-from matplotlib.backends.backend_pdf import PdfPages
-from PIL import Image
+from tqdm import tqdm
 
-from cnn_classifier.inference import TaggedBeeClassifierConvNet, class_labels
+from cnn_classifier.classification import (
+    ImageClassifier,
+    backends,
+    class_labels,
+    load_classifier,
+)
+from utils.crop_store import CropStore, crop_filename
+from utils.prediction_cache import DEFAULT_CACHE_PATH, PredictionCache
+
+if TYPE_CHECKING:
+    import pandas as pd
 
 
 def main():
     parser = init_argparse()
     args: MyArgs = parser.parse_args(namespace=MyArgs())
+    # Imported after parsing the arguments, so that --help is fast.
+    import pandas as pd
+
     cropped_image_dir = Path(args.cropped_image_dir)
     output_dir = Path(args.output_dir)
-    classifier = TaggedBeeClassifierConvNet("output/model.pth")
-    data = run_classifier_on_all(classifier, cropped_image_dir)
+    classifier = load_classifier("output/model.pth", args.backend)
+    if CropStore.exists(cropped_image_dir):
+        with CropStore(cropped_image_dir) as store:
+            data = run_classifier_on_store(classifier, store)
+            generate_plots_pdfs(pd.DataFrame.from_dict(data), output_dir, store)
+        return
+    cache = None
+    if not args.no_prediction_cache:
+        cache = PredictionCache(args.prediction_cache, classifier.weights_path)
+    data = run_classifier_on_all(
+        classifier, cropped_image_dir, cache, args.decode_workers
+    )
     data = pd.DataFrame.from_dict(data)
     generate_plots_pdfs(data, output_dir)
 
 
-def generate_plots_pdfs(df: pd.DataFrame, output_dir: Path):
+def generate_plots_pdfs(
+    df: "pd.DataFrame", output_dir: Path, store: Optional[CropStore] = None
+):
     """
     Creates a multi-page PDF containing a grid of cropped images sorted by tag
-    status and the model's confidence.
+    status and the model's confidence. If a crop store is given, the images
+    are taken from it by their store index instead of being opened.
     """
+    # Imported when plotting, so that --help is fast.
+    import matplotlib.pyplot as plt
+    import pandas as pd
+    from matplotlib.backends.backend_pdf import PdfPages
+    from PIL import Image
+
     df = df.sort_values(by=["class", "confidence"])
     count = df.shape[0]
     plots_per_page = 50
@@ -64,9 +94,12 @@ def generate_plots_pdfs(df: pd.DataFrame, output_dir: Path):
                     current_idx % cols,
                 ),
             )
-            with Image.open(str(row.get("cropped_image_path"))) as cropped_image:
-                plt.imshow(cropped_image, cmap="gray")
-                plt.axis("off")
+            if store is not None:
+                plt.imshow(store.images[row["store_index"]], cmap="gray")
+            else:
+                with Image.open(str(row.get("cropped_image_path"))) as cropped_image:
+                    plt.imshow(cropped_image, cmap="gray")
+            plt.axis("off")
         for figure in figures:
             figure.savefig(pdf_pages, format="pdf")
         pdf_pages.close()
@@ -74,35 +107,84 @@ def generate_plots_pdfs(df: pd.DataFrame, output_dir: Path):
 
 
 def run_classifier_on_all(
-    classifier: TaggedBeeClassifierConvNet, cropped_image_dir: Path
+    classifier: ImageClassifier,
+    cropped_image_dir: Path,
+    cache: Optional[PredictionCache] = None,
+    decode_workers: Optional[int] = None,
 ):
     """
-    Applies the classifier to all images in a given directory containing
-    cropped images. Uses batches.
+    Applies the classifier to all images below a given directory containing
+    cropped images, which may be flat or nested. Streams batches, which are
+    decoded by decode_workers threads. If a prediction cache is given, only
+    images that aren't cached are decoded and classified.
     """
-    predictions, confidences, paths = classifier.classify_images_from_directory(
-        cropped_image_dir, 128
-    )
-    dates = []
-    date_pattern = r"20\d{2}-\d{2}-\d{2}"
-    for path in paths:
-        date_match = re.search(date_pattern, str(path))
-        if date_match is None:
-            raise ValueError(f"Failed to extract date info from path: {path}")
-        dates.append(date_match.group(0))
+    date_pattern = re.compile(r"20\d{2}-\d{2}-\d{2}")
+    predictions, confidences, paths, dates = [], [], [], []
+    for batch_paths, batch_predictions, batch_confidences, _ in tqdm(
+        classifier.iter_classify_images(cropped_image_dir, 128, decode_workers, cache),
+        unit="batch",
+    ):
+        for path in batch_paths:
+            date_match = date_pattern.search(path)
+            if date_match is None:
+                raise ValueError(f"Failed to extract date info from path: {path}")
+            dates.append(date_match.group(0))
+        paths += batch_paths
+        predictions.append(batch_predictions)
+        confidences.append(batch_confidences)
+    predictions = np.concatenate(predictions) if predictions else np.empty(0, int)
     data = {
         "class": predictions,
         "class_label": np.array([class_labels[pred] for pred in predictions]),
-        "confidence": confidences,
-        "cropped_image_path": paths,
+        "confidence": np.concatenate(confidences)
+        if confidences
+        else np.empty(0, np.float32),
+        "cropped_image_path": np.array(paths),
         "date": np.array(dates),
     }
     return data
 
 
+def run_classifier_on_store(
+    classifier: ImageClassifier, store: CropStore, batch_size: int = 1024
+):
+    """
+    Applies the classifier to the crops of a crop store, in batches that are
+    views of the store. The path of a crop is the path of the PNG file that
+    scripts/crop_images.py would write to the store directory.
+    """
+    predictions = np.empty(len(store), dtype=int)
+    confidences = np.empty(len(store), dtype=np.float32)
+    for start, images in tqdm(
+        store.batches(batch_size), total=-(-len(store) // batch_size), unit="batch"
+    ):
+        (
+            predictions[start : start + len(images)],
+            confidences[start : start + len(images)],
+            _,
+        ) = classifier.classify_batch(images)
+    return {
+        "class": predictions,
+        "class_label": np.array([class_labels[pred] for pred in predictions]),
+        "confidence": confidences,
+        "cropped_image_path": np.array(
+            [
+                str(store.path / record.archive / crop_filename(record.member))
+                for record in store.records
+            ]
+        ),
+        "date": np.array([record.date for record in store.records]),
+        "store_index": np.arange(len(store)),
+    }
+
+
 class MyArgs(argparse.Namespace):
     cropped_image_dir: Path
     output_dir: Path
+    prediction_cache: Path
+    no_prediction_cache: bool
+    backend: str
+    decode_workers: Optional[int]
 
 
 def init_argparse() -> argparse.ArgumentParser:
@@ -114,13 +196,36 @@ def init_argparse() -> argparse.ArgumentParser:
     parser.add_argument(
         "cropped_image_dir",
         type=Path,
-        help="path to directory containing cropped images",
+        help="path to directory containing cropped images, or to a crop store written by scripts/crop_images.py --store, which is classified without the prediction cache",
     )
     parser.add_argument(
         "output_dir",
         type=Path,
         help="path to output directory",
     )
+    parser.add_argument(
+        "--prediction_cache",
+        type=Path,
+        default=DEFAULT_CACHE_PATH,
+        help="path to the SQLite database that caches predictions across runs (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--no_prediction_cache",
+        action="store_true",
+        help="classify all images without using the prediction cache",
+    )
+    parser.add_argument(
+        "--backend",
+        choices=backends,
+        default="torch",
+        help="backend to classify with, the numpy backend doesn't import torch (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--decode_workers",
+        type=int,
+        default=None,
+        help="number of threads that decode images ahead of the classifier, 0 decodes on the main thread (default: number of CPUs)",
+    )
     return parser
 
 
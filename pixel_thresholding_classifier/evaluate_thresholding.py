@@ -1,20 +1,29 @@
 import argparse
-import datetime
 import json
 import sys
+import time
 from pathlib import Path
-from typing import Any
+from typing import Optional
 from zipfile import ZipFile
 
 import pandas as pd
-import sklearn
 from hyperparameters import image_size
 from inference import TagStatus, classify_image
-from PIL import Image
-from PIL.Image import Image as PILImage
 from tqdm import tqdm
 
+from utils.apng_decoding import decode_first_frame_center
+from utils.instrumentation import DayTimings, RunReport, profile_path, sample_stacks
 from utils.metadata_types import MetadataJson
+from utils.metrics import BinaryMetrics
+from utils.wood_filter import MarkerIndex
+
+# True label by predicted and corrected label of the data.csv file
+_TRUE_LABELS = {
+    ("tagged", ""): TagStatus.tagged,
+    ("tagged", "untagged"): TagStatus.untagged,
+    ("untagged", ""): TagStatus.untagged,
+    ("untagged", "tagged"): TagStatus.tagged,
+}
 
 
 def main():
@@ -29,12 +38,50 @@ def main():
     except Exception as e:
         print(f"Error: {e}", file=sys.stderr)
         sys.exit(1)
+    marker_index = MarkerIndex.from_csv(wdd_markers_path, image_size)
+
+    if args.profile_day is not None and args.report is None:
+        parser.error("--profile_day requires --report to be set")
 
-    y_true = []
-    y_pred = []
+    report = None if args.report is None else RunReport(args.report)
+    # Tagged is the positive class
+    metrics = BinaryMetrics(positive=TagStatus.tagged.value)
     for zip_path in tqdm(list(zipped_wdd_data_dir.rglob("*.zip"))):
         date = zip_path.stem
-        csv_path = classified_data_dir / date / "data.csv"
+        timings = DayTimings(date)
+        stacks_path = None
+        if date == args.profile_day:
+            stacks_path = profile_path(args.report, date)
+        start = time.perf_counter()
+        with sample_stacks(stacks_path):
+            day_metrics = evaluate_day(
+                zip_path, classified_data_dir / date / "data.csv", marker_index, timings
+            )
+        timings.seconds = time.perf_counter() - start
+        if report is not None:
+            report.add_day(timings)
+        metrics.merge(day_metrics)
+    if report is not None:
+        report.close()
+
+    print(f"tp: {metrics.tp}")
+    print(f"tn: {metrics.tn}")
+    print(f"fp: {metrics.fp}")
+    print(f"fn: {metrics.fn}")
+    print(f"F1 score: {metrics.f1_score()}")
+    print(metrics.classification_report(("untagged", "tagged"), digits=2))
+
+
+def evaluate_day(
+    zip_path: Path, csv_path: Path, marker_index: MarkerIndex, timings: DayTimings
+):
+    """
+    Classifies the waggles of one zip archive with the thresholding classifier.
+    Returns the metrics of the predicted labels against the true labels, taken
+    from the data.csv file of the classified day.
+    """
+    metrics = BinaryMetrics(positive=TagStatus.tagged.value)
+    with timings.time("read_csv"):
         data = pd.read_csv(
             csv_path,
             dtype={
@@ -50,148 +97,52 @@ def main():
             },
             na_filter=False,
         )
-        with ZipFile(zip_path) as zip_file:
-            video_filenames = list(
-                filter(lambda filename: filename.endswith(".apng"), zip_file.namelist())
+    with ZipFile(zip_path) as zip_file:
+        video_filenames = list(
+            filter(lambda filename: filename.endswith(".apng"), zip_file.namelist())
+        )
+        timings.detections = len(video_filenames)
+        metadata = []
+        for video_filename in video_filenames:
+            # Find matching metadata file
+            metadata_filename = video_filename.replace("frames.apng", "waggle.json")
+            with timings.time("zip_io"):
+                raw_metadata = zip_file.read(metadata_filename)
+            with timings.time("json"):
+                json_data: MetadataJson = json.loads(raw_metadata)
+            metadata.append(json_data)
+        # We only care about waggles, so filter the rest out. Also, the
+        # model thinks the bright pixels of the wooden frame on the comb
+        # are tags, so we ignore those detections.
+        with timings.time("wood_filter", len(metadata)):
+            is_wood = marker_index.wood_mask(
+                [json_data["timestamp_begin"] for json_data in metadata],
+                [json_data["roi_center"] for json_data in metadata],
             )
-            for video_filename in tqdm(video_filenames):
-                # Find matching metadata file
-                metadata_filename = video_filename.replace("frames.apng", "waggle.json")
-                with zip_file.open(metadata_filename) as metadata_file:
-                    json_data: MetadataJson = json.load(metadata_file)
-                # We only care about waggles, so filter the rest out. Also,
-                # the model thinks the bright pixels of the wooden frame on
-                # the comb are tags, so we ignore those detections.
-                if json_data["predicted_class_label"] != "waggle" or is_wood_in_frame(
-                    json_data=json_data, wdd_markers_path=wdd_markers_path
-                ):
-                    continue
+        for video_filename, json_data, wood in zip(
+            tqdm(video_filenames), metadata, is_wood
+        ):
+            if json_data["predicted_class_label"] != "waggle" or wood:
+                continue
+            with timings.time("decode"):
                 with zip_file.open(video_filename) as video_file:
-                    with Image.open(video_file) as image:
-                        cropped_image = crop_center(
-                            image=image,
-                            output_width=image_size,
-                            output_height=image_size,
-                        )
-                        label_enum = classify_image(cropped_image)
-                        label = label_enum.name
-                if label == TagStatus.tagged.name:
-                    y_pred.append(TagStatus.tagged.value)
-                else:
-                    y_pred.append(TagStatus.untagged.value)
-                current_sample = data.loc[
-                    data["waggle_id"] == str(json_data["waggle_id"])
-                ]
-                current_sample.reset_index(drop=True, inplace=True)
-                if (
-                    current_sample.at[0, "category_label"] == "tagged"
-                    and current_sample.at[0, "corrected_category_label"] == ""
-                ):
-                    y_true.append(TagStatus.tagged.value)
-                elif (
-                    current_sample.at[0, "category_label"] == "tagged"
-                    and current_sample.at[0, "corrected_category_label"] == "untagged"
-                ):
-                    y_true.append(TagStatus.untagged.value)
-                elif (
-                    current_sample.at[0, "category_label"] == "untagged"
-                    and current_sample.at[0, "corrected_category_label"] == ""
-                ):
-                    y_true.append(TagStatus.untagged.value)
-                elif (
-                    current_sample.at[0, "category_label"] == "untagged"
-                    and current_sample.at[0, "corrected_category_label"] == "tagged"
-                ):
-                    y_true.append(TagStatus.tagged.value)
-
-    # Invert labels because sklearn assumes 1 is positive and 0 is negative result
-    y_pred_inversed = [1 if y == TagStatus.tagged.value else 0 for y in y_pred]
-    y_true_inversed = [1 if y == TagStatus.tagged.value else 0 for y in y_true]
-
-    tn, fp, fn, tp = sklearn.metrics.confusion_matrix(
-        y_true_inversed, y_pred_inversed
-    ).ravel()
-    print(f"tp: {tp}")
-    print(f"tn: {tn}")
-    print(f"fp: {fp}")
-    print(f"fn: {fn}")
-    f1_score = sklearn.metrics.f1_score(y_true_inversed, y_pred_inversed)
-    print(f"F1 score: {f1_score}")
-    print(
-        sklearn.metrics.classification_report(
-            y_true_inversed, y_pred_inversed, digits=2
-        )
-    )
-
-
-def is_wood_in_frame(json_data: Any, wdd_markers_path: Path):
-    """
-    Estimates whether the cropped image of the corresponding dance shows a part
-    of the wooden frame on the comb based on the position of the dance.
-    """
-    df_markers_wdd = pd.read_csv(wdd_markers_path)
-    wdd_markers = get_marker_coordinates_by_timestamp(
-        detection_timestamp=json_data["timestamp_begin"],
-        df_markers=df_markers_wdd,
-    )
-    if wdd_markers is None:
-        return False
-
-    # Values were determined from a single wdd image.
-    wood_offset_x = 100
-    wood_offset_top = 80
-    wood_offset_bot = 220
-
-    # These borders span an area on the comb that is within the wooden frame.
-    border_left = max(
-        [wdd_markers[0][0] + wood_offset_x, wdd_markers[2][0] + wood_offset_x]
-    )
-    border_top = max(
-        [wdd_markers[0][1] + wood_offset_top, wdd_markers[1][1] + wood_offset_top]
-    )
-    border_right = min(
-        [wdd_markers[1][0] - wood_offset_x, wdd_markers[3][0] - wood_offset_x]
-    )
-    border_bot = min(
-        [wdd_markers[2][1] - wood_offset_bot, wdd_markers[3][1] - wood_offset_bot]
-    )
-
-    center_x, center_y = json_data["roi_center"]
-    # Correct the -125 offset of the roi coordinates in the metadata
-    correction_offset = 125
-    center_x += correction_offset
-    center_y += correction_offset
-
-    # Apply offset to account for size of cropped image that the model works on
-    frame_offset = image_size // 2
-    return (
-        center_x - frame_offset <= border_left
-        or center_x + frame_offset >= border_right
-        or center_y - frame_offset <= border_top
-        or center_y + frame_offset >= border_bot
-    )
-
-
-def crop_center(image: PILImage, output_width: int, output_height: int):
-    image_width, image_height = image.size
-    left = (image_width - output_width) // 2
-    top = (image_height - output_height) // 2
-    return image.crop((left, top, left + output_width, top + output_height))
-
-
-def get_marker_coordinates_by_timestamp(detection_timestamp, df_markers):
-    """Gives the most recent marker coordinates from before the dance detection."""
-    df_markers["timestamp"] = pd.to_datetime(df_markers["timestamp"])
-    marker_timestamps = sorted(df_markers["timestamp"].unique())
-    timestamp_to_show = None
-    for marker_timestamp in marker_timestamps:
-        if marker_timestamp <= datetime.datetime.fromisoformat(detection_timestamp):
-            timestamp_to_show = marker_timestamp
-    if timestamp_to_show is None:
-        return None
-    dfsel = df_markers.loc[df_markers["timestamp"] == timestamp_to_show]
-    marker_coords = [(row["x"], row["y"]) for _, row in dfsel.iterrows()]
-    return marker_coords
+                    cropped_image = decode_first_frame_center(
+                        video_file, output_width=image_size, output_height=image_size
+                    )
+            with timings.time("classify"):
+                label_enum = classify_image(cropped_image)
+            current_sample = data.loc[data["waggle_id"] == str(json_data["waggle_id"])]
+            current_sample.reset_index(drop=True, inplace=True)
+            true_label = _TRUE_LABELS.get(
+                (
+                    current_sample.at[0, "category_label"],
+                    current_sample.at[0, "corrected_category_label"],
+                )
+            )
+            # Detections without a true label are not counted.
+            if true_label is not None:
+                metrics.update(true_label.value, label_enum.value)
+    return metrics
 
 
 def validate_csv_path(path: Path) -> None:
@@ -207,6 +158,8 @@ class MyArgs(argparse.Namespace):
     zipped_wdd_data_dir: Path
     wdd_markers_path: Path
     classified_data_dir: Path
+    report: Optional[Path]
+    profile_day: Optional[str]
 
 
 def init_argparse() -> argparse.ArgumentParser:
@@ -233,6 +186,19 @@ def init_argparse() -> argparse.ArgumentParser:
             "been classified and processed into a Label GUI compatible structure"
         ),
     )
+    parser.add_argument(
+        "--report",
+        type=Path,
+        default=None,
+        help="path to a JSONL file to write a run report to: the per-stage timings, detections per second and p50/p99 latencies of every day, and a summary in the last line",
+    )
+    parser.add_argument(
+        "--profile_day",
+        type=str,
+        default=None,
+        metavar="DATE",
+        help="sample the call stacks while processing this day, e.g. 2024-09-02, and write them next to --report in the collapsed format of flamegraph.pl",
+    )
     return parser
 
 
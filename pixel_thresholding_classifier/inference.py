@@ -18,8 +18,6 @@ def classify_image(image, threshold_value: int = threshold_value) -> TagStatus:
 
 @classify_image.register(np.ndarray)
 def _(image: np.ndarray, threshold_value: int = threshold_value) -> TagStatus:
-    print(image.shape)
-    print(threshold_value)
     for i in range(image.shape[0]):
         for j in range(image.shape[1]):
             if image[i, j] > threshold_value:
@@ -1,11 +1,11 @@
 from pathlib import Path
 
 import cv2
-import sklearn
 
 from hyperparameters import threshold_value
 from inference import TagStatus, classify_image
 from train import Evaluation
+from utils.metrics import BinaryMetrics
 
 TEST_PATH = Path.cwd() / "data" / "cropped" / "50x50" / "test"
 
@@ -18,22 +18,19 @@ def main():
 def evaluate_test_images(image_dir: Path, threshold_value: int = threshold_value):
     mistake_count = 0
     image_paths = list(image_dir.rglob("*.png"))
-    y_true = []
-    y_pred = []
+    # Tagged is the positive class
+    metrics = BinaryMetrics(positive=TagStatus.tagged.value)
     for image_path in image_paths:
         if "/tagged/" in str(image_path):
-            y_true.append(TagStatus.tagged.value)
+            true_label = TagStatus.tagged.value
         else:
-            y_true.append(TagStatus.untagged.value)
+            true_label = TagStatus.untagged.value
 
         image = cv2.imread(str(image_path), cv2.IMREAD_GRAYSCALE)
         label_enum = classify_image(image, threshold_value)
         label = label_enum.name
         print(label)
-        if label == TagStatus.tagged.name:
-            y_pred.append(TagStatus.tagged.value)
-        else:
-            y_pred.append(TagStatus.untagged.value)
+        metrics.update(true_label, label_enum.value)
         if (
             label == TagStatus.tagged.name
             and "/tagged/" not in str(image_path)
@@ -42,24 +39,12 @@ def evaluate_test_images(image_dir: Path, threshold_value: int = threshold_value
         ):
             mistake_count += 1
 
-    # Invert labels because sklearn assumes 1 is positive and 0 is negative result
-    y_pred_inversed = [1 if y == TagStatus.tagged.value else 0 for y in y_pred]
-    y_true_inversed = [1 if y == TagStatus.tagged.value else 0 for y in y_true]
-
-    tn, fp, fn, tp = sklearn.metrics.confusion_matrix(
-        y_true_inversed, y_pred_inversed
-    ).ravel()
-    print(f"tp: {tp}")
-    print(f"tn: {tn}")
-    print(f"fp: {fp}")
-    print(f"fn: {fn}")
-    f1_score = sklearn.metrics.f1_score(y_true_inversed, y_pred_inversed)
-    print(f"F1 score: {f1_score}")
-    print(
-        sklearn.metrics.classification_report(
-            y_true_inversed, y_pred_inversed, digits=2
-        )
-    )
+    print(f"tp: {metrics.tp}")
+    print(f"tn: {metrics.tn}")
+    print(f"fp: {metrics.fp}")
+    print(f"fn: {metrics.fn}")
+    print(f"F1 score: {metrics.f1_score()}")
+    print(metrics.classification_report(("untagged", "tagged"), digits=2))
     total = len(image_paths)
     correct = total - mistake_count
     accuracy = 100 * correct / total
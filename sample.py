@@ -4,9 +4,13 @@ import re
 import zipfile
 from pathlib import Path
 
-from PIL import Image
-
-from cnn_classifier.inference import TaggedBeeClassifierConvNet, class_labels
+from cnn_classifier.classification import (
+    class_labels,
+    iter_image_paths,
+    load_classifier,
+)
+from utils.crop_store import CropStore, crop_filename
+from utils.prediction_cache import DEFAULT_CACHE_PATH, PredictionCache
 
 ZIPPED_WDD_PATH = Path("/mnt/trove/wdd/wdd_output_2024/cam0/")
 
@@ -14,17 +18,35 @@ ZIPPED_WDD_PATH = Path("/mnt/trove/wdd/wdd_output_2024/cam0/")
 def get_samples(cropped_images_path: Path, k=100):
     """
     Randomly samples and classifies k cropped images, then writes the results
-    to a samples.csv file.
+    to a samples.csv file. Predictions of images that were classified before
+    with the same model are taken from the prediction cache.
+
+    If cropped_images_path is a crop store, the crops are sampled by index
+    without listing any files and classified without the cache, and their
+    paths are those scripts/crop_images.py would write.
     """
-    paths = list(cropped_images_path.rglob("*"))
-    samples = random.sample(paths, k)
-    classifier = TaggedBeeClassifierConvNet("output/model.pth")
-    predictions = []
-    for sample in samples:
-        with Image.open(sample) as image:
-            prediction, confidence = classifier.classify_single_image(image)
-            predictions.append(class_labels[prediction[0]])
-    data = {"sample_path": samples, "category_label": predictions}
+    classifier = load_classifier("output/model.pth", "numpy")
+    if CropStore.exists(cropped_images_path):
+        with CropStore(cropped_images_path) as store:
+            indices = sorted(random.sample(range(len(store)), k))
+            predictions, _, _ = classifier.classify_batch(store.images[indices])
+            samples = [
+                cropped_images_path
+                / store.records[index].archive
+                / crop_filename(store.records[index].member)
+                for index in indices
+            ]
+    else:
+        # Only images, not the crop manifests of scripts/crop_images.py
+        paths = list(iter_image_paths(cropped_images_path))
+        samples = random.sample(paths, k)
+        cache = PredictionCache(DEFAULT_CACHE_PATH, classifier.weights_path)
+        predictions, _, _ = classifier.classify_image_files(samples, 128, cache)
+        cache.close()
+    data = {
+        "sample_path": samples,
+        "category_label": [class_labels[prediction] for prediction in predictions],
+    }
     dict_to_csv(data, "output/samples.csv")
 
 
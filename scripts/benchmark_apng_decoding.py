@@ -0,0 +1,80 @@
+import argparse
+import io
+import time
+from pathlib import Path
+from zipfile import ZipFile
+
+import numpy as np
+from PIL import Image
+
+from cnn_classifier.hyperparameters import image_size
+from utils.apng_decoding import decode_first_frame_center
+from utils.image_cropping import crop_center
+
+
+def main():
+    """
+    Compares the decoding time of the center crop of the first frame with PIL
+    and with the region-of-interest decoder on the APNG files of a zip archive.
+    """
+    parser = init_argparse()
+    args = parser.parse_args()
+
+    with ZipFile(args.zip_path) as zip_file:
+        video_filenames = [
+            filename for filename in zip_file.namelist() if filename.endswith(".apng")
+        ][: args.limit]
+        # Read the compressed files into memory first, so that only decoding
+        # is measured.
+        videos = [zip_file.read(filename) for filename in video_filenames]
+
+    pil_crops, pil_seconds = benchmark(videos, decode_with_pil)
+    roi_crops, roi_seconds = benchmark(videos, decode_first_frame_center)
+    mismatches = sum(
+        not np.array_equal(pil_crop, roi_crop)
+        for pil_crop, roi_crop in zip(pil_crops, roi_crops)
+    )
+
+    print(f"files: {len(videos)}")
+    print(f"PIL: {1000 * pil_seconds / len(videos):.3f} ms per file")
+    print(f"ROI decoder: {1000 * roi_seconds / len(videos):.3f} ms per file")
+    print(f"speedup: {pil_seconds / roi_seconds:.2f}x")
+    print(f"mismatching crops: {mismatches}")
+
+
+def benchmark(videos, decode):
+    crops = []
+    start = time.perf_counter()
+    for video in videos:
+        crops.append(decode(io.BytesIO(video), image_size, image_size))
+    return crops, time.perf_counter() - start
+
+
+def decode_with_pil(file, output_width: int, output_height: int):
+    with Image.open(file) as image:
+        cropped_image = crop_center(image, output_width, output_height)
+    return np.asarray(cropped_image.convert("L"))
+
+
+def init_argparse() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        description=(
+            "Compares PIL and the region-of-interest decoder on the first frames of the APNG video snippets in a zip archive"
+        ),
+    )
+    parser.add_argument(
+        "zip_path",
+        type=Path,
+        help="path to zip archive of WDD detection data",
+    )
+    parser.add_argument(
+        "--limit",
+        type=int,
+        default=1000,
+        help="maximum number of APNG files to decode (default: %(default)s)",
+    )
+    return parser
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+import argparse
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+
+from cnn_classifier.classification import iter_image_paths, to_grayscale_array
+from utils.crop_store import CropRecord, CropStore
+
+
+def main():
+    """
+    Packs the cropped images below a directory into a temporary crop store
+    and compares reading all crops from the PNG files, i.e. listing, opening
+    and decoding them, with opening the store and reading all crops from it.
+    Checks that both give the same pixels.
+    """
+    parser = init_argparse()
+    args: MyArgs = parser.parse_args(namespace=MyArgs())
+    paths = list(iter_image_paths(args.cropped_image_dir))
+    if not paths:
+        parser.error(f"found no images in {args.cropped_image_dir}")
+
+    start = time.perf_counter()
+    images = np.stack(read_png_crops(args.cropped_image_dir))
+    png_seconds = time.perf_counter() - start
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        with CropStore(Path(temp_dir), "a", images.shape[1:]) as store:
+            store.append(
+                images,
+                [
+                    CropRecord("", str(Path(path).parent), Path(path).name, "")
+                    for path in paths
+                ],
+            )
+        start = time.perf_counter()
+        with CropStore(Path(temp_dir)) as store:
+            # Sums every batch, so that all pages are actually read.
+            checksum = sum(int(batch.sum()) for _, batch in store.batches(1024))
+        store_seconds = time.perf_counter() - start
+        store_bytes = sum(path.stat().st_size for path in Path(temp_dir).iterdir())
+
+    if checksum != int(images.sum()):
+        raise AssertionError("the crop store returned other pixels than the PNG files")
+    png_bytes = sum(Path(path).stat().st_size for path in paths)
+    print(f"{len(paths)} crops of shape {images.shape[1:]}")
+    print(f"{'source':<10}  {'files':>7}  {'MB':>7}  {'seconds':>8}  {'crops/s':>10}")
+    for name, files, size, seconds in (
+        ("PNG files", len(paths), png_bytes, png_seconds),
+        ("crop store", 3, store_bytes, store_seconds),
+    ):
+        print(
+            f"{name:<10}  {files:>7}  {size / 1e6:>7.1f}  {seconds:>8.3f}  "
+            f"{len(paths) / seconds:>10.0f}"
+        )
+
+
+def read_png_crops(cropped_image_dir: Path):
+    images = []
+    for path in iter_image_paths(cropped_image_dir):
+        with Image.open(path) as image:
+            images.append(to_grayscale_array(image))
+    return images
+
+
+class MyArgs(argparse.Namespace):
+    cropped_image_dir: Path
+
+
+def init_argparse() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        description=(
+            "Compares reading cropped images from PNG files with reading them from a crop store"
+        ),
+    )
+    parser.add_argument(
+        "cropped_image_dir",
+        type=Path,
+        help="path to a directory with cropped images, e.g. written by scripts/crop_images.py",
+    )
+    return parser
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+import argparse
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+from cnn_classifier.classification import (
+    ImageClassifier,
+    backends,
+    load_classifier,
+)
+from cnn_classifier.client import InferenceClient, LocalInferenceClient
+from cnn_classifier.hyperparameters import image_size
+from cnn_classifier.server import InferenceServer
+from utils.micro_batcher import MicroBatcher
+
+
+def main():
+    """
+    Classifies random images one per request from concurrent threads through
+    an inference server on an ephemeral port and through the local stand-in
+    client. Reports the throughput, batch sizes and latencies, and checks
+    that the results match classifying all images at once. Exits with status
+    1 if they don't.
+    """
+    parser = init_argparse()
+    args: MyArgs = parser.parse_args(namespace=MyArgs())
+    classifier = load_classifier(args.model_path, args.backend)
+    rng = np.random.default_rng(args.seed)
+    images = rng.integers(
+        0, 256, (args.num_images, image_size, image_size), dtype=np.uint8
+    )
+    reference = classifier.classify_batch(images)
+
+    batcher = MicroBatcher(
+        classifier.classify_batch, args.max_batch_size, args.max_wait_ms / 1000
+    )
+    server = InferenceServer(("127.0.0.1", 0), classifier, batcher)
+    server_thread = threading.Thread(target=server.serve_forever, daemon=True)
+    server_thread.start()
+    clients = {
+        "server": InferenceClient(f"http://127.0.0.1:{server.server_address[1]}"),
+        "local": LocalInferenceClient(
+            classifier, args.max_batch_size, args.max_wait_ms / 1000
+        ),
+    }
+    failed = False
+    try:
+        for name, client in clients.items():
+            failed |= not run(name, client, images, reference, args.threads)
+    finally:
+        server.shutdown()
+        server.server_close()
+        batcher.close()
+        clients["local"].close()
+    if failed:
+        print("Error: the results differ from classifying all images at once")
+        raise SystemExit(1)
+
+
+def run(
+    name: str,
+    client: ImageClassifier,
+    images: np.ndarray,
+    reference,
+    threads: int,
+) -> bool:
+    """Classifies the images one per request, returns whether they match."""
+    # Warms up the connections and the model.
+    client.classify_single_image(images[0])
+    start = time.perf_counter()
+    with ThreadPoolExecutor(threads) as executor:
+        results = list(executor.map(client.classify_single_image, images))
+    seconds = time.perf_counter() - start
+    predictions = np.array([prediction for prediction, _ in results])
+    confidences = np.array([confidence for _, confidence in results])
+    stats = client.stats()
+    mismatches = int((predictions != reference[0]).sum())
+    difference = np.abs(confidences - reference[1]).max()
+    print(
+        f"{name}: {len(images) / seconds:.0f} images/s with {threads} threads, "
+        f"mean batch size {stats['mean_batch_size']}, "
+        f"latency p50 {stats['latency']['p50_ms']} ms, "
+        f"p99 {stats['latency']['p99_ms']} ms, "
+        f"{mismatches} mismatching predictions, "
+        f"max. confidence difference {difference:.3g}"
+    )
+    return mismatches == 0 and difference <= 1e-5
+
+
+class MyArgs(argparse.Namespace):
+    model_path: Path
+    backend: str
+    num_images: int
+    threads: int
+    max_batch_size: int
+    max_wait_ms: float
+    seed: int
+
+
+def init_argparse() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        description=(
+            "Benchmarks the inference server and the local stand-in client with concurrent single-image requests"
+        ),
+    )
+    parser.add_argument(
+        "--model_path",
+        type=Path,
+        default=Path("output/model.pth"),
+        help="path to the model weights (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--backend",
+        choices=backends,
+        default="torch",
+        help="backend to classify with (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--num_images",
+        type=int,
+        default=2000,
+        help="number of random images (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=16,
+        help="number of threads that send requests concurrently (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--max_batch_size",
+        type=int,
+        default=64,
+        help="maximum number of images that are classified together (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--max_wait_ms",
+        type=float,
+        default=2.0,
+        help="maximum time in milliseconds that a request waits for others (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=0,
+        help="seed of the random images (default: %(default)s)",
+    )
+    return parser
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,229 @@
+import argparse
+import csv
+import io
+import time
+from pathlib import Path
+from typing import List, Optional, Tuple
+from zipfile import ZipFile
+
+import numpy as np
+
+from cnn_classifier.classification import (
+    ImageClassifier,
+    TagStatus,
+    backends,
+    class_labels,
+    frame_aggregations,
+    load_classifier,
+)
+from cnn_classifier.hyperparameters import image_size
+from utils.apng_decoding import decode_first_frame_center, decode_frames_center
+from utils.metrics import BinaryMetrics
+
+
+def main():
+    """
+    Classifies the video snippets of labeled days by their first frame and by
+    K evenly spaced frames with every aggregation. For every mode, reports
+    the decoding and classification time per snippet, the throughput relative
+    to the first frame, and the accuracy, precision, recall and F1 score of
+    tagged against the labels. Like evaluate_performance.py, the label of a
+    snippet is its corrected label, or its predicted label if it wasn't
+    corrected.
+    """
+    parser = init_argparse()
+    args: MyArgs = parser.parse_args(namespace=MyArgs())
+    snippets = load_labeled_snippets(
+        args.zipped_wdd_data_dir, args.classified_data_dir, args.limit
+    )
+    if not snippets:
+        parser.error("found no labeled video snippets")
+    classifier = load_classifier(args.model_path, args.backend)
+    videos = [video for video, _ in snippets]
+    labels = np.array([label for _, label in snippets])
+    print(
+        f"{len(snippets)} snippets, {int((labels == TagStatus.tagged.value).sum())} tagged"
+    )
+    print(
+        f"{'mode':<16}  {'decode':>9}  {'classify':>9}  {'snippets/s':>10}  "
+        f"{'cost':>5}  {'accuracy':>8}  {'precision':>9}  {'recall':>6}  {'f1':>6}"
+    )
+    baseline_seconds = None
+    for num_frames in args.num_frames:
+        aggregations = ["first"] if num_frames == 1 else frame_aggregations
+        for aggregation in aggregations:
+            decode_seconds, classify_seconds, predictions = run(
+                classifier,
+                videos,
+                num_frames,
+                args.max_decoded_frames,
+                aggregation,
+                args.batch_size,
+            )
+            seconds = decode_seconds + classify_seconds
+            if baseline_seconds is None:
+                baseline_seconds = seconds
+            accuracy, precision, recall, f1 = scores(labels, predictions)
+            mode = "first frame" if num_frames == 1 else f"{num_frames} {aggregation}"
+            print(
+                f"{mode:<16}  {1000 * decode_seconds / len(videos):>6.2f} ms  "
+                f"{1000 * classify_seconds / len(videos):>6.2f} ms  "
+                f"{len(videos) / seconds:>10.0f}  {seconds / baseline_seconds:>4.1f}x  "
+                f"{accuracy:>8.3f}  {precision:>9.3f}  {recall:>6.3f}  {f1:>6.3f}"
+            )
+
+
+def load_labeled_snippets(
+    zipped_wdd_data_dir: Path, classified_data_dir: Path, limit: Optional[int] = None
+) -> List[Tuple[bytes, int]]:
+    """
+    APNG files and labels of the detections in the data.csv files of the
+    classified days whose zip archive is in zipped_wdd_data_dir.
+    """
+    zip_paths = {path.stem: path for path in zipped_wdd_data_dir.rglob("*.zip")}
+    snippets = []
+    # Hidden directories hold days that are still being processed.
+    for day_dir in sorted(classified_data_dir.glob("[!.]*")):
+        if day_dir.name not in zip_paths or not (day_dir / "data.csv").exists():
+            continue
+        with ZipFile(zip_paths[day_dir.name]) as zip_file:
+            # The day dance id counts the APNG files of the archive, see
+            # daily_data_processing.py.
+            video_filenames = [
+                name for name in zip_file.namelist() if name.endswith(".apng")
+            ]
+            with open(day_dir / "data.csv", newline="") as f:
+                for row in csv.DictReader(f):
+                    label = row["corrected_category_label"] or row["category_label"]
+                    video = zip_file.read(video_filenames[int(row["day_dance_id"]) - 1])
+                    snippets.append((video, class_labels.index(label)))
+                    if limit is not None and len(snippets) == limit:
+                        return snippets
+    return snippets
+
+
+def run(
+    classifier: ImageClassifier,
+    videos: List[bytes],
+    num_frames: int,
+    max_decoded_frames: int,
+    aggregation: str,
+    batch_size: int,
+) -> Tuple[float, float, np.ndarray]:
+    """
+    Decodes and classifies the snippets in batches like the decode and
+    classify stages of daily_data_processing.py. Returns the decoding and
+    classification seconds and the predictions.
+    """
+    start = time.perf_counter()
+    if num_frames == 1:
+        crops = [
+            decode_first_frame_center(io.BytesIO(video), image_size, image_size)
+            for video in videos
+        ]
+    else:
+        crops = [
+            decode_frames_center(
+                video, image_size, image_size, num_frames, max_decoded_frames
+            )
+            for video in videos
+        ]
+    decode_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    predictions = []
+    for batch_start in range(0, len(crops), batch_size):
+        batch = crops[batch_start : batch_start + batch_size]
+        if num_frames == 1:
+            batch_predictions, _, _ = classifier.classify_images(batch)
+        else:
+            batch_predictions, _, _ = classifier.classify_frame_stacks(
+                batch, aggregation
+            )
+        predictions.append(batch_predictions)
+    classify_seconds = time.perf_counter() - start
+    return decode_seconds, classify_seconds, np.concatenate(predictions)
+
+
+def scores(
+    labels: np.ndarray, predictions: np.ndarray
+) -> Tuple[float, float, float, float]:
+    """Accuracy and precision, recall and F1 score of tagged."""
+    metrics = BinaryMetrics(positive=TagStatus.tagged.value)
+    metrics.update(labels, predictions)
+    return (
+        metrics.accuracy(),
+        metrics.precision(),
+        metrics.recall(),
+        metrics.f1_score(),
+    )
+
+
+class MyArgs(argparse.Namespace):
+    zipped_wdd_data_dir: Path
+    classified_data_dir: Path
+    model_path: Path
+    backend: str
+    num_frames: List[int]
+    max_decoded_frames: int
+    batch_size: int
+    limit: Optional[int]
+
+
+def init_argparse() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        description=(
+            "Compares the throughput and accuracy of classifying the first frame and several frames of the video snippets of labeled days"
+        ),
+    )
+    parser.add_argument(
+        "zipped_wdd_data_dir",
+        type=Path,
+        help="path to directory containing zip archives of WDD detection data",
+    )
+    parser.add_argument(
+        "classified_data_dir",
+        type=Path,
+        help="path to directory with the labeled days, as written by daily_data_processing.py and corrected with the Label GUI",
+    )
+    parser.add_argument(
+        "--model_path",
+        type=Path,
+        default=Path("output/model.pth"),
+        help="path to the model weights (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--backend",
+        choices=backends,
+        default="torch",
+        help="backend to classify with (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--num_frames",
+        type=int,
+        nargs="+",
+        default=[1, 2, 4, 8],
+        help="numbers of frames per snippet to compare, 1 is the first frame (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--max_decoded_frames",
+        type=int,
+        default=16,
+        help="maximum number of frames that are decoded per snippet (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=64,
+        help="number of snippets that are classified together (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--limit",
+        type=int,
+        default=None,
+        help="maximum number of snippets (default: all)",
+    )
+    return parser
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import List, Optional
+
+# Dependencies that take long to import, reported if a command imports them
+HEAVY_MODULES = (
+    "torch",
+    "torchvision",
+    "pandas",
+    "sklearn",
+    "matplotlib",
+    "ffmpeg",
+    "cv2",
+)
+
+# Modules of the console entry points, see pyproject.toml
+HELP_MODULES = (
+    "daily_data_processing",
+    "data_overview",
+    "evaluate_performance",
+    "grid_pdf",
+    "cnn_classifier.train",
+    "cnn_classifier.sweep",
+    "cnn_classifier.split_dataset",
+    "cnn_classifier.cross_validate",
+    "cnn_classifier.test",
+    "cnn_classifier.export",
+    "cnn_classifier.server",
+)
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+
+
+def main():
+    """
+    Measures the wall time from starting the tools to their exit for --help
+    and, if a directory of zip archives is given, for the metadata-only data
+    overview, and lists the heavy dependencies each of them imports.
+    """
+    parser = init_argparse()
+    args: MyArgs = parser.parse_args(namespace=MyArgs())
+    commands = [[module, "--help"] for module in HELP_MODULES]
+    if args.zipped_wdd_data_dir is not None:
+        commands.append(["data_overview", str(args.zipped_wdd_data_dir.resolve())])
+
+    failed = False
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for command in commands:
+            seconds = [run(command, Path(temp_dir)) for _ in range(args.repetitions)]
+            median = statistics.median(seconds)
+            heavy_modules = imported_heavy_modules(command, Path(temp_dir))
+            print(
+                f"{' '.join(command)}: {1000 * median:.0f} ms, "
+                f"imports {', '.join(heavy_modules) or 'no heavy modules'}"
+            )
+            if args.limit is not None and median > args.limit:
+                failed = True
+    if failed:
+        print(f"Error: some commands took longer than {args.limit} s")
+        raise SystemExit(1)
+
+
+def run(command: List[str], cwd: Path) -> float:
+    """Runs a tool in cwd, which receives its output files, returns the seconds."""
+    start = time.perf_counter()
+    subprocess.run(
+        [sys.executable, "-m", *command],
+        cwd=cwd,
+        env=environment(),
+        check=True,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    return time.perf_counter() - start
+
+
+def imported_heavy_modules(command: List[str], cwd: Path) -> List[str]:
+    """Heavy modules that a tool imports, according to -X importtime."""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-m", *command],
+        cwd=cwd,
+        env=environment(),
+        check=True,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        text=True,
+    )
+    imported = set()
+    for line in result.stderr.splitlines():
+        if line.startswith("import time:"):
+            imported.add(line.rsplit("|", 1)[-1].strip().split(".")[0])
+    return [module for module in HEAVY_MODULES if module in imported]
+
+
+def environment() -> dict:
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(
+        filter(None, [str(REPO_DIR), env.get("PYTHONPATH")])
+    )
+    return env
+
+
+class MyArgs(argparse.Namespace):
+    zipped_wdd_data_dir: Optional[Path]
+    repetitions: int
+    limit: Optional[float]
+
+
+def init_argparse() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        description=(
+            "Measures the startup time of the tools for --help and the metadata-only data overview"
+        ),
+    )
+    parser.add_argument(
+        "--zipped_wdd_data_dir",
+        type=Path,
+        default=None,
+        help="path to a directory of zip archives to run the data overview on",
+    )
+    parser.add_argument(
+        "--repetitions",
+        type=int,
+        default=5,
+        help="number of runs of every command, the median is reported (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--limit",
+        type=float,
+        default=None,
+        help="exit with status 1 if the median of a command exceeds this many seconds",
+    )
+    return parser
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+import argparse
+import time
+from pathlib import Path
+from typing import Optional
+
+import torch
+import torch.nn as nn
+
+from cnn_classifier.datasets import get_dataloader, get_in_memory_dataloader
+from cnn_classifier.hyperparameters import batch_size, learning_rate
+from cnn_classifier.model import TaggedBeeClassificationModel
+from cnn_classifier.split_dataset import DEFAULT_DATA_DIR
+
+
+def main():
+    """
+    Compares the time of a training epoch with the ImageFolder data loader and
+    with the in-memory data loader, both for iterating over the batches only
+    and for training on them.
+    """
+    parser = init_argparse()
+    args: MyArgs = parser.parse_args(namespace=MyArgs())
+    if args.torch_threads is not None:
+        torch.set_num_threads(args.torch_threads)
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+    start = time.perf_counter()
+    in_memory_dataloader = get_in_memory_dataloader(
+        "train", args.data_dir, args.in_memory_batch_size, device, seed=0
+    )
+    print(
+        f"decoding {len(in_memory_dataloader.dataset)} training images once: "
+        f"{1000 * (time.perf_counter() - start):.1f} ms"
+    )
+    dataloaders = {
+        f"ImageFolder, batch size {args.batch_size}": get_dataloader(
+            "train", args.data_dir, args.batch_size
+        ),
+        f"in memory, batch size {args.batch_size}": get_in_memory_dataloader(
+            "train", args.data_dir, args.batch_size, device, seed=0
+        ),
+        f"in memory, batch size {args.in_memory_batch_size}": in_memory_dataloader,
+    }
+    for name, dataloader in dataloaders.items():
+        load_seconds = []
+        train_seconds = []
+        for _ in range(args.epochs):
+            start = time.perf_counter()
+            for images, labels in dataloader:
+                images, labels = images.to(device), labels.to(device)
+            load_seconds.append(time.perf_counter() - start)
+            train_seconds.append(train_epoch(dataloader, device))
+        print(
+            f"{name}: {1000 * min(load_seconds):.1f} ms per epoch to load, "
+            f"{1000 * min(train_seconds):.1f} ms per epoch to train"
+        )
+
+
+def train_epoch(dataloader, device: torch.device) -> float:
+    """Trains a new model for one epoch, returns the seconds."""
+    model = TaggedBeeClassificationModel().to(device)
+    criterion = nn.CrossEntropyLoss()
+    optimizer = torch.optim.Adam(model.parameters(), lr=learning_rate)
+    model.train()
+    start = time.perf_counter()
+    for images, labels in dataloader:
+        images, labels = images.to(device), labels.to(device)
+        loss = criterion(model(images), labels)
+        loss.backward()
+        optimizer.step()
+        optimizer.zero_grad()
+    return time.perf_counter() - start
+
+
+class MyArgs(argparse.Namespace):
+    data_dir: Path
+    batch_size: int
+    in_memory_batch_size: int
+    epochs: int
+    torch_threads: Optional[int]
+
+
+def init_argparse() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        description=(
+            "Compares the epoch time of the ImageFolder and the in-memory training data loaders"
+        ),
+    )
+    parser.add_argument(
+        "--data_dir",
+        type=Path,
+        default=DEFAULT_DATA_DIR,
+        help="path to the cropped images, with one directory per split (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=batch_size,
+        help="batch size of the training (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--in_memory_batch_size",
+        type=int,
+        default=256,
+        help="large batch size to compare with the in-memory data loader (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--epochs",
+        type=int,
+        default=3,
+        help="number of epochs per data loader, the fastest is reported (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--torch_threads",
+        type=int,
+        default=None,
+        help="number of torch intra-op threads (default: chosen by torch)",
+    )
+    return parser
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+import argparse
+import tempfile
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+import torch
+from PIL import Image
+
+from cnn_classifier.classification import to_grayscale_array
+from cnn_classifier.export import export_npz
+from cnn_classifier.hyperparameters import image_size
+from cnn_classifier.inference import TaggedBeeClassifierConvNet
+from cnn_classifier.numpy_inference import NumpyTaggedBeeClassifier
+
+
+def main():
+    """
+    Checks that the numpy backend matches the fp32 torch model, with weights
+    loaded from the saved state dict and from an exported .npz file. Exits with
+    status 1 if it doesn't.
+    """
+    parser = init_argparse()
+    args: MyArgs = parser.parse_args(namespace=MyArgs())
+    classifier = TaggedBeeClassifierConvNet(args.model_path, device="cpu")
+
+    rng = np.random.default_rng(args.seed)
+    batch = rng.integers(
+        0, 256, (args.num_images, image_size, image_size), dtype=np.uint8
+    )
+    if args.image_dir is not None:
+        images = []
+        for path in sorted(args.image_dir.rglob("*.png")):
+            with Image.open(path) as image:
+                images.append(to_grayscale_array(image))
+        if images:
+            batch = np.concatenate((batch, np.stack(images)))
+
+    with torch.inference_mode():
+        reference_outputs = classifier.uint8_model(
+            torch.from_numpy(batch).unsqueeze(1).float()
+        ).numpy()
+    reference = classifier.classify_batch(batch)
+
+    failed = False
+    with tempfile.TemporaryDirectory() as temp_dir:
+        npz_path = Path(temp_dir) / "model.npz"
+        export_npz(classifier, npz_path)
+        for weights_path in (args.model_path, npz_path):
+            numpy_classifier = NumpyTaggedBeeClassifier(weights_path)
+            outputs = numpy_classifier.forward(batch)
+            result = numpy_classifier.classify_batch(batch)
+            logit_difference = np.abs(outputs - reference_outputs).max()
+            confidence_difference = np.abs(result[1] - reference[1]).max()
+            mismatches = int((result[0] != reference[0]).sum())
+            print(f"weights: {weights_path.suffix}")
+            print(f"  images: {len(batch)}")
+            print(f"  max. logit difference: {logit_difference:.3g}")
+            print(f"  max. confidence difference: {confidence_difference:.3g}")
+            print(f"  mismatching predictions: {mismatches}")
+            failed |= logit_difference > args.tolerance or mismatches > 0
+    if failed:
+        print("Error: the numpy backend doesn't match the torch model")
+        raise SystemExit(1)
+
+
+class MyArgs(argparse.Namespace):
+    model_path: Path
+    image_dir: Optional[Path]
+    num_images: int
+    seed: int
+    tolerance: float
+
+
+def init_argparse() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        description=(
+            "Checks that the numpy backend matches the fp32 torch model on random and, optionally, real cropped images"
+        ),
+    )
+    parser.add_argument(
+        "--model_path",
+        type=Path,
+        default=Path("output/model.pth"),
+        help="path to the model weights (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--image_dir",
+        type=Path,
+        default=None,
+        help="path to a directory of cropped PNG images to include",
+    )
+    parser.add_argument(
+        "--num_images",
+        type=int,
+        default=1000,
+        help="number of random images (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=0,
+        help="seed of the random images (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=1e-4,
+        help="maximum absolute difference of the logits (default: %(default)s)",
+    )
+    return parser
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+import argparse
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+import torch
+import torchvision.transforms.v2 as transforms
+from PIL import Image
+
+from cnn_classifier.classification import to_grayscale_array
+from cnn_classifier.hyperparameters import image_size
+from cnn_classifier.inference import TaggedBeeClassifierConvNet
+
+
+def main():
+    """
+    Checks that the uint8 batch path of the classifier, which folds the
+    normalization into the first convolution, matches the PIL transforms the
+    model was trained with. Exits with status 1 if it doesn't.
+    """
+    parser = init_argparse()
+    args: MyArgs = parser.parse_args(namespace=MyArgs())
+    classifier = TaggedBeeClassifierConvNet(args.model_path)
+    transform = transforms.Compose(
+        [
+            transforms.Grayscale(1),
+            transforms.ToImage(),
+            transforms.ToDtype(torch.float32, scale=True),
+            transforms.Normalize([0.5], [0.5]),
+        ]
+    )
+
+    rng = np.random.default_rng(args.seed)
+    images = [
+        Image.fromarray(
+            rng.integers(0, 256, (image_size, image_size, 3), dtype=np.uint8), "RGB"
+        )
+        for _ in range(args.num_images)
+    ] + [
+        Image.fromarray(rng.integers(0, 256, (image_size, image_size), dtype=np.uint8))
+        for _ in range(args.num_images)
+    ]
+    if args.image_dir is not None:
+        for path in sorted(args.image_dir.rglob("*.png")):
+            with Image.open(path) as image:
+                image.load()
+                images.append(image)
+
+    with torch.inference_mode():
+        reference_inputs = torch.stack([transform(image) for image in images])
+        reference_outputs = classifier.model(reference_inputs.to(classifier.device))
+        batch = np.stack([to_grayscale_array(image) for image in images])
+        outputs = classifier.uint8_model(
+            torch.from_numpy(batch).unsqueeze(1).float().to(classifier.device)
+        )
+    reference = classifier.model.postprocess_predictions(reference_outputs)
+    result = classifier.classify_batch(batch)
+
+    logit_difference = (outputs - reference_outputs).abs().max().item()
+    confidence_difference = np.abs(result[1] - reference[1]).max()
+    mismatches = int((result[0] != reference[0]).sum())
+    print(f"images: {len(images)}")
+    print(f"max. logit difference: {logit_difference:.3g}")
+    print(f"max. confidence difference: {confidence_difference:.3g}")
+    print(f"mismatching predictions: {mismatches}")
+    if logit_difference > args.tolerance or mismatches > 0:
+        print("Error: the uint8 batch path doesn't match the transforms")
+        raise SystemExit(1)
+
+
+class MyArgs(argparse.Namespace):
+    model_path: Path
+    image_dir: Optional[Path]
+    num_images: int
+    seed: int
+    tolerance: float
+
+
+def init_argparse() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        description=(
+            "Checks that the uint8 batch path of the classifier matches the PIL transforms on random and, optionally, real cropped images"
+        ),
+    )
+    parser.add_argument(
+        "--model_path",
+        type=Path,
+        default=Path("output/model.pth"),
+        help="path to the model weights (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--image_dir",
+        type=Path,
+        default=None,
+        help="path to a directory of cropped PNG images to include",
+    )
+    parser.add_argument(
+        "--num_images",
+        type=int,
+        default=500,
+        help="number of random RGB and of random grayscale images (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=0,
+        help="seed of the random images (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=1e-4,
+        help="maximum absolute difference of the logits (default: %(default)s)",
+    )
+    return parser
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,188 @@
+import argparse
+import datetime
+import sys
+import tempfile
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from cnn_classifier.hyperparameters import image_size
+from utils.wood_filter import (
+    ROI_CORRECTION_OFFSET,
+    WOOD_OFFSET_BOT,
+    WOOD_OFFSET_TOP,
+    WOOD_OFFSET_X,
+    MarkerIndex,
+)
+
+
+def main():
+    """
+    Checks that MarkerIndex.wood_mask and is_wood_in_frame match the original
+    per-detection wood filter, which read the markers CSV and parsed every
+    timestamp with datetime.fromisoformat, on random detections. The
+    timestamps mix precisions, as isoformat drops zero microseconds, and
+    some have a UTC offset. Exits with status 1 if they don't match.
+    """
+    parser = init_argparse()
+    args: MyArgs = parser.parse_args(namespace=MyArgs())
+    rng = np.random.default_rng(args.seed)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        markers_path = args.markers
+        if markers_path is None:
+            markers_path = Path(temp_dir) / "markers.csv"
+            write_random_markers(markers_path, rng)
+        df_markers = pd.read_csv(markers_path)
+        marker_index = MarkerIndex.from_csv(markers_path, image_size)
+
+    marker_times = pd.to_datetime(df_markers["timestamp"], format="ISO8601")
+    timestamps, roi_centers = random_detections(
+        marker_times.min() - pd.Timedelta(hours=1),
+        marker_times.max() + pd.Timedelta(hours=1),
+        args.num_detections,
+        rng,
+    )
+    expected = np.array(
+        [
+            original_is_wood_in_frame(timestamp, center, df_markers)
+            for timestamp, center in zip(timestamps, roi_centers)
+        ]
+    )
+    mask = marker_index.wood_mask(timestamps, roi_centers)
+    single = np.array(
+        [
+            marker_index.is_wood_in_frame(
+                {"timestamp_begin": timestamp, "roi_center": center}
+            )
+            for timestamp, center in zip(timestamps, roi_centers)
+        ]
+    )
+    print(
+        f"{len(timestamps)} detections, {int(expected.sum())} with wood, "
+        f"{sum('.' not in timestamp for timestamp in timestamps)} without "
+        f"microseconds, {sum(timestamp.endswith('+00:00') for timestamp in timestamps)} "
+        "with a UTC offset"
+    )
+    failed = False
+    for name, result in (("wood_mask", mask), ("is_wood_in_frame", single)):
+        mismatches = int((result != expected).sum())
+        print(f"{name}: {mismatches} mismatches")
+        failed |= mismatches > 0
+    if failed:
+        sys.exit(1)
+
+
+def write_random_markers(path: Path, rng: np.random.Generator, num_epochs: int = 5):
+    """Markers CSV with 4 markers per epoch, whose timestamps mix precisions."""
+    rows = []
+    start = datetime.datetime(2024, 9, 1)
+    for epoch in range(num_epochs):
+        timestamp = start + datetime.timedelta(
+            hours=int(rng.integers(1, 24)) * epoch,
+            microseconds=int(rng.integers(0, 1_000_000)) if epoch % 2 else 0,
+        )
+        offset = rng.integers(-50, 50, 2)
+        for x, y in ((200, 200), (1800, 200), (200, 1800), (1800, 1800)):
+            rows.append((timestamp.isoformat(), x + offset[0], y + offset[1]))
+    pd.DataFrame(rows, columns=["timestamp", "x", "y"]).to_csv(path, index=False)
+
+
+def random_detections(
+    start: pd.Timestamp,
+    end: pd.Timestamp,
+    num_detections: int,
+    rng: np.random.Generator,
+) -> Tuple[List[str], List[List[int]]]:
+    """
+    Timestamps and ROI centers of random detections. A quarter of the
+    timestamps has zero microseconds and another quarter a +00:00 offset.
+    """
+    microseconds = int((end - start).total_seconds() * 1_000_000)
+    timestamps = []
+    for kind in range(num_detections):
+        timestamp = start.to_pydatetime() + datetime.timedelta(
+            microseconds=int(rng.integers(0, microseconds))
+        )
+        if kind % 4 == 0:
+            timestamp = timestamp.replace(microsecond=0)
+        elif kind % 4 == 1:
+            timestamp = timestamp.replace(tzinfo=datetime.timezone.utc)
+        timestamps.append(timestamp.isoformat())
+    roi_centers = rng.integers(-125, 1900, (num_detections, 2)).tolist()
+    return timestamps, roi_centers
+
+
+def original_is_wood_in_frame(
+    timestamp: str, roi_center: List[int], df_markers: pd.DataFrame
+) -> bool:
+    """
+    The wood filter before MarkerIndex, which compared every marker epoch with
+    the parsed timestamp. Timestamps with an offset are compared in UTC, as
+    the naive marker timestamps can't be compared with them.
+    """
+    detection_time = datetime.datetime.fromisoformat(timestamp)
+    if detection_time.tzinfo is not None:
+        detection_time = detection_time.astimezone(datetime.timezone.utc).replace(
+            tzinfo=None
+        )
+    marker_times = pd.to_datetime(df_markers["timestamp"], format="ISO8601")
+    timestamp_to_show = None
+    for marker_time in sorted(marker_times.unique()):
+        if marker_time <= detection_time:
+            timestamp_to_show = marker_time
+    if timestamp_to_show is None:
+        return False
+    markers = df_markers.loc[marker_times == timestamp_to_show]
+    coords = list(zip(markers["x"], markers["y"]))
+    border_left = max(coords[0][0] + WOOD_OFFSET_X, coords[2][0] + WOOD_OFFSET_X)
+    border_top = max(coords[0][1] + WOOD_OFFSET_TOP, coords[1][1] + WOOD_OFFSET_TOP)
+    border_right = min(coords[1][0] - WOOD_OFFSET_X, coords[3][0] - WOOD_OFFSET_X)
+    border_bot = min(coords[2][1] - WOOD_OFFSET_BOT, coords[3][1] - WOOD_OFFSET_BOT)
+    center_x = roi_center[0] + ROI_CORRECTION_OFFSET
+    center_y = roi_center[1] + ROI_CORRECTION_OFFSET
+    frame_offset = image_size // 2
+    return (
+        center_x - frame_offset <= border_left
+        or center_x + frame_offset >= border_right
+        or center_y - frame_offset <= border_top
+        or center_y + frame_offset >= border_bot
+    )
+
+
+class MyArgs(argparse.Namespace):
+    markers: Optional[Path]
+    num_detections: int
+    seed: int
+
+
+def init_argparse() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        description=(
+            "Checks that the vectorized wood filter matches the original per-detection wood filter"
+        ),
+    )
+    parser.add_argument(
+        "--markers",
+        type=Path,
+        default=None,
+        help="markers CSV to check with (default: random markers whose timestamps mix precisions)",
+    )
+    parser.add_argument(
+        "--num_detections",
+        type=int,
+        default=2000,
+        help="number of random detections (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=0,
+        help="seed of the random markers and detections (default: %(default)s)",
+    )
+    return parser
+
+
+if __name__ == "__main__":
+    main()
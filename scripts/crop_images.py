@@ -1,23 +1,60 @@
 import argparse
+import collections
+import json
+import multiprocessing
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-from zipfile import ZipFile
+from typing import Dict, Iterator, List, Optional, Tuple
+from zipfile import BadZipFile, ZipFile
 
+import numpy as np
 from PIL import Image
 from tqdm import tqdm
 
 from cnn_classifier.hyperparameters import image_size
-from utils.image_cropping import crop_center
+from utils.apng_decoding import decode_first_frame_center
+from utils.crop_store import CropRecord, CropStore, crop_filename
+
+# Directory of the manifests of the cropped archives in the output directory
+MANIFEST_DIR = ".crop_manifests"
+# Number of video snippets that are cropped per task, large archives are
+# split into several tasks
+DEFAULT_CHUNK_SIZE = 256
+
+# Crop size and open zip archive of a worker process, see init_worker
+_worker = {}
 
 
 def main():
+    """
+    Extracts and crops the first frames of the WDD video snippets of all zip
+    archives below a directory, in parallel worker processes. Runs are
+    incremental: archives whose snippets were all cropped before are skipped
+    after reading their central directory, and of archives that have grown,
+    only the new snippets are cropped.
+    """
     parser = init_argparse()
-    args = parser.parse_args()
+    args: MyArgs = parser.parse_args(namespace=MyArgs())
+    if args.workers < 1 or args.chunk_size < 1:
+        parser.error("--workers and --chunk_size must be at least 1")
 
+    if args.store:
+        with CropStore(
+            args.cropped_image_output_dir, "a", (image_size, image_size)
+        ) as store:
+            create_crop_store(
+                args.zipped_wdd_data_dir, store, args.workers, args.chunk_size
+            )
+        return
     create_cropped_images(
         zips_dir=args.zipped_wdd_data_dir,
         target_dir=args.cropped_image_output_dir,
         output_width=image_size,
         output_height=image_size,
+        workers=args.workers,
+        chunk_size=args.chunk_size,
     )
 
 
@@ -26,37 +63,235 @@ def create_cropped_images(
     target_dir: Path | str,
     output_width: int,
     output_height: int,
+    workers: int = 1,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
 ):
-    """Extracts and crops first frame from WDD video snippets."""
+    """
+    Extracts and crops first frame from WDD video snippets.
+
+    The CRC32s of the cropped snippets of an archive are kept in a manifest,
+    see crop_manifest_path, which is updated after every task. Snippets that
+    are new or whose CRC32 changed are cropped, the others are skipped.
+    """
     zips_dir = Path(zips_dir)
-    for path_to_zip in tqdm(zips_dir.rglob("*")):
-        if not str(path_to_zip).endswith(".zip"):
+    target_dir = Path(target_dir)
+    # Members of the archives by zip path, and the cropped members of the
+    # archives with snippets to crop
+    archives: Dict[Path, Dict[str, int]] = {}
+    cropped: Dict[Path, Dict[str, int]] = {}
+    tasks = []
+    for path_to_zip, members in find_archives(zips_dir):
+        manifest = read_crop_manifest(crop_manifest_path(target_dir, path_to_zip))
+        # Manifest entries of removed members are dropped.
+        done = {
+            member: crc
+            for member, crc in manifest.items()
+            if members.get(member) == crc
+        }
+        pending = [member for member in members if member not in done]
+        if not pending:
             continue
-        zip_filename = path_to_zip.name.replace(".zip", "")
-        current_target_dir = Path(target_dir) / zip_filename
+        archives[path_to_zip] = members
+        cropped[path_to_zip] = done
+        current_target_dir = target_dir / path_to_zip.stem
         current_target_dir.mkdir(parents=True, exist_ok=True)
-        with ZipFile(path_to_zip) as zip_file:
-            video_filenames = filter(
-                lambda filename: filename.endswith(".apng"), zip_file.namelist()
+        tasks += [
+            (path_to_zip, pending[start : start + chunk_size], current_target_dir)
+            for start in range(0, len(pending), chunk_size)
+        ]
+    print(
+        f"Cropping {sum(len(task[1]) for task in tasks)} snippets of {len(archives)} archives"
+    )
+
+    with tqdm(total=sum(len(task[1]) for task in tasks)) as progress:
+        for (path_to_zip, members, _), _ in run_tasks(
+            tasks, workers, (output_width, output_height)
+        ):
+            for member in members:
+                cropped[path_to_zip][member] = archives[path_to_zip][member]
+            write_crop_manifest(
+                crop_manifest_path(target_dir, path_to_zip), cropped[path_to_zip]
+            )
+            progress.update(len(members))
+
+
+def create_crop_store(
+    zips_dir: Path | str,
+    store: CropStore,
+    workers: int = 1,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+):
+    """
+    Extracts and crops the first frames of the WDD video snippets into a crop
+    store, with the waggle ids of their metadata. The archive of a crop is
+    the path of its zip archive relative to zips_dir, without the extension.
+
+    The store is the manifest: snippets that it already has are skipped. As
+    the store is append-only, snippets whose CRC32 changed aren't cropped
+    again. The crops are appended in the order of the archives and their
+    members, however many workers crop them.
+    """
+    zips_dir = Path(zips_dir)
+    stored = collections.defaultdict(set)
+    for record in store.records:
+        stored[record.archive].add(record.member)
+    tasks = []
+    for path_to_zip, members in find_archives(zips_dir):
+        archive = path_to_zip.relative_to(zips_dir).with_suffix("").as_posix()
+        pending = [member for member in members if member not in stored[archive]]
+        tasks += [
+            (path_to_zip, pending[start : start + chunk_size], None)
+            for start in range(0, len(pending), chunk_size)
+        ]
+    print(f"Cropping {sum(len(task[1]) for task in tasks)} snippets into {store.path}")
+
+    with tqdm(total=sum(len(task[1]) for task in tasks)) as progress:
+        for (path_to_zip, members, _), (crops, waggle_ids) in run_tasks(
+            tasks, workers, store.image_shape[::-1]
+        ):
+            archive = path_to_zip.relative_to(zips_dir).with_suffix("").as_posix()
+            store.append(
+                crops,
+                [
+                    CropRecord(path_to_zip.stem, archive, member, waggle_id)
+                    for member, waggle_id in zip(members, waggle_ids)
+                ],
+            )
+            progress.update(len(members))
+
+
+def find_archives(zips_dir: Path) -> Iterator[Tuple[Path, Dict[str, int]]]:
+    """
+    Zip archives below a directory and the CRC32s of their APNG members by
+    name, in the order of the archive, read from the central directory
+    without decompressing anything. Archives that are still being written
+    are skipped.
+    """
+    for path_to_zip in sorted(zips_dir.rglob("*.zip")):
+        try:
+            with ZipFile(path_to_zip) as zip_file:
+                members = {
+                    info.filename: info.CRC
+                    for info in zip_file.infolist()
+                    if info.filename.endswith(".apng")
+                }
+        except BadZipFile:
+            print(f"Skipping incomplete archive {path_to_zip}", file=sys.stderr)
+            continue
+        yield path_to_zip, members
+
+
+def crop_manifest_path(target_dir: Path, path_to_zip: Path) -> Path:
+    return target_dir / MANIFEST_DIR / (path_to_zip.stem + ".json")
+
+
+def read_crop_manifest(path: Path) -> Dict[str, int]:
+    """CRC32s of the cropped members of an archive by name, empty if none were."""
+    if not path.exists():
+        return {}
+    with open(path) as f:
+        return json.load(f)["members"]
+
+
+def write_crop_manifest(path: Path, members: Dict[str, int]):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # Replaced atomically, so that an interrupted run leaves the old manifest.
+    temp_path = path.with_suffix(".tmp")
+    with open(temp_path, "w") as f:
+        json.dump({"num_members": len(members), "members": members}, f)
+    os.replace(temp_path, path)
+
+
+def run_tasks(tasks: List[Tuple], workers: int, size: Tuple[int, int]):
+    """
+    Yields the tasks and their results in order. With more than one worker,
+    the tasks run in worker processes, at most two per worker ahead of the
+    task whose result is yielded next.
+    """
+    if workers == 1:
+        init_worker(*size)
+        for task in tasks:
+            yield task, crop_members_in_worker(*task)
+        return
+    with ProcessPoolExecutor(
+        workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=init_worker,
+        initargs=size,
+    ) as executor:
+        pending = collections.deque()
+        for task in tasks:
+            pending.append((task, executor.submit(crop_members_in_worker, *task)))
+            if len(pending) >= 2 * workers:
+                task, future = pending.popleft()
+                yield task, future.result()
+        while pending:
+            task, future = pending.popleft()
+            yield task, future.result()
+
+
+def init_worker(output_width: int, output_height: int):
+    _worker["size"] = (output_width, output_height)
+    _worker["zip_path"] = None
+    _worker["zip_file"] = None
+
+
+def crop_members_in_worker(
+    path_to_zip: Path, members: List[str], target_dir: Optional[Path]
+) -> Optional[Tuple[np.ndarray, List[str]]]:
+    """
+    Crops the first frames of some members of an archive. Saves them as PNG
+    files to target_dir if given, otherwise returns the crops and the waggle
+    ids of the members.
+    """
+    # The archive stays open for the next task, which is usually of the same
+    # archive.
+    if _worker["zip_path"] != path_to_zip:
+        if _worker["zip_file"] is not None:
+            _worker["zip_file"].close()
+        _worker["zip_file"] = ZipFile(path_to_zip)
+        _worker["zip_path"] = path_to_zip
+    zip_file: ZipFile = _worker["zip_file"]
+    output_width, output_height = _worker["size"]
+    crops = []
+    for filename in members:
+        with zip_file.open(filename) as video_file:
+            cropped_image = decode_first_frame_center(
+                video_file, output_width, output_height
             )
-            for filename in video_filenames:
-                with zip_file.open(filename) as video_file:
-                    with Image.open(video_file) as image:
-                        cropped_image = crop_center(image, output_width, output_height)
+        if target_dir is not None:
+            # Flatten output directory structure
+            Image.fromarray(cropped_image).save(target_dir / crop_filename(filename))
+        else:
+            crops.append(cropped_image)
+    if target_dir is not None:
+        return None
+    return np.stack(crops), [waggle_id(zip_file, filename) for filename in members]
+
+
+def waggle_id(zip_file: ZipFile, video_filename: str) -> str:
+    """Waggle id in the metadata next to a video snippet, empty if there is none."""
+    metadata_filename = video_filename.replace("frames.apng", "waggle.json")
+    try:
+        return str(json.loads(zip_file.read(metadata_filename))["waggle_id"])
+    except KeyError:
+        return ""
 
-                        # Flatten output directory structure
-                        filename = video_file.name.replace(
-                            "/frames.apng", ".png"
-                        ).replace("/", "_")
 
-                        target_path = current_target_dir / filename
-                        cropped_image.save(target_path)
+class MyArgs(argparse.Namespace):
+    zipped_wdd_data_dir: Path
+    cropped_image_output_dir: Path
+    store: bool
+    workers: int
+    chunk_size: int
 
 
 def init_argparse() -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser(
-        usage="%(prog)s <zipped_wdd_data_dir> <cropped_image_output_dir>",
-        description=("Extracts and crops the first frame from APNG video snippets"),
+        usage="%(prog)s <zipped_wdd_data_dir> <cropped_image_output_dir> [options]",
+        description=(
+            "Extracts and crops the first frame from APNG video snippets, in parallel and only of snippets that weren't cropped before"
+        ),
     )
     parser.add_argument(
         "zipped_wdd_data_dir",
@@ -68,6 +303,23 @@ def init_argparse() -> argparse.ArgumentParser:
         type=Path,
         help="Path to output directory",
     )
+    parser.add_argument(
+        "--store",
+        action="store_true",
+        help="Write the crops into a crop store in the output directory instead of one PNG file per crop, see utils/crop_store.py",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="Number of worker processes that crop in parallel (default: number of CPUs, %(default)s)",
+    )
+    parser.add_argument(
+        "--chunk_size",
+        type=int,
+        default=DEFAULT_CHUNK_SIZE,
+        help="Number of video snippets per task, large archives are split into several tasks (default: %(default)s)",
+    )
     return parser
 
 
@@ -0,0 +1,267 @@
+import io
+import struct
+import zlib
+from typing import BinaryIO, List, Optional, Tuple
+
+import numpy as np
+from PIL import Image
+
+from utils.image_cropping import crop_center
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+# (mode, channels) by PNG color type, for a bit depth of 8
+_COLOR_TYPES = {0: ("L", 1), 2: ("RGB", 3), 4: ("LA", 2), 6: ("RGBA", 4)}
+
+
+def decode_first_frame_center(
+    file: BinaryIO, output_width: int, output_height: int
+) -> np.ndarray:
+    """
+    Decodes the center crop of the first frame of an (A)PNG file as a grayscale
+    uint8 array of shape (output_height, output_width).
+
+    Only the scanlines up to the bottom of the crop are inflated and only the
+    columns up to the right edge of the crop are unfiltered. The rest of the
+    file, including all further frames, is never read. Files that are not
+    8-bit, non-interlaced PNGs are decoded with PIL instead.
+    """
+    header = file.read(len(PNG_SIGNATURE) + 25)
+    if header[: len(PNG_SIGNATURE)] != PNG_SIGNATURE:
+        raise ValueError("Not a PNG file")
+    length, chunk_type = struct.unpack(">I4s", header[8:16])
+    if chunk_type != b"IHDR" or length != 13:
+        raise ValueError("PNG file does not start with an IHDR chunk")
+    width, height, bit_depth, color_type, _, _, interlace = struct.unpack(
+        ">IIBBBBB", header[16:29]
+    )
+    if (
+        bit_depth != 8
+        or color_type not in _COLOR_TYPES
+        or interlace != 0
+        or width < output_width
+        or height < output_height
+    ):
+        return _decode_with_pil(
+            io.BytesIO(header + file.read()), output_width, output_height
+        )
+
+    mode, channels = _COLOR_TYPES[color_type]
+    left = (width - output_width) // 2
+    top = (height - output_height) // 2
+    num_rows = top + output_height
+    stride = 1 + width * channels
+    num_bytes = num_rows * stride
+
+    raw = bytearray()
+    decompressor = zlib.decompressobj()
+    seen_idat = False
+    while len(raw) < num_bytes:
+        chunk_header = file.read(8)
+        if len(chunk_header) < 8:
+            raise ValueError("Unexpected end of PNG file")
+        length, chunk_type = struct.unpack(">I4s", chunk_header)
+        if chunk_type != b"IDAT":
+            if seen_idat or chunk_type == b"IEND":
+                raise ValueError("Not enough image data in PNG file")
+            # Skip ancillary chunks (and their CRC) before the image data
+            file.read(length + 4)
+            continue
+        seen_idat = True
+        data = file.read(length)
+        file.read(4)
+        raw += decompressor.decompress(data, num_bytes - len(raw))
+        # The decompressor may hold back input once the limit is reached.
+        while decompressor.unconsumed_tail and len(raw) < num_bytes:
+            raw += decompressor.decompress(
+                decompressor.unconsumed_tail, num_bytes - len(raw)
+            )
+
+    return _crop_scanlines(
+        raw, mode, channels, width, left, top, output_width, output_height
+    )
+
+
+def decode_frames_center(
+    data: bytes,
+    output_width: int,
+    output_height: int,
+    num_frames: int,
+    max_decoded_frames: Optional[int] = None,
+) -> np.ndarray:
+    """
+    Decodes the center crops of num_frames evenly spaced frames of an APNG
+    file as a grayscale uint8 array of shape (K, output_height, output_width).
+    K is smaller than num_frames if the file has fewer frames or if
+    max_decoded_frames, the cap of the decoding cost, is smaller. The first
+    frame is always included, a still PNG has one frame.
+
+    Frames that cover the whole image and replace the previous frame, as in
+    WDD snippets, are decoded independently: like in decode_first_frame_center
+    only the scanlines of the crop are inflated, and the data of the other
+    frames is skipped. The frames are spread over the whole snippet and at
+    most max_decoded_frames are inflated. Other files are decoded with PIL,
+    which has to composite every frame up to the last selected one, so the
+    frames are only spread over the first max_decoded_frames frames.
+    """
+    if max_decoded_frames is not None:
+        num_frames = min(num_frames, max_decoded_frames)
+    if data[: len(PNG_SIGNATURE)] != PNG_SIGNATURE:
+        raise ValueError("Not a PNG file")
+    width = height = bit_depth = color_type = interlace = None
+    has_transparency = False
+    # Control (fcTL) fields and compressed data of every frame
+    frames: List[Tuple[Optional[tuple], List[memoryview]]] = []
+    # Compressed data of a default image that is not part of the animation
+    default_image: List[memoryview] = []
+    view = memoryview(data)
+    position = len(PNG_SIGNATURE)
+    while position + 8 <= len(data):
+        length, chunk_type = struct.unpack_from(">I4s", data, position)
+        chunk = view[position + 8 : position + 8 + length]
+        position += 12 + length
+        if chunk_type == b"IHDR":
+            width, height, bit_depth, color_type, _, _, interlace = struct.unpack(
+                ">IIBBBBB", chunk[:13]
+            )
+        elif chunk_type == b"tRNS":
+            has_transparency = True
+        elif chunk_type == b"fcTL":
+            # width, height, x offset, y offset, dispose op and blend op
+            control = struct.unpack(">IIIIHHBB", chunk[4:26])
+            frames.append((control[:4] + control[6:], []))
+        elif chunk_type == b"IDAT":
+            # The default image is the first frame if an fcTL precedes it.
+            (frames[-1][1] if frames else default_image).append(chunk)
+        elif chunk_type == b"fdAT" and frames:
+            # Skips the sequence number
+            frames[-1][1].append(chunk[4:])
+        elif chunk_type == b"IEND":
+            break
+    if not frames:
+        # A still PNG
+        frames = [(None, default_image)]
+
+    indices = frame_indices(len(frames), num_frames)
+    has_alpha = color_type in (4, 6) or has_transparency
+    if (
+        bit_depth != 8
+        or color_type not in _COLOR_TYPES
+        or interlace != 0
+        or width < output_width
+        or height < output_height
+        or not all(
+            _is_independent(frames[index][0], width, height, has_alpha)
+            for index in indices
+        )
+    ):
+        return _decode_frames_with_pil(
+            data, output_width, output_height, num_frames, max_decoded_frames
+        )
+
+    mode, channels = _COLOR_TYPES[color_type]
+    left = (width - output_width) // 2
+    top = (height - output_height) // 2
+    num_bytes = (top + output_height) * (1 + width * channels)
+    crops = []
+    for index in indices:
+        raw = bytearray()
+        decompressor = zlib.decompressobj()
+        for chunk in frames[index][1]:
+            raw += decompressor.decompress(chunk, num_bytes - len(raw))
+            while decompressor.unconsumed_tail and len(raw) < num_bytes:
+                raw += decompressor.decompress(
+                    decompressor.unconsumed_tail, num_bytes - len(raw)
+                )
+            if len(raw) >= num_bytes:
+                break
+        if len(raw) < num_bytes:
+            raise ValueError("Not enough image data in APNG frame")
+        crops.append(
+            _crop_scanlines(
+                raw, mode, channels, width, left, top, output_width, output_height
+            )
+        )
+    return np.stack(crops)
+
+
+def frame_indices(total: int, num_frames: int) -> List[int]:
+    """Indices of num_frames evenly spaced frames of total frames, with the first."""
+    if total <= num_frames:
+        return list(range(total))
+    return np.linspace(0, total - 1, num_frames).round().astype(int).tolist()
+
+
+def _is_independent(
+    control: Optional[tuple], width: int, height: int, has_alpha: bool
+) -> bool:
+    """Whether a frame covers the whole image and doesn't blend with the previous one."""
+    if control is None:
+        return True
+    frame_width, frame_height, x_offset, y_offset, _, blend_op = control
+    return (
+        (frame_width, frame_height, x_offset, y_offset) == (width, height, 0, 0)
+        # APNG_BLEND_OP_SOURCE, or APNG_BLEND_OP_OVER of opaque pixels
+        and (blend_op == 0 or not has_alpha)
+    )
+
+
+def _crop_scanlines(
+    raw: bytes,
+    mode: str,
+    channels: int,
+    width: int,
+    left: int,
+    top: int,
+    output_width: int,
+    output_height: int,
+) -> np.ndarray:
+    """Unfilters the inflated scanlines above the bottom of the crop and crops them."""
+    num_rows = top + output_height
+    stride = 1 + width * channels
+    # Scanline filters only refer to bytes on the left and above, so columns
+    # to the right of the crop can be dropped before unfiltering.
+    num_columns = left + output_width
+    scanlines = np.frombuffer(raw, dtype=np.uint8, count=num_rows * stride).reshape(
+        num_rows, stride
+    )[:, : 1 + num_columns * channels]
+    # PIL's PNG decoder does the unfiltering. It expects a zlib stream, so the
+    # scanlines are wrapped in uncompressed deflate blocks.
+    image = Image.frombytes(
+        mode,
+        (num_columns, num_rows),
+        zlib.compress(scanlines.tobytes(), 0),
+        "zip",
+        mode,
+    )
+    cropped_image = image.crop((left, top, num_columns, num_rows))
+    if mode != "L":
+        cropped_image = cropped_image.convert("L")
+    return np.array(cropped_image)
+
+
+def _decode_with_pil(
+    file: BinaryIO, output_width: int, output_height: int
+) -> np.ndarray:
+    with Image.open(file) as image:
+        cropped_image = crop_center(image, output_width, output_height)
+    return np.array(cropped_image.convert("L"))
+
+
+def _decode_frames_with_pil(
+    data: bytes,
+    output_width: int,
+    output_height: int,
+    num_frames: int,
+    max_decoded_frames: Optional[int] = None,
+) -> np.ndarray:
+    with Image.open(io.BytesIO(data)) as image:
+        total = getattr(image, "n_frames", 1)
+        if max_decoded_frames is not None:
+            total = min(total, max_decoded_frames)
+        crops = []
+        for index in frame_indices(total, num_frames):
+            image.seek(index)
+            cropped_image = crop_center(image, output_width, output_height)
+            crops.append(np.array(cropped_image.convert("L")))
+    return np.stack(crops)
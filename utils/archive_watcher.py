@@ -0,0 +1,115 @@
+import json
+import os
+import time
+import zipfile
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+
+class ArchiveWatcher:
+    """
+    Finds zip archives below a root directory that are new or have grown since
+    they were last processed, and that are complete.
+
+    An archive counts as complete once its size and modification time haven't
+    changed between two polls and its central directory can be read. The
+    state, i.e. the known directories and the processed archives, is kept in a
+    JSON file, so that it survives restarts.
+
+    To avoid walking the whole tree on every poll, a directory is only listed
+    again if its modification time changed, and only archives that were
+    modified within the last active_seconds are checked for growth.
+    """
+
+    def __init__(self, root: Path, state_path: Path, active_seconds: float):
+        self.root = root
+        self.state_path = state_path
+        self.active_seconds = active_seconds
+        self.directories: Dict[str, dict] = {}
+        # Size, modification time and number of processed video snippets of
+        # the processed archives
+        self.archives: Dict[str, dict] = {}
+        if state_path.exists():
+            with state_path.open() as file:
+                state = json.load(file)
+            self.directories = state["directories"]
+            self.archives = state["archives"]
+        # Size and modification time of changed archives at the last poll
+        self._observed: Dict[str, Tuple[int, float]] = {}
+
+    def poll(self) -> List[Path]:
+        """Returns the archives that are ready to be processed."""
+        now = time.time()
+        ready = []
+        for archive in self._scan(str(self.root)):
+            processed = self.archives.get(archive)
+            if processed is not None and now - processed["mtime"] > self.active_seconds:
+                continue
+            try:
+                stat = os.stat(archive)
+            except FileNotFoundError:
+                continue
+            observation = (stat.st_size, stat.st_mtime)
+            if processed is not None and observation == (
+                processed["size"],
+                processed["mtime"],
+            ):
+                continue
+            if self._observed.get(archive) == observation and _has_central_directory(
+                archive
+            ):
+                ready.append(Path(archive))
+            self._observed[archive] = observation
+        return ready
+
+    def processed_members(self, archive: Path) -> int:
+        """Number of video snippets of the archive that were processed."""
+        processed = self.archives.get(str(archive))
+        return 0 if processed is None else processed["members"]
+
+    def mark_processed(self, archive: Path, members: int):
+        size, mtime = self._observed.pop(str(archive))
+        self.archives[str(archive)] = {"size": size, "mtime": mtime, "members": members}
+        self._save()
+
+    def _scan(self, directory: str):
+        mtime = os.stat(directory).st_mtime
+        known = self.directories.get(directory)
+        if known is None or known["mtime"] != mtime:
+            subdirectories = []
+            archives = []
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.is_dir():
+                        subdirectories.append(entry.path)
+                    elif entry.name.endswith(".zip"):
+                        archives.append(entry.path)
+            known = {
+                "mtime": mtime,
+                "subdirectories": sorted(subdirectories),
+                "archives": sorted(archives),
+            }
+            self.directories[directory] = known
+        yield from known["archives"]
+        for subdirectory in known["subdirectories"]:
+            try:
+                yield from self._scan(subdirectory)
+            except FileNotFoundError:
+                continue
+
+    def _save(self):
+        self.state_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.state_path.with_suffix(".tmp")
+        with tmp_path.open("w") as file:
+            json.dump(
+                {"directories": self.directories, "archives": self.archives}, file
+            )
+        os.replace(tmp_path, self.state_path)
+
+
+def _has_central_directory(path: str) -> bool:
+    try:
+        with zipfile.ZipFile(path):
+            return True
+    except (zipfile.BadZipFile, OSError):
+        return False
@@ -0,0 +1,200 @@
+import csv
+import json
+import os
+from pathlib import Path
+from typing import Iterator, List, NamedTuple, Optional, Sequence, Tuple
+
+import numpy as np
+
+# Files of a crop store directory
+META_NAME = "crop_store.json"
+IMAGES_NAME = "crops.u8"
+INDEX_NAME = "index.csv"
+INDEX_COLUMNS = ["date", "archive", "member", "waggle_id", "offset"]
+
+
+class CropRecord(NamedTuple):
+    # Day of the archive, e.g. 2024-07-01
+    date: str
+    # Path of the zip archive relative to the directory of the archives,
+    # without the extension
+    archive: str
+    # APNG member of the archive, e.g. 10/3/3/frames.apng
+    member: str
+    waggle_id: str
+    # Byte offset of the image in the images file
+    offset: int = 0
+
+
+class CropStore:
+    """
+    Packed store of equally sized uint8 grayscale crops, e.g. of a day or a
+    season, in a directory: the crops are concatenated in one file that is
+    memory-mapped as an array of shape (N, H, W), and index.csv has a
+    CropRecord per crop. Compared to one PNG file per crop, nothing has to be
+    listed, opened or decoded to read crops, and a whole season is three
+    files.
+
+    Open a store with mode "a" to append crops. A store is created if it
+    doesn't exist, which needs the image shape. There must be only one
+    writer, readers see the crops that were appended before they opened the
+    store. Crops of an append that was interrupted before its index rows
+    were written, and a last index row that was cut off, are dropped the
+    next time the store is opened for appending, and ignored by readers.
+    """
+
+    def __init__(
+        self,
+        path: Path,
+        mode: str = "r",
+        image_shape: Optional[Tuple[int, int]] = None,
+    ):
+        if mode not in ("r", "a"):
+            raise ValueError(f"Unknown mode: {mode}, expected r or a")
+        self.path = Path(path)
+        self.mode = mode
+        if (self.path / META_NAME).exists():
+            with open(self.path / META_NAME) as f:
+                meta = json.load(f)
+            self.image_shape = (meta["height"], meta["width"])
+            if image_shape is not None and tuple(image_shape) != self.image_shape:
+                raise ValueError(
+                    f"The crops of {self.path} have shape {self.image_shape}, "
+                    f"not {tuple(image_shape)}"
+                )
+        elif mode == "a":
+            if image_shape is None:
+                raise ValueError(f"Creating the crop store {self.path} needs a shape")
+            self.image_shape = tuple(image_shape)
+            self._create()
+        else:
+            raise FileNotFoundError(f"Found no crop store in {self.path}")
+        self.image_bytes = self.image_shape[0] * self.image_shape[1]
+        self.records, index_bytes = self._read_index()
+        self._images: Optional[np.ndarray] = None
+        self._images_file = None
+        self._index_file = None
+        if mode == "a":
+            with open(self.path / INDEX_NAME, "r+b") as f:
+                f.truncate(index_bytes)
+            self._images_file = open(self.path / IMAGES_NAME, "r+b")
+            self._images_file.truncate(len(self.records) * self.image_bytes)
+            self._images_file.seek(0, os.SEEK_END)
+            self._index_file = open(self.path / INDEX_NAME, "a", newline="")
+
+    @staticmethod
+    def exists(path: Path) -> bool:
+        return (Path(path) / META_NAME).exists()
+
+    def __len__(self):
+        return len(self.records)
+
+    @property
+    def images(self) -> np.ndarray:
+        """
+        The crops as a memory-mapped array of shape (N, H, W). Slices are
+        views that read from the file without copying, e.g. batches for
+        ImageClassifier.classify_batch. Writing to them changes only the
+        memory of this process.
+        """
+        if self._images is None or len(self._images) != len(self.records):
+            if not self.records:
+                return np.empty((0, *self.image_shape), dtype=np.uint8)
+            # Copy-on-write, so that the views are writable like other arrays,
+            # e.g. for torch.as_tensor, but the file is never changed.
+            self._images = np.memmap(
+                self.path / IMAGES_NAME,
+                dtype=np.uint8,
+                mode="c",
+                shape=(len(self.records), *self.image_shape),
+            )
+        return self._images
+
+    def __getitem__(self, index) -> np.ndarray:
+        return self.images[index]
+
+    def batches(self, batch_size: int) -> Iterator[Tuple[int, np.ndarray]]:
+        """Start index and view of consecutive batches of crops."""
+        images = self.images
+        for start in range(0, len(images), batch_size):
+            yield start, images[start : start + batch_size]
+
+    def append(self, images: np.ndarray, records: Sequence[CropRecord]) -> range:
+        """
+        Appends crops of shape (N, H, W) and their records, whose offsets are
+        set by the store. Returns the indices of the crops.
+        """
+        if self.mode != "a":
+            raise ValueError(f"The crop store {self.path} is opened read-only")
+        images = np.ascontiguousarray(images, dtype=np.uint8)
+        if images.shape[1:] != self.image_shape or len(images) != len(records):
+            raise ValueError(
+                f"Expected {len(records)} crops of shape {self.image_shape}, "
+                f"got an array of shape {images.shape}"
+            )
+        start = len(self.records)
+        records = [
+            record._replace(offset=(start + i) * self.image_bytes)
+            for i, record in enumerate(records)
+        ]
+        # The crops are written before their index rows, so that readers
+        # never find a row without its crop.
+        self._images_file.write(images.tobytes())
+        self._images_file.flush()
+        csv.writer(self._index_file).writerows(records)
+        self._index_file.flush()
+        self.records += records
+        return range(start, len(self.records))
+
+    def close(self):
+        for file in (self._images_file, self._index_file):
+            if file is not None:
+                file.close()
+        self._images_file = self._index_file = None
+        self._images = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _read_index(self) -> Tuple[List[CropRecord], int]:
+        """
+        Records of the index and the length in bytes of the header and their
+        rows. Reading stops at a row that was cut off by an interrupted
+        append, i.e. that has no line break, misses fields or has another
+        offset than its position.
+        """
+        with open(self.path / INDEX_NAME, "rb") as f:
+            lines = f.read().splitlines(keepends=True)
+        records = []
+        index_bytes = len(lines[0])
+        for line in lines[1:]:
+            fields = next(csv.reader([line.decode()]), [])
+            if (
+                not line.endswith(b"\n")
+                or len(fields) != len(INDEX_COLUMNS)
+                or fields[-1] != str(len(records) * self.image_bytes)
+            ):
+                break
+            records.append(CropRecord(*fields[:-1], int(fields[-1])))
+            index_bytes += len(line)
+        return records, index_bytes
+
+    def _create(self):
+        self.path.mkdir(parents=True, exist_ok=True)
+        with open(self.path / INDEX_NAME, "w", newline="") as f:
+            csv.writer(f).writerow(INDEX_COLUMNS)
+        (self.path / IMAGES_NAME).touch()
+        # Written last, it marks the store as complete.
+        with open(self.path / META_NAME, "w") as f:
+            json.dump({"height": self.image_shape[0], "width": self.image_shape[1]}, f)
+
+
+def crop_filename(member: str) -> str:
+    """
+    Name of the PNG file of the crop of an APNG member, as written by
+    scripts/crop_images.py, i.e. "10/3/3/frames.apng" -> "10_3_3.png".
+    """
+    return member.replace("/frames.apng", ".png").replace("/", "_")
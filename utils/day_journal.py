@@ -0,0 +1,74 @@
+import json
+import threading
+from pathlib import Path
+from typing import Dict, Set
+
+
+class DayJournal:
+    """
+    Append-only record of the progress of processing one day of WDD data.
+
+    Every line is a JSON object. A "classified" entry holds the classification
+    result of a detection, an "encoded" entry marks that the video of a
+    detection was encoded. Loading an existing journal restores both, so an
+    interrupted day can be resumed. A truncated last line, e.g. after a crash,
+    is ignored.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.classified: Dict[str, dict] = {}
+        self.encoded: Set[str] = set()
+        if path.exists():
+            with path.open() as file:
+                for line in file:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    self._apply(entry)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._file = path.open("a")
+        # Entries are written by the worker threads of the pipeline stages.
+        self._lock = threading.Lock()
+
+    def record_classified(
+        self,
+        day_dance_id: str,
+        waggle_id: int,
+        prediction: int,
+        confidence: float,
+        dance_type: str,
+    ):
+        self._write(
+            {
+                "event": "classified",
+                "day_dance_id": day_dance_id,
+                "waggle_id": waggle_id,
+                "prediction": int(prediction),
+                "confidence": float(confidence),
+                "dance_type": dance_type,
+            }
+        )
+
+    def record_encoded(self, day_dance_id: str):
+        self._write({"event": "encoded", "day_dance_id": day_dance_id})
+
+    def close(self):
+        self._file.close()
+
+    def remove(self):
+        self.close()
+        self.path.unlink(missing_ok=True)
+
+    def _write(self, entry: dict):
+        with self._lock:
+            self._file.write(json.dumps(entry) + "\n")
+            self._file.flush()
+            self._apply(entry)
+
+    def _apply(self, entry: dict):
+        if entry["event"] == "classified":
+            self.classified[entry["day_dance_id"]] = entry
+        elif entry["event"] == "encoded":
+            self.encoded.add(entry["day_dance_id"])
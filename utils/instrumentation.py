@@ -0,0 +1,222 @@
+import json
+import math
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Optional
+
+# Latencies are counted in buckets that grow by a factor of 2 ** (1 / 8), so
+# percentiles are accurate to about 9% and histograms of days can be merged.
+_BUCKETS_PER_OCTAVE = 8
+
+
+class StageStats:
+    """Number of calls and items, total time and latency histogram of a stage."""
+
+    def __init__(self):
+        self.calls = 0
+        self.items = 0
+        self.seconds = 0.0
+        self.latency_buckets: Counter = Counter()
+
+    def add(self, seconds: float, items: int = 1):
+        self.calls += 1
+        self.items += items
+        self.seconds += seconds
+        # Every item of a call waits for the whole call.
+        self.latency_buckets[_bucket(seconds)] += items
+
+    def merge(self, other: "StageStats"):
+        self.calls += other.calls
+        self.items += other.items
+        self.seconds += other.seconds
+        self.latency_buckets.update(other.latency_buckets)
+
+    def percentile(self, q: float) -> float:
+        """Latency in seconds that q percent of the items don't exceed."""
+        total = sum(self.latency_buckets.values())
+        if total == 0:
+            return 0.0
+        rank = math.ceil(total * q / 100)
+        seen = 0
+        for bucket in sorted(self.latency_buckets):
+            seen += self.latency_buckets[bucket]
+            if seen >= rank:
+                return 2 ** ((bucket + 0.5) / _BUCKETS_PER_OCTAVE)
+        return 0.0
+
+    def to_dict(self) -> dict:
+        return {
+            "calls": self.calls,
+            "items": self.items,
+            "seconds": round(self.seconds, 6),
+            "p50_ms": round(1000 * self.percentile(50), 3),
+            "p99_ms": round(1000 * self.percentile(99), 3),
+        }
+
+
+class DayTimings:
+    """
+    Timings of the stages of processing one day. Stages can be timed from
+    several threads at once. Stages that overlap, e.g. the stages of a
+    pipeline, add up to more than the wall time of the day.
+    """
+
+    def __init__(self, date: str):
+        self.date = date
+        self.detections = 0
+        self.seconds = 0.0
+        self.stages: Dict[str, StageStats] = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def time(self, stage: str, items: int = 1):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - start, items)
+
+    def record(self, stage: str, seconds: float, items: int = 1):
+        with self._lock:
+            if stage not in self.stages:
+                self.stages[stage] = StageStats()
+            self.stages[stage].add(seconds, items)
+
+    def to_dict(self) -> dict:
+        return {
+            "date": self.date,
+            "detections": self.detections,
+            "seconds": round(self.seconds, 6),
+            "detections_per_second": _rate(self.detections, self.seconds),
+            "stages": {name: stats.to_dict() for name, stats in self.stages.items()},
+        }
+
+    def __getstate__(self):
+        # Timings are sent back from worker processes, locks can't be pickled.
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+
+class RunReport:
+    """
+    Machine-readable report of a run: a JSON line with the timings of every
+    day, and a last line with the summary of all days.
+
+    The seconds and the throughput of the summary are measured from opening
+    to closing the report, as days that are processed in parallel overlap.
+    day_seconds is the sum of the seconds of the days.
+    """
+
+    def __init__(self, path: Path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._file = path.open("w")
+        self.start = time.perf_counter()
+        self.days = 0
+        self.detections = 0
+        self.day_seconds = 0.0
+        self.stages: Dict[str, StageStats] = {}
+
+    def add_day(self, timings: DayTimings):
+        self._file.write(json.dumps(timings.to_dict()) + "\n")
+        self._file.flush()
+        self.days += 1
+        self.detections += timings.detections
+        self.day_seconds += timings.seconds
+        for name, stats in timings.stages.items():
+            self.stages.setdefault(name, StageStats()).merge(stats)
+
+    def close(self):
+        seconds = time.perf_counter() - self.start
+        summary = {
+            "summary": True,
+            "days": self.days,
+            "detections": self.detections,
+            "seconds": round(seconds, 6),
+            "day_seconds": round(self.day_seconds, 6),
+            "detections_per_second": _rate(self.detections, seconds),
+            "stages": {name: stats.to_dict() for name, stats in self.stages.items()},
+        }
+        self._file.write(json.dumps(summary) + "\n")
+        self._file.close()
+
+
+class StackSampler:
+    """
+    Samples the call stacks of all threads at a fixed interval while active.
+    Unlike cProfile, this also covers the worker threads of a pipeline. The
+    stacks are written in the collapsed format of flamegraph.pl, which
+    speedscope can read, too.
+    """
+
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.stacks: Counter = Counter()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+
+    def write(self, path: Path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with path.open("w") as file:
+            for stack, count in self.stacks.most_common():
+                file.write(f"{stack} {count}\n")
+
+    def _sample(self):
+        own_id = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                functions = []
+                while frame is not None:
+                    code = frame.f_code
+                    functions.append(f"{Path(code.co_filename).stem}:{code.co_name}")
+                    frame = frame.f_back
+                thread_name = names.get(thread_id, str(thread_id))
+                self.stacks[";".join([thread_name] + functions[::-1])] += 1
+
+
+@contextmanager
+def sample_stacks(path: Optional[Path]):
+    """Samples the call stacks into path, does nothing if path is None."""
+    if path is None:
+        yield
+        return
+    sampler = StackSampler()
+    try:
+        with sampler:
+            yield
+    finally:
+        sampler.write(path)
+        print(f"Wrote sampled call stacks to {path}")
+
+
+def profile_path(report_path: Path, date: str) -> Path:
+    """Path of the sampled call stacks of a day, next to the run report."""
+    return report_path.with_name(f"{report_path.stem}-{date}.stacks.txt")
+
+
+def _bucket(seconds: float) -> int:
+    return math.floor(math.log2(max(seconds, 1e-9)) * _BUCKETS_PER_OCTAVE)
+
+
+def _rate(items: int, seconds: float) -> float:
+    return round(items / seconds, 3) if seconds > 0 else 0.0
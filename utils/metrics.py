@@ -0,0 +1,197 @@
+import math
+from typing import Dict, Optional, Sequence
+
+import numpy as np
+
+# Scores are counted in bins that are uniform in log-odds, so scores close to
+# 0 or 1, where the classifiers are most confident, stay distinguishable.
+# Within the range, bins are 0.0006 wide in log-odds.
+DEFAULT_NUM_BINS = 1 << 16
+_MAX_LOG_ODDS = 20.0
+
+
+class BinaryMetrics:
+    """
+    Streaming metrics of a binary classifier. The confusion counts and the
+    histograms of the scores of positive and negative samples are accumulated
+    batch by batch in constant memory. Metrics of days, splits or worker
+    processes can be combined with merge.
+
+    Precision, recall and F1 score are computed from the confusion counts and
+    match sklearn with zero_division=np.nan. The ROC AUC is computed from the
+    histograms, with scores in the same bin counting as ties, and matches
+    sklearn's roc_auc_score to about 1e-4 unless many scores of both classes
+    differ by less than a bin.
+    """
+
+    def __init__(self, positive: int = 1, num_bins: int = DEFAULT_NUM_BINS):
+        # Label of the positive class, e.g. TagStatus.tagged.value
+        self.positive = positive
+        self.num_bins = num_bins
+        # Counts by true and predicted label, 1 is positive
+        self.confusion = np.zeros((2, 2), dtype=np.int64)
+        # Score histograms of the negative and positive samples
+        self.histograms = np.zeros((2, num_bins), dtype=np.int64)
+
+    def update(self, y_true, y_pred, scores: Optional[Sequence[float]] = None):
+        """
+        Adds a batch of true and predicted labels and, for the ROC AUC, the
+        probabilities of the positive class. Accepts arrays, lists, tensors on
+        the CPU and scalars.
+        """
+        is_positive = np.atleast_1d(np.asarray(y_true)) == self.positive
+        predicted_positive = np.atleast_1d(np.asarray(y_pred)) == self.positive
+        self.confusion += np.bincount(
+            2 * is_positive + predicted_positive, minlength=4
+        ).reshape(2, 2)
+        if scores is not None:
+            bins = self._bins(np.atleast_1d(np.asarray(scores, dtype=np.float64)))
+            self.histograms += np.bincount(
+                is_positive * self.num_bins + bins, minlength=2 * self.num_bins
+            ).reshape(2, self.num_bins)
+
+    def merge(self, other: "BinaryMetrics"):
+        if (other.positive, other.num_bins) != (self.positive, self.num_bins):
+            raise ValueError(
+                "Can only merge metrics with the same positive class and bins"
+            )
+        self.confusion += other.confusion
+        self.histograms += other.histograms
+
+    @classmethod
+    def merged(cls, parts: Sequence["BinaryMetrics"], **kwargs) -> "BinaryMetrics":
+        """Combination of partial metrics, e.g. of several days."""
+        metrics = cls(**kwargs)
+        for part in parts:
+            metrics.merge(part)
+        return metrics
+
+    @property
+    def tp(self) -> int:
+        return int(self.confusion[1, 1])
+
+    @property
+    def fp(self) -> int:
+        return int(self.confusion[0, 1])
+
+    @property
+    def fn(self) -> int:
+        return int(self.confusion[1, 0])
+
+    @property
+    def tn(self) -> int:
+        return int(self.confusion[0, 0])
+
+    @property
+    def count(self) -> int:
+        return int(self.confusion.sum())
+
+    def accuracy(self) -> float:
+        return _divide(self.tp + self.tn, self.count)
+
+    def precision(self) -> float:
+        return _divide(self.tp, self.tp + self.fp)
+
+    def recall(self) -> float:
+        return _divide(self.tp, self.tp + self.fn)
+
+    def f1_score(self) -> float:
+        return _divide(2 * self.tp, 2 * self.tp + self.fp + self.fn)
+
+    def roc_auc_score(self) -> float:
+        """
+        Probability that a positive sample scores higher than a negative one,
+        with ties counting half, i.e. the area under the ROC curve. NaN if
+        there are no scores of one of the classes.
+        """
+        negatives, positives = self.histograms
+        num_negatives, num_positives = negatives.sum(), positives.sum()
+        if num_negatives == 0 or num_positives == 0:
+            return math.nan
+        negatives_below = np.cumsum(negatives) - negatives
+        wins = (positives * (negatives_below + 0.5 * negatives)).sum()
+        return float(wins / (num_positives * num_negatives))
+
+    def confusion_matrix(self) -> Dict[str, int]:
+        return {
+            "true_positive": self.tp,
+            "true_negative": self.tn,
+            "false_positive": self.fp,
+            "false_negative": self.fn,
+        }
+
+    def classification_report(
+        self, names: Sequence[str] = ("negative", "positive"), digits: int = 2
+    ) -> str:
+        """
+        Precision, recall, F1 score and support of the classes that occur,
+        like sklearn's classification_report.
+        """
+        rows = {}
+        for index, name in enumerate(names):
+            # The metrics of the negative class swap the roles of the classes.
+            tp = int(self.confusion[index, index])
+            fp = int(self.confusion[1 - index, index])
+            fn = int(self.confusion[index, 1 - index])
+            if tp + fp + fn == 0:
+                continue
+            rows[name] = (
+                _divide(tp, tp + fp, 0.0),
+                _divide(tp, tp + fn, 0.0),
+                _divide(2 * tp, 2 * tp + fp + fn, 0.0),
+                tp + fn,
+            )
+        supports = np.array([row[3] for row in rows.values()])
+        scores = np.array([row[:3] for row in rows.values()]).reshape(-1, 3)
+        averages = {
+            "macro avg": scores.mean(axis=0) if len(rows) else np.zeros(3),
+            "weighted avg": _weighted_mean(scores, supports),
+        }
+        width = max([len(name) for name in rows] + [len("weighted avg"), digits])
+        lines = [
+            f"{'':>{width}}  {'precision':>9} {'recall':>9} {'f1-score':>9} {'support':>9}",
+            "",
+        ]
+        for name, (precision, recall, f1, support) in rows.items():
+            lines.append(
+                f"{name:>{width}}  {precision:>9.{digits}f} {recall:>9.{digits}f} "
+                f"{f1:>9.{digits}f} {support:>9}"
+            )
+        lines += [
+            "",
+            f"{'accuracy':>{width}}  {'':>9} {'':>9} "
+            f"{self.accuracy():>9.{digits}f} {self.count:>9}",
+        ]
+        for name, (precision, recall, f1) in averages.items():
+            lines.append(
+                f"{name:>{width}}  {precision:>9.{digits}f} {recall:>9.{digits}f} "
+                f"{f1:>9.{digits}f} {self.count:>9}"
+            )
+        return "\n".join(lines) + "\n"
+
+    def to_dict(self) -> dict:
+        return {
+            "confusion_matrix": self.confusion_matrix(),
+            "accuracy": self.accuracy(),
+            "precision": self.precision(),
+            "recall": self.recall(),
+            "f1_score": self.f1_score(),
+            "roc_auc_score": self.roc_auc_score(),
+        }
+
+    def _bins(self, scores: np.ndarray) -> np.ndarray:
+        with np.errstate(divide="ignore"):
+            log_odds = np.log(scores) - np.log1p(-scores)
+        log_odds = np.clip(np.nan_to_num(log_odds), -_MAX_LOG_ODDS, _MAX_LOG_ODDS)
+        bins = (log_odds + _MAX_LOG_ODDS) / (2 * _MAX_LOG_ODDS) * self.num_bins
+        return np.minimum(bins.astype(np.intp), self.num_bins - 1)
+
+
+def _divide(numerator: float, denominator: float, zero_division=math.nan) -> float:
+    return numerator / denominator if denominator else zero_division
+
+
+def _weighted_mean(scores: np.ndarray, weights: np.ndarray) -> np.ndarray:
+    if weights.sum() == 0:
+        return np.zeros(3)
+    return (scores * weights[:, np.newaxis]).sum(axis=0) / weights.sum()
@@ -0,0 +1,144 @@
+import queue
+import threading
+import time
+from collections import Counter
+from concurrent.futures import Future
+from typing import Callable, Optional, Tuple
+
+import numpy as np
+
+from utils.instrumentation import StageStats
+
+# Marks the end of the requests in the queue
+_CLOSED = object()
+
+
+class _Request:
+    def __init__(self, images: np.ndarray):
+        self.images = images
+        self.future: Future = Future()
+        self.start = time.perf_counter()
+
+
+class MicroBatcher:
+    """
+    Merges concurrent requests into batches that are classified by a single
+    worker thread. A batch is classified as soon as it holds max_batch_size
+    images or max_wait seconds have passed since its first request arrived,
+    so a lone request waits at most max_wait. Requests are never split, a
+    request with more than max_batch_size images is classified on its own.
+
+    classify_batch is called with a stacked uint8 batch and returns a tuple of
+    arrays with one entry per image, e.g. ImageClassifier.classify_batch.
+    """
+
+    def __init__(
+        self,
+        classify_batch: Callable[[np.ndarray], Tuple[np.ndarray, ...]],
+        max_batch_size: int = 64,
+        max_wait: float = 0.002,
+    ):
+        self.classify_batch = classify_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.requests = 0
+        self.batches = 0
+        self.batch_sizes: Counter = Counter()
+        # Time from a request arriving to its results, per image
+        self.latency = StageStats()
+        # Time of the forward passes, per batch
+        self.compute = StageStats()
+        self._stats_lock = threading.Lock()
+        self._queue: queue.Queue = queue.Queue()
+        self._thread = threading.Thread(
+            target=self._run, name="micro-batcher", daemon=True
+        )
+        self._thread.start()
+
+    def submit(self, images: np.ndarray) -> Future:
+        """
+        Queues a stacked batch of images, returns a future of the results for
+        these images.
+        """
+        request = _Request(images)
+        self._queue.put(request)
+        return request.future
+
+    def classify(self, images: np.ndarray, timeout: Optional[float] = None):
+        """Classifies a stacked batch of images together with other requests."""
+        return self.submit(images).result(timeout)
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            images = sum(size * count for size, count in self.batch_sizes.items())
+            return {
+                "requests": self.requests,
+                "images": images,
+                "batches": self.batches,
+                "mean_batch_size": round(images / self.batches, 3)
+                if self.batches
+                else 0.0,
+                "max_batch_size": max(self.batch_sizes, default=0),
+                "queued_requests": self._queue.qsize(),
+                "latency": self.latency.to_dict(),
+                "compute": self.compute.to_dict(),
+            }
+
+    def close(self):
+        """Classifies the queued requests, then stops the worker thread."""
+        self._queue.put(_CLOSED)
+        self._thread.join()
+
+    def _run(self):
+        pending = None
+        closed = False
+        while not closed:
+            request = pending if pending is not None else self._queue.get()
+            pending = None
+            if request is _CLOSED:
+                break
+            batch = [request]
+            size = len(request.images)
+            deadline = request.start + self.max_wait
+            while size < self.max_batch_size:
+                try:
+                    request = self._queue.get(
+                        timeout=max(deadline - time.perf_counter(), 0)
+                    )
+                except queue.Empty:
+                    break
+                if request is _CLOSED:
+                    closed = True
+                    break
+                if size + len(request.images) > self.max_batch_size:
+                    # Starts the next batch
+                    pending = request
+                    break
+                batch.append(request)
+                size += len(request.images)
+            self._classify(batch)
+
+    def _classify(self, batch):
+        start = time.perf_counter()
+        try:
+            images = np.concatenate([request.images for request in batch])
+            results = self.classify_batch(images)
+        except Exception as e:
+            for request in batch:
+                request.future.set_exception(e)
+            return
+        end = time.perf_counter()
+        offset = 0
+        for request in batch:
+            count = len(request.images)
+            request.future.set_result(
+                tuple(result[offset : offset + count] for result in results)
+            )
+            offset += count
+        with self._stats_lock:
+            self.requests += len(batch)
+            self.batches += 1
+            self.batch_sizes[len(images)] += 1
+            self.compute.add(end - start, len(images))
+            for request in batch:
+                self.latency.add(end - request.start, len(request.images))
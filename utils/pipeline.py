@@ -0,0 +1,185 @@
+import queue
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Optional
+
+from utils.instrumentation import DayTimings
+
+# Marks the end of the items in a queue
+_DONE = object()
+# Returned instead of an item once the pipeline is aborted
+_ABORTED = object()
+
+
+class Stage:
+    """
+    A step of a Pipeline that is run by one or more worker threads.
+
+    The function is called for every item of the input queue and returns an
+    iterable of items for the next stage, e.g. an empty list to drop an item.
+    If batch_size is set, the function is instead called with lists of
+    batch_size items, only the last batch may be smaller.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        function: Callable,
+        workers: int = 1,
+        batch_size: Optional[int] = None,
+    ):
+        self.name = name
+        self.function = function
+        self.workers = workers
+        self.batch_size = batch_size
+
+
+class Pipeline:
+    """
+    Runs stages concurrently, connected by bounded queues, so that memory use
+    doesn't depend on the number of items. The items returned by the last
+    stage are discarded. If timings are given, every call of a stage function
+    is timed under the name of the stage.
+    """
+
+    def __init__(
+        self,
+        stages: List[Stage],
+        queue_size: int = 64,
+        timings: Optional[DayTimings] = None,
+    ):
+        self.stages = stages
+        self.timings = timings
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in stages]
+        self._abort = threading.Event()
+        self._exception: Optional[BaseException] = None
+
+    def queue_depths(self) -> Dict[str, int]:
+        """Number of items waiting in front of each stage."""
+        return {
+            stage.name: input_queue.qsize()
+            for stage, input_queue in zip(self.stages, self.queues)
+        }
+
+    def run(
+        self,
+        items: Iterable,
+        report: Optional[Callable[[Dict[str, int]], None]] = None,
+        report_interval: float = 1.0,
+    ):
+        """
+        Feeds the items into the first stage and waits until all stages are
+        done. If given, report is called with the queue depths every
+        report_interval seconds. Re-raises the first exception of a stage.
+        """
+        threads = [threading.Thread(target=self._feed, args=(items,), daemon=True)]
+        for index, stage in enumerate(self.stages):
+            remaining = [stage.workers]
+            lock = threading.Lock()
+            for worker in range(stage.workers):
+                threads.append(
+                    threading.Thread(
+                        target=self._work,
+                        args=(index, remaining, lock),
+                        name=f"{stage.name}-{worker}",
+                        daemon=True,
+                    )
+                )
+        for thread in threads:
+            thread.start()
+        last_report = time.monotonic()
+        try:
+            for thread in threads:
+                while thread.is_alive():
+                    thread.join(timeout=0.1)
+                    if report is not None and time.monotonic() - last_report >= (
+                        report_interval
+                    ):
+                        report(self.queue_depths())
+                        last_report = time.monotonic()
+        except BaseException:
+            # E.g. a KeyboardInterrupt. The workers finish their current item
+            # and stop before the exception is propagated, so that none of
+            # them runs after run returns, e.g. writing to a closed journal.
+            self._abort.set()
+            for thread in threads:
+                thread.join()
+            raise
+        if self._exception is not None:
+            raise self._exception
+
+    def _feed(self, items: Iterable):
+        try:
+            for item in items:
+                if not self._put(self.queues[0], item):
+                    return
+        except BaseException as e:
+            self._fail(e)
+            return
+        self._put(self.queues[0], _DONE)
+
+    def _work(self, index: int, remaining: List[int], lock: threading.Lock):
+        stage = self.stages[index]
+        input_queue = self.queues[index]
+        output_queue = self.queues[index + 1] if index + 1 < len(self.queues) else None
+        try:
+            while True:
+                item = self._get(input_queue)
+                if item is _DONE:
+                    # Let the other workers of this stage see the end, too.
+                    input_queue.put(_DONE)
+                    break
+                if item is _ABORTED:
+                    return
+                if stage.batch_size is None:
+                    outputs = self._call(stage, item, 1)
+                else:
+                    batch = [item]
+                    while len(batch) < stage.batch_size:
+                        item = self._get(input_queue)
+                        if item is _ABORTED:
+                            return
+                        if item is _DONE:
+                            input_queue.put(_DONE)
+                            break
+                        batch.append(item)
+                    outputs = self._call(stage, batch, len(batch))
+                for output in outputs:
+                    if output_queue is not None and not self._put(output_queue, output):
+                        return
+        except BaseException as e:
+            self._fail(e)
+            return
+        with lock:
+            remaining[0] -= 1
+            last = remaining[0] == 0
+        if last and output_queue is not None:
+            self._put(output_queue, _DONE)
+
+    def _call(self, stage: Stage, argument, items: int):
+        if self.timings is None:
+            return stage.function(argument)
+        with self.timings.time(stage.name, items):
+            return stage.function(argument)
+
+    def _put(self, target_queue: queue.Queue, item) -> bool:
+        while not self._abort.is_set():
+            try:
+                target_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _get(self, source_queue: queue.Queue):
+        while not self._abort.is_set():
+            try:
+                return source_queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        return _ABORTED
+
+    def _fail(self, exception: BaseException):
+        if self._exception is None:
+            self._exception = exception
+        self._abort.set()
@@ -0,0 +1,155 @@
+import hashlib
+import math
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Sequence, Tuple
+
+DEFAULT_CACHE_PATH = Path("output/prediction_cache.sqlite")
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+# The size of the database is checked after this many inserted entries, and
+# evicting shrinks it to this fraction of the maximum size.
+SIZE_CHECK_INTERVAL = 10_000
+LOW_WATER_FRACTION = 0.8
+
+# Prediction, confidence and tagged probability of an image
+CachedPrediction = Tuple[int, float, float]
+
+
+class PredictionCache:
+    """
+    Persistent cache of classification results in an SQLite database.
+
+    Entries are keyed by an archive, i.e. a zip archive or a directory of
+    images, the CRC32 of a member of the archive and the hash of the model
+    weights, so changing the model file invalidates the cache. Entries of
+    other model weights are kept, e.g. for switching between models or
+    variants, until they are evicted: once the entries take more than
+    max_bytes, the least recently used entries are evicted.
+    """
+
+    def __init__(
+        self, path: Path, model_path: Path, max_bytes: int = DEFAULT_MAX_BYTES
+    ):
+        self.max_bytes = max_bytes
+        self.model_hash = hash_file(model_path)
+        # Entries inserted by this instance since the size was checked
+        self._inserted = 0
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Several worker processes may share the cache, so wait for their
+        # writes instead of failing.
+        self._connection = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        # The stages of a day run on different threads.
+        self._lock = threading.Lock()
+        with self._lock, self._connection:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS predictions (
+                    archive TEXT NOT NULL,
+                    crc32 INTEGER NOT NULL,
+                    model_hash TEXT NOT NULL,
+                    prediction INTEGER NOT NULL,
+                    confidence REAL NOT NULL,
+                    tagged_probability REAL NOT NULL,
+                    last_used REAL NOT NULL,
+                    PRIMARY KEY (archive, crc32, model_hash)
+                )
+                """
+            )
+            self._connection.execute(
+                "CREATE INDEX IF NOT EXISTS predictions_last_used "
+                "ON predictions (last_used)"
+            )
+            # Runs may insert fewer entries than SIZE_CHECK_INTERVAL.
+            self._evict()
+
+    def get_archive(self, archive: str) -> Dict[int, CachedPrediction]:
+        """Returns the cached predictions of an archive by CRC32."""
+        with self._lock, self._connection:
+            self._connection.execute(
+                "UPDATE predictions SET last_used = ? "
+                "WHERE archive = ? AND model_hash = ?",
+                (time.time(), archive, self.model_hash),
+            )
+            rows = self._connection.execute(
+                "SELECT crc32, prediction, confidence, tagged_probability "
+                "FROM predictions WHERE archive = ? AND model_hash = ?",
+                (archive, self.model_hash),
+            ).fetchall()
+        return {row[0]: row[1:] for row in rows}
+
+    def put_many(
+        self,
+        archive: str,
+        crc32s: Sequence[int],
+        predictions: Sequence[int],
+        confidences: Sequence[float],
+        tagged_probabilities: Sequence[float],
+    ):
+        """Adds the predictions of members of an archive to the cache."""
+        now = time.time()
+        rows = [
+            (
+                archive,
+                int(crc32),
+                self.model_hash,
+                int(prediction),
+                float(confidence),
+                float(tagged_probability),
+                now,
+            )
+            for crc32, prediction, confidence, tagged_probability in zip(
+                crc32s, predictions, confidences, tagged_probabilities
+            )
+        ]
+        with self._lock, self._connection:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO predictions VALUES (?, ?, ?, ?, ?, ?, ?)", rows
+            )
+            self._inserted += len(rows)
+            if self._inserted >= SIZE_CHECK_INTERVAL:
+                self._inserted = 0
+                self._evict()
+
+    def size(self) -> int:
+        """Bytes of the pages that are in use, i.e. not freed by evictions."""
+        (page_count,) = self._connection.execute("PRAGMA page_count").fetchone()
+        (free_pages,) = self._connection.execute("PRAGMA freelist_count").fetchone()
+        (page_size,) = self._connection.execute("PRAGMA page_size").fetchone()
+        return (page_count - free_pages) * page_size
+
+    def close(self):
+        self._connection.close()
+
+    def _evict(self):
+        """
+        If the entries take more than max_bytes, evicts the least recently
+        used entries down to LOW_WATER_FRACTION of max_bytes, so that the next
+        inserts don't evict again right away. Freed pages are reused by later
+        inserts, the file doesn't shrink.
+        """
+        size = self.size()
+        if size <= self.max_bytes:
+            return
+        (num_entries,) = self._connection.execute(
+            "SELECT COUNT(*) FROM predictions"
+        ).fetchone()
+        # Assumes that all entries take about the same space
+        num_evicted = math.ceil(
+            num_entries * (1 - LOW_WATER_FRACTION * self.max_bytes / size)
+        )
+        self._connection.execute(
+            "DELETE FROM predictions WHERE rowid IN ("
+            "SELECT rowid FROM predictions ORDER BY last_used LIMIT ?)",
+            (num_evicted,),
+        )
+
+
+def hash_file(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
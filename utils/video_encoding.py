@@ -0,0 +1,56 @@
+import os
+import tempfile
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Optional, Union
+
+
+def encode_video(
+    input: Union[Path, bytes], output: Path, threads: Optional[int] = None
+):
+    """
+    Encodes an APNG video to an MP4 video. The input is either a path or the
+    bytes of the APNG file, e.g. read from a zip archive.
+    """
+    if isinstance(input, bytes):
+        with in_memory_file(input) as input_path:
+            encode_video(input_path, output, threads)
+        return
+    # python-ffmpeg is imported when a video is encoded, so that the tools
+    # start faster.
+    from ffmpeg import FFmpeg
+
+    output.parent.mkdir(parents=True, exist_ok=True)
+    options = {"codec:v": "libx264"}
+    if threads is not None:
+        options["threads"] = threads
+    ffmpeg = (
+        FFmpeg()
+        .option("y")
+        .input(str(input), f="apng")
+        .output(str(output), options, crf=18, pix_fmt="yuv420p")
+    )
+    ffmpeg.execute()
+
+
+@contextmanager
+def in_memory_file(data: bytes):
+    """
+    Provides the data under a path that ffmpeg can open. ffmpeg's APNG demuxer
+    needs a seekable input, so the data can't be piped through stdin. On Linux,
+    an anonymous in-memory file is used, elsewhere a temporary file.
+    """
+    if hasattr(os, "memfd_create"):
+        fd = os.memfd_create("frames.apng")
+        try:
+            os.write(fd, data)
+            yield Path(f"/proc/{os.getpid()}/fd/{fd}")
+        finally:
+            os.close(fd)
+    else:
+        with tempfile.NamedTemporaryFile(suffix=".apng", delete=False) as file:
+            file.write(data)
+        try:
+            yield Path(file.name)
+        finally:
+            os.remove(file.name)
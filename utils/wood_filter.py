@@ -0,0 +1,146 @@
+import datetime
+from pathlib import Path
+from typing import TYPE_CHECKING, Sequence
+
+import numpy as np
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+# Values were determined from a single wdd image.
+WOOD_OFFSET_X = 100
+WOOD_OFFSET_TOP = 80
+WOOD_OFFSET_BOT = 220
+
+# Correct the -125 offset of the roi coordinates in the metadata
+ROI_CORRECTION_OFFSET = 125
+
+
+def validate_csv_path(path: Path) -> None:
+    if not path.exists():
+        raise FileNotFoundError(f"File does not exist: {path}")
+    if not path.is_file():
+        raise ValueError(f"Not a file: {path}")
+    if path.suffix.lower() != ".csv":
+        raise ValueError(f"Not a CSV file: {path}")
+
+
+class MarkerIndex:
+    """
+    Marker coordinates at the corners of the comb, indexed by the time at which
+    they were recorded.
+
+    The markers CSV is loaded once. The marker epochs are kept sorted so that
+    the most recent epoch before a detection is found by binary search, and
+    the border of the area within the wooden frame is precomputed per epoch.
+    """
+
+    def __init__(
+        self, timestamps: "pd.DatetimeIndex", borders: np.ndarray, image_size: int
+    ):
+        self.timestamps = timestamps
+        # One row of (left, top, right, bottom) per marker epoch.
+        self.borders = borders
+        self.image_size = image_size
+
+    @classmethod
+    def from_csv(cls, wdd_markers_path: Path, image_size: int):
+        # pandas is imported when it's needed, so that tools that don't use the
+        # wood filter start faster.
+        import pandas as pd
+
+        df_markers = pd.read_csv(wdd_markers_path)
+        # Like the detection timestamps, see parse_timestamp
+        df_markers["timestamp"] = pd.to_datetime(
+            df_markers["timestamp"], format="ISO8601", utc=True
+        ).dt.tz_localize(None)
+        timestamps = []
+        borders = []
+        for timestamp, markers in df_markers.groupby("timestamp", sort=True):
+            if markers.shape[0] < 4:
+                raise ValueError(
+                    f"Expected 4 markers at {timestamp}, found {markers.shape[0]}"
+                )
+            x = markers["x"].to_numpy()
+            y = markers["y"].to_numpy()
+            # These borders span an area on the comb that is within the wooden frame.
+            borders.append(
+                (
+                    max(x[0] + WOOD_OFFSET_X, x[2] + WOOD_OFFSET_X),
+                    max(y[0] + WOOD_OFFSET_TOP, y[1] + WOOD_OFFSET_TOP),
+                    min(x[1] - WOOD_OFFSET_X, x[3] - WOOD_OFFSET_X),
+                    min(y[2] - WOOD_OFFSET_BOT, y[3] - WOOD_OFFSET_BOT),
+                )
+            )
+            timestamps.append(timestamp)
+        return cls(
+            pd.DatetimeIndex(timestamps),
+            np.array(borders, dtype=float).reshape(-1, 4),
+            image_size,
+        )
+
+    def is_wood_in_frame(self, json_data) -> bool:
+        """
+        Estimates whether the cropped image of the corresponding dance shows a
+        part of the wooden frame on the comb based on the position of the dance.
+        """
+        epoch = (
+            self.timestamps.searchsorted(
+                parse_timestamp(json_data["timestamp_begin"]), side="right"
+            )
+            - 1
+        )
+        if epoch < 0:
+            return False
+        return bool(
+            self._outside_borders(
+                self.borders[epoch], np.asarray(json_data["roi_center"], dtype=float)
+            )
+        )
+
+    def wood_mask(
+        self, timestamps: Sequence[str], roi_centers: Sequence[Sequence[int]]
+    ) -> np.ndarray:
+        """
+        Vectorized version of is_wood_in_frame for many detections, e.g. all
+        detections of a day. Returns a boolean mask.
+        """
+        centers = np.asarray(roi_centers, dtype=float).reshape(-1, 2)
+        if len(self.timestamps) == 0 or centers.shape[0] == 0:
+            return np.zeros(centers.shape[0], dtype=bool)
+        # Parsed one by one, as the precision and the time zone of the
+        # timestamps may differ, e.g. isoformat drops zero microseconds.
+        detection_times = np.array(
+            [parse_timestamp(timestamp) for timestamp in timestamps],
+            dtype="datetime64[us]",
+        )
+        epochs = self.timestamps.searchsorted(detection_times, side="right") - 1
+        has_markers = epochs >= 0
+        borders = self.borders[np.maximum(epochs, 0)]
+        return has_markers & self._outside_borders(borders, centers)
+
+    def _outside_borders(self, borders: np.ndarray, centers: np.ndarray):
+        center_x = centers[..., 0] + ROI_CORRECTION_OFFSET
+        center_y = centers[..., 1] + ROI_CORRECTION_OFFSET
+        border_left, border_top, border_right, border_bot = np.moveaxis(borders, -1, 0)
+
+        # Apply offset to account for size of cropped image that the model works on
+        frame_offset = self.image_size // 2
+        return (
+            (center_x - frame_offset <= border_left)
+            | (center_x + frame_offset >= border_right)
+            | (center_y - frame_offset <= border_top)
+            | (center_y + frame_offset >= border_bot)
+        )
+
+
+def parse_timestamp(timestamp: str) -> datetime.datetime:
+    """
+    Parses an ISO 8601 timestamp of the metadata or the markers CSV into a
+    naive datetime. Timestamps with a time zone are converted to UTC, naive
+    timestamps are taken as they are.
+    """
+    parsed = datetime.datetime.fromisoformat(timestamp)
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return parsed